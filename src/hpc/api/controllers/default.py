@@ -2,10 +2,17 @@ from aiohttp.web_request import Request
 
 from hpc.api.services.listing import Listing
 from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_batch_request import JobBatchRequest
 import hpc.api.services.job as job
+import hpc.api.services.sweep as sweep
+import hpc.api.services.workflow as workflow
+from hpc.api.openapi.models.workflow_request import WorkflowRequest
+from hpc.api.openapi.models.sweep_request import SweepRequest
 from hpc.api.openapi.models.infrastructure import Infrastructure
 import hpc.api.services.infrastructure as infrastructure
 import hpc.api.services.telemetry as telemetry
+import hpc.api.services.event_stream as event_stream
+import hpc.api.utils.events as events
 from hpc.api.log import get_logger
 from hpc.api.openapi.models.file_transfer_request import FileTransferRequest
 from hpc.api.openapi.models.s3_file_transfer_request import S3FileTransferRequest
@@ -38,10 +45,32 @@ async def submit_new_job(request: Request):
         return {"message": str(ex)}, 500
 
 
-async def get_job_status(job_id):
+async def submit_job_batch(request: Request):
+    logger.debug("Submitting a batch of jobs")
+
+    if request.content_type == "application/json":
+        job_batch_request = JobBatchRequest.from_dict(await request.json())
+        logger.debug(job_batch_request)
+    else:
+        return {"Incorrect input, expected JSON"}, 400
+
+    try:
+        res = await job.submit_batch(job_batch_request)
+        return [r.to_dict() for r in res], 201
+    except Exception as ex:
+        logger.exception("An error occurred during submission of a batch of jobs")
+        return {"message": str(ex)}, 500
+
+
+async def get_job_status(job_id, wait=None, if_status_not=None):
     logger.debug("Retrieving job status: {}".format(job_id))
     try:
-        res = await job.get(job_id)
+        if wait:
+            res = await events.wait_for_change(
+                lambda: job.get(job_id), events.JOB, job_id, wait,
+                if_status_not)
+        else:
+            res = await job.get(job_id)
         return res.to_dict(), 200
     except KeyError as ex:
         logger.exception("Job not found: {}".format(job_id))
@@ -51,6 +80,80 @@ async def get_job_status(job_id):
         return {"message": str(ex)}, 500
 
 
+async def submit_sweep(request: Request):
+    logger.debug("Starting a parameter sweep")
+
+    if request.content_type == "application/json":
+        sweep_request = SweepRequest.from_dict(await request.json())
+        logger.debug(sweep_request)
+    else:
+        return {"Incorrect input, expected JSON"}, 400
+
+    try:
+        res = await sweep.submit(sweep_request)
+        return res.to_dict(), 201
+    except ValueError as ex:
+        logger.exception("Invalid parameter sweep")
+        return {"message": str(ex)}, 400
+    except Exception as ex:
+        logger.exception("An error occurred during submission of the sweep")
+        return {"message": str(ex)}, 500
+
+
+async def get_sweep_status(sweep_id):
+    logger.debug("Retrieving sweep status: {}".format(sweep_id))
+    try:
+        res = await sweep.get(sweep_id)
+        return res.to_dict(), 200
+    except KeyError as ex:
+        logger.exception("Sweep not found: {}".format(sweep_id))
+        return {"message": str(ex)}, 404
+    except Exception as ex:
+        logger.exception("An error occurred during retrieval of the sweep")
+        return {"message": str(ex)}, 500
+
+
+async def submit_workflow(request: Request):
+    logger.debug("Starting a workflow")
+
+    if request.content_type == "application/json":
+        workflow_request = WorkflowRequest.from_dict(await request.json())
+        logger.debug(workflow_request)
+    else:
+        return {"Incorrect input, expected JSON"}, 400
+
+    try:
+        res = await workflow.submit(workflow_request)
+        return res.to_dict(), 201
+    except Exception as ex:
+        logger.exception("An error occurred while starting the workflow")
+        return {"message": str(ex)}, 500
+
+
+async def get_workflow_status(workflow_id, wait=None, if_status_not=None):
+    logger.debug("Retrieving workflow status: {}".format(workflow_id))
+    try:
+        if wait:
+            res = await events.wait_for_change(
+                lambda: workflow.get(workflow_id), events.WORKFLOW,
+                workflow_id, wait, if_status_not)
+        else:
+            res = await workflow.get(workflow_id)
+        return res.to_dict(), 200
+    except KeyError as ex:
+        logger.exception("Workflow not found: {}".format(workflow_id))
+        return {"message": str(ex)}, 404
+    except Exception as ex:
+        logger.exception("An error occurred during retrieval of the workflow")
+        return {"message": str(ex)}, 500
+
+
+async def stream_events(request: Request, id_=None, infrastructure=None,
+                        type_=None):
+    logger.debug("Streaming events")
+    return await event_stream.stream(request, id_, infrastructure, type_)
+
+
 async def create_new_infrastructure(request: Request):
     logger.debug("Creating a new infrastructure")
     if request.content_type == "application/json":
@@ -117,11 +220,17 @@ async def transfer_remote_file(request: Request):
         return {"message": str(ex)}, 500
 
 
-async def get_file_transfer_status(file_transfer_id):
+async def get_file_transfer_status(file_transfer_id, wait=None,
+                                   if_status_not=None):
     logger.debug("Retrieving file transfer: {}".format(file_transfer_id))
     try:
         dm = DataManagerFactory.get_data_manager(DataManagerFactory.HTTP)
-        res = await dm.get(file_transfer_id)
+        if wait:
+            res = await events.wait_for_change(
+                lambda: dm.get(file_transfer_id), events.FILE_TRANSFER,
+                file_transfer_id, wait, if_status_not)
+        else:
+            res = await dm.get(file_transfer_id)
         return res.to_dict(), 200
     except KeyError as ex:
         logger.exception(
@@ -146,16 +255,25 @@ async def transfer_remote_s3_file(request: Request):
         dm = DataManagerFactory.get_data_manager(DataManagerFactory.S3)
         res = await dm.transfer(ft_request)
         return res.to_dict(), 201
+    except ValueError as ex:
+        logger.exception("Invalid S3 file transfer")
+        return {"message": str(ex)}, 400
     except Exception as ex:
         logger.exception("An error occurred during transferring an S3 file")
         return {"message": str(ex)}, 500
 
 
-async def get_s3_file_transfer_status(file_transfer_id):
+async def get_s3_file_transfer_status(file_transfer_id, wait=None,
+                                      if_status_not=None):
     logger.debug("Retrieving S3 file transfer: {}".format(file_transfer_id))
     try:
         dm = DataManagerFactory.get_data_manager(DataManagerFactory.S3)
-        res = await dm.get(file_transfer_id)
+        if wait:
+            res = await events.wait_for_change(
+                lambda: dm.get(file_transfer_id), events.S3_TRANSFER,
+                file_transfer_id, wait, if_status_not)
+        else:
+            res = await dm.get(file_transfer_id)
         return res.to_dict(), 200
     except KeyError as ex:
         logger.exception(
@@ -180,16 +298,25 @@ async def transfer_remote_s3_results(request: Request):
         dm = DataManagerFactory.get_data_manager(DataManagerFactory.S3_RESULT)
         res = await dm.transfer(ft_request)
         return res.to_dict(), 201
+    except ValueError as ex:
+        logger.exception("Invalid S3 result transfer")
+        return {"message": str(ex)}, 400
     except Exception as ex:
         logger.exception("An error occurred during transferring a result to S3")
         return {"message": str(ex)}, 500
 
 
-async def get_s3_result_transfer_status(file_transfer_id):
+async def get_s3_result_transfer_status(file_transfer_id, wait=None,
+                                        if_status_not=None):
     logger.debug("Retrieving S3 result transfer: {}".format(file_transfer_id))
     try:
         dm = DataManagerFactory.get_data_manager(DataManagerFactory.S3_RESULT)
-        res = await dm.get(file_transfer_id)
+        if wait:
+            res = await events.wait_for_change(
+                lambda: dm.get(file_transfer_id), events.S3_TRANSFER,
+                file_transfer_id, wait, if_status_not)
+        else:
+            res = await dm.get(file_transfer_id)
         return res.to_dict(), 200
     except KeyError as ex:
         logger.exception(
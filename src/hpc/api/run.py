@@ -3,10 +3,35 @@ import connexion
 
 from hpc.api.openapi import encoder
 from hpc.api.log import get_logger
+import hpc.api.utils.ssh as ssh
+import hpc.api.utils.persistence as persistence
+import hpc.api.utils.template as template
+import hpc.api.services.telemetry as telemetry
+import hpc.api.services.job as job
+import hpc.api.services.data_manager as data_manager
+import hpc.api.services.workflow as workflow
+import hpc.api.services.sweep as sweep
 
 
 logger = get_logger(__name__)
 
+
+async def on_startup(app):
+    template.load()
+    # resume the work of a previous process from the persisted records
+    await job.recover()
+    await data_manager.recover()
+    await workflow.recover()
+    # after the jobs, the sweeps wait for their candidates
+    await sweep.recover()
+
+
+async def on_cleanup(app):
+    telemetry.close()
+    await ssh.close_pool()
+    await persistence.close()
+
+
 async def get_app():
     app = connexion.AioHttpApp(
         __name__,
@@ -26,6 +51,8 @@ async def get_app():
         pass_context_arg_name="request",
         strict_validation=True
         )
+    app.app.on_startup.append(on_startup)
+    app.app.on_cleanup.append(on_cleanup)
 
     return app
 
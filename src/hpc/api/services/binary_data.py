@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+from typing import List, Optional
+
+import asyncssh
+
+import hpc.api.utils.ssh as ssh
+from hpc.api.services.tuning import get_input_path, quote_path
+from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_request_params import JobRequestParams
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Skip the clear and convert stages of jobs whose binary data are up to date
+SKIP_CONVERSION = os.getenv("HPC_GATEWAY_SKIP_CONVERSION", "1") == "1"
+# Written next to the binary data by exe.sh.j2 after a conversion
+STAMP_SUFFIX = ".hpc-gateway-stamp"
+# Parameters the binary data depend on besides the input file, binary data
+# converted with other values are not reused
+CONVERSION_PARAMS = (
+    "root_dir", "workspace", "read_input_data", "input_data_double",
+    "input_data_float", "ideko_kernel", "inbestme_kernel",
+    "benchmark_state", "num_mpi_procs", "num_numa", "num_core_numa", "exe",
+)
+
+
+class BinaryData:
+    """Binary data converted from the input of a job. The fingerprint of
+    their input is the size and mtime of the input file and the hash of
+    the conversion parameters."""
+
+    def __init__(self, params: JobRequestParams):
+        self.input_path = get_input_path(params)
+        self.stamp_path = "{}{}{}{}".format(
+            params.root_dir, params.workspace, params.input_data_double,
+            STAMP_SUFFIX)
+        self.params_hash = hashlib.sha256(json.dumps(
+            [getattr(params, name) for name in CONVERSION_PARAMS]
+        ).encode()).hexdigest()[:16]
+        self.up_to_date = False
+
+    def get_check_command(self) -> str:
+        # prints the current fingerprint of the input followed by the stamp
+        return 'echo "$(stat -c \'%s %Y\' {} 2>/dev/null) {} $(cat {} 2>/dev/null)"'.format(
+            quote_path(self.input_path), self.params_hash,
+            quote_path(self.stamp_path))
+
+    def check(self, data: str) -> bool:
+        fields = data.split()
+        self.up_to_date = len(fields) == 6 and fields[:3] == fields[3:]
+        return self.up_to_date
+
+
+async def check(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    job_requests: List[JobRequest],
+    convert: bool = False
+) -> List[Optional[BinaryData]]:
+    """Compares the inputs of the jobs with the stamps of their binary
+    data in a single command. None for the jobs without parameters or
+    when skipping is disabled. With convert, every job converts its
+    input, the stamps are still written."""
+    if not SKIP_CONVERSION:
+        return [None] * len(job_requests)
+    binary_data = [
+        BinaryData(r.params) if r.params else None for r in job_requests]
+    checked = [b for b in binary_data if b is not None]
+    if convert or not checked:
+        return binary_data
+    command = "; ".join(b.get_check_command() for b in checked)
+    stdout, stderr = await ssh.exec_command(host, username, pkey, command)
+    lines = stdout.split("\n")
+    lines += [""] * (len(checked) - len(lines))
+    for b, line in zip(checked, lines):
+        if b.check(line):
+            logger.debug("Binary data are up to date: {}".format(
+                b.input_path))
+    return binary_data
@@ -1,15 +1,26 @@
+import os
 import json
+import shlex
 import asyncio
-from pathlib import Path
+from bisect import insort
+from collections import deque
+from itertools import count
+from pathlib import Path, PurePosixPath
+from typing import Awaitable, Callable, Deque, Dict, List, Tuple
 from uuid import uuid4
 
 
 import aiofiles.tempfile
+import asyncssh
+from botocore.exceptions import HTTPClientError
 
 import hpc.api.utils.persistence as persistence
 import hpc.api.utils.ssh as ssh
 import hpc.api.utils.downloader as downloader
 import hpc.api.utils.s3 as s3
+import hpc.api.utils.dataset_cache as dataset_cache
+import hpc.api.services.delta_sync as delta_sync
+import hpc.api.services.remote_pull as remote_pull
 from hpc.api.openapi.models.file_transfer_request import FileTransferRequest
 from hpc.api.openapi.models.file_transfer_status import FileTransferStatus
 from hpc.api.openapi.models.s3_file_transfer_request import S3FileTransferRequest
@@ -17,6 +28,474 @@ from hpc.api.openapi.models.s3_file_transfer_status import S3FileTransferStatus
 from hpc.api.openapi.models.file_transfer_status_code import FileTransferStatusCode
 from hpc.api.openapi.models.s3_result_transfer_request import S3ResultTransferRequest
 from hpc.api.openapi.models.s3_result_transfer_status import S3ResultTransferStatus
+from hpc.api.openapi.models.transfer_progress import TransferProgress
+from hpc.api.openapi.models.transfer_strategy import TransferStrategy
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Interrupted transfers are resumed from the parts already written
+TRANSFER_RETRIES = int(os.getenv("HPC_GATEWAY_TRANSFER_RETRIES", 3))
+TRANSFER_RETRY_DELAY = float(os.getenv("HPC_GATEWAY_TRANSFER_RETRY_DELAY", 5.0))
+# Transfers running at once, over all and on every infrastructure, the
+# others wait in a queue
+TRANSFER_CONCURRENCY = int(os.getenv("HPC_GATEWAY_TRANSFER_CONCURRENCY", 16))
+TRANSFER_CONCURRENCY_PER_INFRASTRUCTURE = int(os.getenv(
+    "HPC_GATEWAY_TRANSFER_CONCURRENCY_PER_INFRASTRUCTURE", 4))
+# Bytes per second shared by the running transfers of an infrastructure,
+# 0 for no limit
+TRANSFER_BANDWIDTH = int(os.getenv("HPC_GATEWAY_TRANSFER_BANDWIDTH", 0))
+# Files of a prefix transfer transferred at once, at most as many as the
+# SFTP sessions of the pool channels left to transfers allow
+BULK_TRANSFER_CONCURRENCY = int(os.getenv(
+    "HPC_GATEWAY_BULK_TRANSFER_CONCURRENCY", 8))
+GLOB_CHARS = "*?["
+# Errors of a dropped connection, anything else fails the transfer
+RETRIABLE_ERRORS = (
+    asyncssh.DisconnectError,
+    asyncssh.ChannelOpenError,
+    ConnectionError,
+    asyncio.TimeoutError,
+    HTTPClientError,
+)
+
+
+def get_progress(ft_status, part_size: int = None) -> TransferProgress:
+    """Returns the progress recorded on the transfer status, a fresh one
+    if none was recorded yet or it was made with another part size."""
+    progress = ft_status.progress
+    if progress is None or progress.part_size != part_size:
+        progress = TransferProgress(
+            total_bytes=None,
+            transferred_bytes=0,
+            part_size=part_size,
+            completed_parts=[])
+        ft_status.progress = progress
+    return progress
+
+
+async def retry_transfer(
+    transfer: Callable[[], Awaitable[None]],
+    ft_status
+) -> None:
+    for attempt in range(TRANSFER_RETRIES + 1):
+        try:
+            return await transfer()
+        except RETRIABLE_ERRORS as e:
+            if attempt == TRANSFER_RETRIES:
+                raise
+            logger.warning("Transfer {} interrupted: {!r}, resuming".format(
+                ft_status.id, e))
+            await asyncio.sleep(TRANSFER_RETRY_DELAY)
+
+
+def track_parts(
+    ft_status, save_status, part_size: int = ssh.SFTP_PART_SIZE
+) -> ssh.PartCallback:
+    progress = get_progress(ft_status, part_size)
+
+    async def on_part(offset: int, length: int, size: int) -> None:
+        progress.total_bytes = size
+        progress.completed_parts.append(offset)
+        progress.transferred_bytes += length
+        await save_status(ft_status)
+        await get_scheduler().throttle(ft_status.id, length)
+    return on_part
+
+
+async def sftp_upload(
+    host, username, pkey, local_src: Path, remote_dst: Path,
+    ft_status, save_status, sync: bool = False
+) -> None:
+    """ssh.sftp_upload resuming from the completed parts when the
+    connection drops, the progress is saved after every part. With sync
+    the blocks already in place in the remote file count as completed
+    parts and are not sent."""
+    part_size = delta_sync.SYNC_BLOCK_SIZE if sync else ssh.SFTP_PART_SIZE
+    on_part = track_parts(ft_status, save_status, part_size)
+    progress = ft_status.progress
+    if sync and not progress.completed_parts:
+        remote = await delta_sync.get_remote_blocks(
+            host, username, pkey, remote_dst, part_size)
+        unchanged = await delta_sync.get_unchanged_blocks_async(
+            local_src, remote)
+        size = local_src.stat().st_size
+        progress.total_bytes = size
+        progress.completed_parts.extend(unchanged)
+        progress.reused_bytes = sum(
+            min(part_size, size - offset) for offset in unchanged)
+        progress.transferred_bytes += progress.reused_bytes
+        await save_status(ft_status)
+    await retry_transfer(
+        lambda: ssh.sftp_upload(
+            host, username, pkey, local_src, remote_dst,
+            completed_parts=set(progress.completed_parts),
+            on_part=on_part,
+            part_size=part_size),
+        ft_status)
+
+
+async def sftp_download(
+    host, username, pkey, remote_src: Path, local_dst: Path,
+    ft_status, save_status
+) -> None:
+    on_part = track_parts(ft_status, save_status)
+    await retry_transfer(
+        lambda: ssh.sftp_download(
+            host, username, pkey, remote_src, local_dst,
+            completed_parts=set(ft_status.progress.completed_parts),
+            on_part=on_part),
+        ft_status)
+
+
+async def stream_s3_object(
+    host, username, pkey, client, bucket, obj, remote_dst: Path,
+    ft_status, save_status
+) -> None:
+    """Streams the object into the remote file, an interrupted stream is
+    continued with a ranged GET from the last written offset. The
+    progress is saved about once per SFTP part size."""
+    progress = get_progress(ft_status)
+    saved = progress.transferred_bytes
+
+    async def on_chunk(offset: int) -> None:
+        nonlocal saved
+        progress.transferred_bytes = offset
+        if offset - saved >= ssh.SFTP_PART_SIZE:
+            await get_scheduler().throttle(ft_status.id, offset - saved)
+            saved = offset
+            await save_status(ft_status)
+
+    async def stream() -> None:
+        offset = progress.transferred_bytes
+        chunks = s3.stream_object(client, bucket, obj, offset=offset)
+        await ssh.sftp_upload_stream(
+            host, username, pkey, chunks, remote_dst,
+            offset=offset, on_chunk=on_chunk)
+        progress.total_bytes = progress.transferred_bytes
+
+    await retry_transfer(stream, ft_status)
+
+
+async def sync_s3_object(
+    host, username, pkey, client, bucket, obj, remote_dst: Path,
+    ft_status, save_status
+) -> None:
+    """Streams the object through the comparison with the blocks of the
+    existing remote file, only the blocks that differ are written. An
+    interrupted transfer compares again with the blocks written so far."""
+    async def sync() -> None:
+        progress = get_progress(ft_status, delta_sync.SYNC_BLOCK_SIZE)
+        progress.transferred_bytes = 0
+        progress.reused_bytes = 0
+        remote = await delta_sync.get_remote_blocks(
+            host, username, pkey, remote_dst, progress.part_size)
+
+        async def on_block(offset: int, length: int, written: bool) -> None:
+            progress.transferred_bytes = offset + length
+            if not written:
+                progress.reused_bytes += length
+                return
+            await save_status(ft_status)
+            await get_scheduler().throttle(ft_status.id, length)
+
+        chunks = s3.stream_object(client, bucket, obj)
+        await ssh.sftp_write_blocks(
+            host, username, pkey, delta_sync.changed_blocks(chunks, remote),
+            remote_dst, on_block=on_block)
+        progress.total_bytes = progress.transferred_bytes
+
+    await retry_transfer(sync, ft_status)
+
+
+async def try_remote_pull(
+    host, username, pkey, url: str, remote_dst: Path,
+    ft_status, save_status
+) -> bool:
+    """Lets the infrastructure download the url itself. False when that
+    failed and the data have to be relayed by the gateway instead, a
+    download that timed out fails the transfer."""
+    progress = get_progress(ft_status)
+
+    async def on_progress(size: int) -> None:
+        progress.transferred_bytes = size
+        await save_status(ft_status)
+
+    ft_status.strategy = TransferStrategy.REMOTE_PULL
+    try:
+        await remote_pull.pull(
+            host, username, pkey, url, remote_dst, on_progress)
+    except remote_pull.RemotePullTimeout:
+        # relaying a download this slow would hold the slot as long again
+        raise
+    except Exception as e:
+        logger.warning("Remote pull of transfer {} failed, relaying it: {!r}".format(
+            ft_status.id, e))
+        ft_status.strategy = TransferStrategy.RELAY
+        ft_status.progress = None
+        return False
+    progress.total_bytes = progress.transferred_bytes
+    return True
+
+
+def check_object_or_prefix(ft_request) -> None:
+    if (ft_request.object is None) == (ft_request.prefix is None):
+        raise ValueError("Either an object or a prefix is required")
+
+
+def get_relative_path(name: str, base: str) -> PurePosixPath:
+    """The path of name below base, names leaving base are refused."""
+    path = PurePosixPath(name[len(base):].lstrip("/"))
+    if not path.parts or ".." in path.parts:
+        raise ValueError("Invalid name below {}: {}".format(base, name))
+    return path
+
+
+def get_object_key(prefix: str, path: PurePosixPath) -> str:
+    """The key of path below prefix, the prefix is a directory whether
+    or not it ends with a slash."""
+    prefix = prefix.rstrip("/")
+    return "{}/{}".format(prefix, path) if prefix else str(path)
+
+
+def split_glob(src: str) -> Tuple[str, str]:
+    """Returns the leading directory of src without wildcards and the
+    pattern of the files to match, all the files below src when it is a
+    directory."""
+    parts = src.rstrip("/").split("/")
+    for i, part in enumerate(parts):
+        if any(c in part for c in GLOB_CHARS):
+            return "/".join(parts[:i]), src
+    base = "/".join(parts)
+    return base, "{}/**/*".format(base) if base else "**/*"
+
+
+def get_bulk_concurrency() -> int:
+    """Files of a prefix transfer run at once. Every file may use
+    SFTP_CONCURRENCY sessions, they have to fit in the bulk channels of
+    the pool."""
+    return max(1, min(
+        BULK_TRANSFER_CONCURRENCY,
+        ssh.get_pool().max_bulk_channels // ssh.SFTP_CONCURRENCY))
+
+
+async def transfer_files(
+    files: List[Tuple[str, int]],
+    transfer_file: Callable[[str], Awaitable[None]],
+    ft_status,
+    save_status
+) -> None:
+    """Transfers the (name, size) files of a prefix transfer, up to
+    get_bulk_concurrency() at once over the pooled connections. The
+    aggregated progress is saved after every file."""
+    progress = get_progress(ft_status)
+    progress.total_files = len(files)
+    progress.transferred_files = 0
+    progress.total_bytes = sum(size for _, size in files)
+    progress.transferred_bytes = 0
+    await save_status(ft_status)
+    semaphore = asyncio.Semaphore(get_bulk_concurrency())
+
+    async def transfer(name: str, size: int) -> None:
+        async with semaphore:
+            await retry_transfer(lambda: transfer_file(name), ft_status)
+            progress.transferred_files += 1
+            progress.transferred_bytes += size
+            await save_status(ft_status)
+            await get_scheduler().throttle(ft_status.id, size)
+
+    tasks = [asyncio.ensure_future(transfer(*f)) for f in files]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # the first failure fails the transfer, stop the other files
+        for task in tasks:
+            task.cancel()
+
+
+class ScheduledTransfer:
+    def __init__(
+        self,
+        ft_status,
+        run: Callable[[], Awaitable[None]],
+        get_directory: Callable[[str], str]
+    ):
+        self.ft_status = ft_status
+        self.run = run
+        self.get_directory = get_directory
+        self.key = None
+        self.started = None
+        self.transferred = 0
+
+    def __lt__(self, other: "ScheduledTransfer") -> bool:
+        return self.key < other.key
+
+    def record(self) -> Tuple[str, str]:
+        return self.get_directory(self.ft_status.id), \
+            json.dumps(self.ft_status.to_dict())
+
+
+class TransferScheduler:
+    """Runs a bounded number of transfers at once, over all and on every
+    infrastructure. Queued transfers start by priority then in submission
+    order, the free slots go to the infrastructures in turn so that a
+    burst on one of them does not hold up the others."""
+
+    def __init__(
+        self,
+        concurrency: int = TRANSFER_CONCURRENCY,
+        concurrency_per_infrastructure: int = TRANSFER_CONCURRENCY_PER_INFRASTRUCTURE,
+        bandwidth: int = TRANSFER_BANDWIDTH
+    ):
+        self.concurrency = concurrency
+        self.concurrency_per_infrastructure = concurrency_per_infrastructure
+        self.bandwidth = bandwidth
+        self.loop = asyncio.get_event_loop()
+        self.queues: Dict[str, List[ScheduledTransfer]] = {}
+        self.running: Dict[str, ScheduledTransfer] = {}
+        self.running_per_infrastructure: Dict[str, int] = {}
+        # infrastructures with queued transfers, in turn
+        self.turns: Deque[str] = deque()
+        self.counter = count()
+
+    async def submit(self, transfer: ScheduledTransfer) -> None:
+        """Queues the transfer and starts the transfers with a free slot,
+        the status of the transfer is saved either way."""
+        ft_status = transfer.ft_status
+        transfer.key = (-(ft_status.priority or 0), next(self.counter))
+        ft_status.status = FileTransferStatusCode.QUEUED
+        ft_status.queue_position = None
+        queue = self.queues.setdefault(ft_status.infrastructure, [])
+        if not queue:
+            self.turns.append(ft_status.infrastructure)
+        insort(queue, transfer)
+        await self.dispatch()
+
+    async def dispatch(self) -> None:
+        while len(self.running) < self.concurrency:
+            transfer = self.next_transfer()
+            if transfer is None:
+                break
+            await self.start(transfer)
+        # the queued transfers moved up are saved at once
+        moved = []
+        for queue in self.queues.values():
+            for position, transfer in enumerate(queue):
+                if transfer.ft_status.queue_position != position:
+                    transfer.ft_status.queue_position = position
+                    moved.append(transfer.record())
+        if moved:
+            await persistence.save_many(moved)
+
+    def next_transfer(self):
+        for _ in range(len(self.turns)):
+            infrastructure = self.turns[0]
+            self.turns.rotate(-1)
+            running = self.running_per_infrastructure.get(infrastructure, 0)
+            if running >= self.concurrency_per_infrastructure:
+                continue
+            queue = self.queues[infrastructure]
+            transfer = queue.pop(0)
+            if not queue:
+                del self.queues[infrastructure]
+                self.turns.remove(infrastructure)
+            return transfer
+        return None
+
+    async def start(self, transfer: ScheduledTransfer) -> None:
+        ft_status = transfer.ft_status
+        infrastructure = ft_status.infrastructure
+        self.running[ft_status.id] = transfer
+        self.running_per_infrastructure[infrastructure] = \
+            self.running_per_infrastructure.get(infrastructure, 0) + 1
+        transfer.started = self.loop.time()
+        ft_status.status = FileTransferStatusCode.TRANSFERRING
+        ft_status.queue_position = None
+        await persistence.save(*transfer.record())
+        asyncio.create_task(self.run(transfer), name=ft_status.id)
+
+    async def run(self, transfer: ScheduledTransfer) -> None:
+        infrastructure = transfer.ft_status.infrastructure
+        try:
+            await transfer.run()
+        finally:
+            del self.running[transfer.ft_status.id]
+            self.running_per_infrastructure[infrastructure] -= 1
+            await self.dispatch()
+
+    async def throttle(self, transfer_id: str, length: int) -> None:
+        """Delays a running transfer while it is ahead of its share of the
+        bandwidth of its infrastructure, the running transfers of an
+        infrastructure share its bandwidth equally."""
+        transfer = self.running.get(transfer_id)
+        if not self.bandwidth or transfer is None:
+            return
+        transfer.transferred += length
+        share = self.bandwidth / self.running_per_infrastructure[
+            transfer.ft_status.infrastructure]
+        delay = transfer.started + transfer.transferred / share \
+            - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_scheduler = None
+
+
+def get_scheduler() -> TransferScheduler:
+    global _scheduler
+    if _scheduler is None or _scheduler.loop is not asyncio.get_event_loop():
+        _scheduler = TransferScheduler()
+    return _scheduler
+
+
+async def find_records(collection: str, statuses) -> List[dict]:
+    """The records of collection in any of statuses, each record once
+    and in the order of statuses."""
+    records = {}
+    for status in statuses:
+        for data in await persistence.find(collection, status=status):
+            record = persistence.load_record(data)
+            records.setdefault(record["id"], record)
+    return list(records.values())
+
+
+async def recover() -> int:
+    """Queues the HTTP transfers interrupted by a restart again, the
+    running ones first, they resume from the parts already uploaded. The
+    credentials of S3 transfers are not persisted, these transfers are
+    failed instead."""
+    manager = HTTPDataManager()
+    statuses = (FileTransferStatusCode.TRANSFERRING,
+                FileTransferStatusCode.QUEUED)
+    # scheduling saves the transfers past the limits as queued, both
+    # statuses are read before any of them is scheduled
+    http_records = await find_records(
+        persistence.get_file_transfers_collection(), statuses)
+    s3_records = await find_records(
+        persistence.get_s3_transfers_collection(), statuses)
+    for record in http_records:
+        ft_status = FileTransferStatus.from_dict(record)
+        ft_request = FileTransferRequest(
+            src=ft_status.src,
+            dst=ft_status.dst,
+            infrastructure=ft_status.infrastructure,
+            priority=ft_status.priority,
+            sync=ft_status.sync)
+        await manager.schedule(ft_request, ft_status)
+    for record in s3_records:
+        record["status"] = FileTransferStatusCode.FAILURE
+        record["queue_position"] = None
+        record["reason"] = "Interrupted by a restart"
+    await persistence.save_many(
+        (persistence.get_s3_transfer_directory(record["id"]), json.dumps(record))
+        for record in s3_records)
+    resumed, failed = len(http_records), len(s3_records)
+    if resumed or failed:
+        logger.info("Resumed {} transfers, failed {} S3 transfers".format(
+            resumed, failed))
+    return resumed
 
 
 class DataManagerFactory:
@@ -43,38 +522,45 @@ class HTTPDataManager:
     ) -> FileTransferStatus:
         ft_status = FileTransferStatus(
             id=str(uuid4()),
-            status=FileTransferStatusCode.TRANSFERRING,
+            status=FileTransferStatusCode.QUEUED,
             infrastructure=ft_request.infrastructure,
             src=ft_request.src,
             dst=ft_request.dst,
+            priority=ft_request.priority,
+            sync=ft_request.sync,
             reason="")
-        await persistence.save(
-            persistence.get_file_transfer_directory(ft_status.id),
-            json.dumps(ft_status.to_dict()))
-        asyncio.create_task(
-            self.handle_copy(ft_request, ft_status),
-            name=ft_status.id)
+        await self.schedule(ft_request, ft_status)
         return ft_status
 
+    async def schedule(self, ft_request, ft_status) -> None:
+        await get_scheduler().submit(ScheduledTransfer(
+            ft_status,
+            lambda: self.handle_copy(ft_request, ft_status),
+            persistence.get_file_transfer_directory))
+
     async def handle_copy(
         self,
         ft_request: FileTransferRequest,
         ft_status: FileTransferStatus
     ) -> None:
         try:
-            await self.copy(ft_request)
+            await self.copy(ft_request, ft_status)
             ft_status.status = FileTransferStatusCode.COMPLETED
         except Exception as e:  # TODO: better error handling and error description
             ft_status.status = FileTransferStatusCode.FAILURE
             ft_status.reason = repr(e)
         finally:
-            await persistence.save(
-                persistence.get_file_transfer_directory(ft_status.id),
-                json.dumps(ft_status.to_dict()))
+            await self.save_status(ft_status)
+
+    async def save_status(self, ft_status) -> None:
+        await persistence.save(
+            persistence.get_file_transfer_directory(ft_status.id),
+            json.dumps(ft_status.to_dict()))
 
     async def copy(
         self,
-        ft_request: FileTransferRequest
+        ft_request: FileTransferRequest,
+        ft_status: FileTransferStatus
     ) -> None:
         infrastructure = json.loads(
             await persistence.get(
@@ -84,6 +570,14 @@ class HTTPDataManager:
         pkey = await ssh.get_pkey(key_path, key_password)
         host = infrastructure["host"]
         username = infrastructure["username"]
+        if remote_pull.is_enabled(infrastructure) \
+                and remote_pull.is_pullable(ft_request.src) \
+                and not ft_request.sync:
+            if await try_remote_pull(
+                    host, username, pkey, ft_request.src,
+                    Path(ft_request.dst), ft_status, self.save_status):
+                return
+        ft_status.strategy = TransferStrategy.RELAY
         async with aiofiles.tempfile.TemporaryDirectory() as download_dir:
             # download remote file into local fs
             local_dst = Path(download_dir) / \
@@ -92,7 +586,17 @@ class HTTPDataManager:
             # upload local file to sftp
             local_src = local_dst
             remote_dst = Path(ft_request.dst)
-            await ssh.sftp_upload(host, username, pkey, local_src, remote_dst)
+            cache = dataset_cache.get_cache()
+            if cache.enabled:
+                key = await dataset_cache.file_key(local_src)
+                if await cache.fetch(host, username, pkey, key, remote_dst):
+                    ft_status.cache_hit = True
+                    return
+            await sftp_upload(
+                host, username, pkey, local_src, remote_dst,
+                ft_status, self.save_status, sync=ft_request.sync)
+            if cache.enabled:
+                await cache.store(host, username, pkey, key, remote_dst)
 
     async def get(
         self,
@@ -109,43 +613,52 @@ class S3DataManager:
         self,
         ft_request: S3FileTransferRequest
     ) -> S3FileTransferStatus:
+        check_object_or_prefix(ft_request)
         ft_status = S3FileTransferStatus(
             id=str(uuid4()),
-            status=FileTransferStatusCode.TRANSFERRING,
+            status=FileTransferStatusCode.QUEUED,
             infrastructure=ft_request.infrastructure,
             endpoint=ft_request.endpoint,
             bucket=ft_request.bucket,
             object=ft_request.object,
+            prefix=ft_request.prefix,
             region=ft_request.region,
             dst=ft_request.dst,
+            priority=ft_request.priority,
+            sync=ft_request.sync,
             reason="")
-        await persistence.save(
-            persistence.get_s3_transfer_directory(ft_status.id),
-            json.dumps(ft_status.to_dict()))
-        asyncio.create_task(
-            self.handle_copy(ft_request, ft_status),
-            name=ft_status.id)
+        await self.schedule(ft_request, ft_status)
         return ft_status
 
+    async def schedule(self, ft_request, ft_status) -> None:
+        await get_scheduler().submit(ScheduledTransfer(
+            ft_status,
+            lambda: self.handle_copy(ft_request, ft_status),
+            persistence.get_s3_transfer_directory))
+
     async def handle_copy(
         self,
         ft_request: S3FileTransferRequest,
         ft_status: S3FileTransferStatus
     ) -> None:
         try:
-            await self.copy(ft_request)
+            await self.copy(ft_request, ft_status)
             ft_status.status = FileTransferStatusCode.COMPLETED
         except Exception as e:  # TODO: better error handling and error description
             ft_status.status = FileTransferStatusCode.FAILURE
             ft_status.reason = repr(e)
         finally:
-            await persistence.save(
-                persistence.get_s3_transfer_directory(ft_status.id),
-                json.dumps(ft_status.to_dict()))
+            await self.save_status(ft_status)
+
+    async def save_status(self, ft_status) -> None:
+        await persistence.save(
+            persistence.get_s3_transfer_directory(ft_status.id),
+            json.dumps(ft_status.to_dict()))
 
     async def copy(
         self,
-        ft_request: S3FileTransferRequest
+        ft_request: S3FileTransferRequest,
+        ft_status: S3FileTransferStatus
     ) -> None:
         infrastructure = json.loads(
             await persistence.get(
@@ -155,23 +668,80 @@ class S3DataManager:
         pkey = await ssh.get_pkey(key_path, key_password)
         host = infrastructure["host"]
         username = infrastructure["username"]
-        async with aiofiles.tempfile.TemporaryDirectory() as download_dir:
-            client = s3.get_client(
-                ft_request.endpoint,
-                ft_request.region,
-                ft_request.access_key,
-                ft_request.secret_key)
-            # download remote file into local fs
-            local_dst = Path(download_dir) / ft_request.object
-            await s3.download_file(
-                client,
-                ft_request.bucket,
-                ft_request.object,
-                local_dst)
-            # upload local file to sftp
-            local_src = local_dst
-            remote_dst = Path(ft_request.dst)
-            await ssh.sftp_upload(host, username, pkey, local_src, remote_dst)
+        client = s3.get_client(
+            ft_request.endpoint,
+            ft_request.region,
+            ft_request.access_key,
+            ft_request.secret_key)
+        if ft_request.prefix is not None:
+            return await self.copy_prefix(
+                host, username, pkey, client, ft_request, ft_status)
+        remote_dst = Path(ft_request.dst)
+        cache = dataset_cache.get_cache()
+        if cache.enabled:
+            head = await s3.head_object(
+                client, ft_request.bucket, ft_request.object)
+            key = dataset_cache.s3_key(
+                ft_request.endpoint, ft_request.bucket, ft_request.object, head)
+            if await cache.fetch(host, username, pkey, key, remote_dst):
+                ft_status.cache_hit = True
+                return
+        if remote_pull.is_enabled(infrastructure) and not ft_request.sync:
+            url = s3.get_presigned_url(
+                client, ft_request.bucket, ft_request.object,
+                remote_pull.PRESIGNED_URL_EXPIRY)
+            if await try_remote_pull(
+                    host, username, pkey, url, remote_dst,
+                    ft_status, self.save_status):
+                if cache.enabled:
+                    await cache.store(host, username, pkey, key, remote_dst)
+                return
+        ft_status.strategy = TransferStrategy.RELAY
+        if ft_request.sync:
+            await sync_s3_object(
+                host, username, pkey, client,
+                ft_request.bucket, ft_request.object, remote_dst,
+                ft_status, self.save_status)
+        else:
+            # stream the object body straight into the remote file
+            await stream_s3_object(
+                host, username, pkey, client,
+                ft_request.bucket, ft_request.object, remote_dst,
+                ft_status, self.save_status)
+        if cache.enabled:
+            await cache.store(host, username, pkey, key, remote_dst)
+
+    async def copy_prefix(
+        self,
+        host, username, pkey, client,
+        ft_request: S3FileTransferRequest,
+        ft_status: S3FileTransferStatus
+    ) -> None:
+        """Streams the objects below the prefix into the dst directory."""
+        # the objects below runs/7 only, not those of runs/70
+        prefix = ft_request.prefix.rstrip("/")
+        if prefix:
+            prefix += "/"
+        objects = await s3.list_objects(client, ft_request.bucket, prefix)
+        files = [(o["Key"], o["Size"]) for o in objects
+                 if not o["Key"].endswith("/")]
+        if not files:
+            raise ValueError("No objects below the prefix {} of {}".format(
+                ft_request.prefix, ft_request.bucket))
+        remote_dsts = {
+            key: Path(ft_request.dst) / get_relative_path(key, prefix)
+            for key, _ in files}
+        directories = sorted({str(p.parent) for p in remote_dsts.values()})
+        if directories:
+            await ssh.exec_command(host, username, pkey, "mkdir -p {}".format(
+                " ".join(shlex.quote(d) for d in directories)))
+
+        async def transfer_file(key: str) -> None:
+            await ssh.sftp_upload_stream(
+                host, username, pkey,
+                s3.stream_object(client, ft_request.bucket, key),
+                remote_dsts[key])
+        await transfer_files(files, transfer_file, ft_status, self.save_status)
 
     async def get(
         self,
@@ -188,43 +758,51 @@ class S3ResultManager:
         self,
         ft_request: S3ResultTransferRequest
     ) -> S3ResultTransferStatus:
+        check_object_or_prefix(ft_request)
         ft_status = S3ResultTransferStatus(
             id=str(uuid4()),
-            status=FileTransferStatusCode.TRANSFERRING,
+            status=FileTransferStatusCode.QUEUED,
             infrastructure=ft_request.infrastructure,
             endpoint=ft_request.endpoint,
             bucket=ft_request.bucket,
             object=ft_request.object,
+            prefix=ft_request.prefix,
             region=ft_request.region,
             src=ft_request.src,
+            priority=ft_request.priority,
             reason="")
-        await persistence.save(
-            persistence.get_s3_transfer_directory(ft_status.id),
-            json.dumps(ft_status.to_dict()))
-        asyncio.create_task(
-            self.handle_copy(ft_request, ft_status),
-            name=ft_status.id)
+        await self.schedule(ft_request, ft_status)
         return ft_status
 
+    async def schedule(self, ft_request, ft_status) -> None:
+        await get_scheduler().submit(ScheduledTransfer(
+            ft_status,
+            lambda: self.handle_copy(ft_request, ft_status),
+            persistence.get_s3_transfer_directory))
+
     async def handle_copy(
         self,
         ft_request: S3ResultTransferRequest,
         ft_status: S3ResultTransferStatus
     ) -> None:
         try:
-            await self.copy(ft_request)
+            await self.copy(ft_request, ft_status)
             ft_status.status = FileTransferStatusCode.COMPLETED
         except Exception as e:  # TODO: better error handling and error description
             ft_status.status = FileTransferStatusCode.FAILURE
             ft_status.reason = repr(e)
         finally:
-            await persistence.save(
-                persistence.get_s3_transfer_directory(ft_status.id),
-                json.dumps(ft_status.to_dict()))
+            await self.save_status(ft_status)
+
+    async def save_status(self, ft_status) -> None:
+        await persistence.save(
+            persistence.get_s3_transfer_directory(ft_status.id),
+            json.dumps(ft_status.to_dict()))
 
     async def copy(
         self,
-        ft_request: S3ResultTransferRequest
+        ft_request: S3ResultTransferRequest,
+        ft_status: S3ResultTransferStatus
     ) -> None:
         infrastructure = json.loads(
             await persistence.get(
@@ -234,11 +812,16 @@ class S3ResultManager:
         pkey = await ssh.get_pkey(key_path, key_password)
         host = infrastructure["host"]
         username = infrastructure["username"]
+        if ft_request.prefix is not None:
+            return await self.copy_prefix(
+                host, username, pkey, ft_request, ft_status)
         async with aiofiles.tempfile.TemporaryDirectory() as download_dir:
             # download from sftp to local file
             remote_src = Path(ft_request.src)
             local_dst = Path(download_dir) / ft_request.object
-            await ssh.sftp_download(host, username, pkey, remote_src, local_dst)
+            await sftp_download(
+                host, username, pkey, remote_src, local_dst,
+                ft_status, self.save_status)
             client = s3.get_client(
                 ft_request.endpoint,
                 ft_request.region,
@@ -252,6 +835,46 @@ class S3ResultManager:
                 ft_request.bucket,
                 ft_request.object)
 
+    async def copy_prefix(
+        self,
+        host, username, pkey,
+        ft_request: S3ResultTransferRequest,
+        ft_status: S3ResultTransferStatus
+    ) -> None:
+        """Uploads the files matched by src below the prefix, every file
+        is staged locally until it is uploaded."""
+        base, pattern = split_glob(ft_request.src)
+        files = await ssh.sftp_glob(host, username, pkey, pattern)
+        if not files:
+            # also a src naming a single file, which has nothing below it
+            raise ValueError("No files match {}, a directory or a glob "
+                             "pattern is expected".format(ft_request.src))
+        objects = {
+            name: get_object_key(
+                ft_request.prefix, get_relative_path(name, base))
+            for name, _ in files}
+        client = s3.get_client(
+            ft_request.endpoint,
+            ft_request.region,
+            ft_request.access_key,
+            ft_request.secret_key)
+        async with aiofiles.tempfile.TemporaryDirectory() as download_dir:
+            local_dsts = {
+                name: Path(download_dir) / str(i)
+                for i, (name, _) in enumerate(files)}
+
+            async def transfer_file(name: str) -> None:
+                local_dst = local_dsts[name]
+                try:
+                    await ssh.sftp_download(
+                        host, username, pkey, Path(name), local_dst)
+                    await s3.upload_file(
+                        client, local_dst, ft_request.bucket, objects[name])
+                finally:
+                    local_dst.unlink(missing_ok=True)
+            await transfer_files(
+                files, transfer_file, ft_status, self.save_status)
+
     async def get(
         self,
         file_transfer_id: str
@@ -0,0 +1,113 @@
+import os
+import shlex
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, List, Optional, Tuple
+
+import asyncssh
+
+import hpc.api.utils.ssh as ssh
+
+
+MB = 1048576  # 1 MB in bytes
+
+# Files are compared block by block, only the blocks that differ from the
+# existing remote file are sent
+SYNC_BLOCK_SIZE = int(os.getenv("HPC_GATEWAY_SYNC_BLOCK_SIZE", 4 * MB))
+
+
+class RemoteBlocks:
+    """Size and block digests of the existing remote file, no blocks when
+    there is no such file."""
+
+    def __init__(self, size: int = 0, digests: List[str] = None,
+                 block_size: int = SYNC_BLOCK_SIZE):
+        self.size = size
+        self.digests = digests or []
+        self.block_size = block_size
+
+    def is_unchanged(self, offset: int, data: bytes) -> bool:
+        i = offset // self.block_size
+        if i >= len(self.digests):
+            return False
+        # the last remote block is shorter when the file was appended to
+        length = min(self.block_size, self.size - offset)
+        return len(data) == length and \
+            hashlib.md5(data).hexdigest() == self.digests[i]
+
+
+def get_digests_command(remote_path: Path, block_size: int) -> str:
+    # prints the size of the file then the md5 of every block, nothing
+    # when the file does not exist
+    return (
+        'f={path}; [ -f "$f" ] || exit 0; size=$(stat -c %s "$f"); '
+        'echo "$size"; i=0; while [ $((i * {bs})) -lt "$size" ]; do '
+        'dd if="$f" bs={bs} skip=$i count=1 2>/dev/null | md5sum | cut -c1-32; '
+        'i=$((i + 1)); done').format(
+            path=shlex.quote(str(remote_path)), bs=block_size)
+
+
+def parse_digests(data: str, block_size: int) -> RemoteBlocks:
+    lines = data.split()
+    if not lines:
+        return RemoteBlocks(block_size=block_size)
+    return RemoteBlocks(int(lines[0]), lines[1:], block_size)
+
+
+async def get_remote_blocks(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    remote_path: Path,
+    block_size: int = SYNC_BLOCK_SIZE
+) -> RemoteBlocks:
+    stdout, stderr = await ssh.exec_command(
+        host, username, pkey, get_digests_command(remote_path, block_size))
+    return parse_digests(stdout, block_size)
+
+
+def get_unchanged_blocks(local_path: Path, remote: RemoteBlocks) -> List[int]:
+    """Offsets of the blocks of the local file already in place in the
+    remote file."""
+    size = local_path.stat().st_size
+    unchanged = []
+    with local_path.open("rb") as src:
+        for offset in range(0, min(size, remote.size), remote.block_size):
+            src.seek(offset)
+            if remote.is_unchanged(offset, src.read(remote.block_size)):
+                unchanged.append(offset)
+    return unchanged
+
+
+async def get_unchanged_blocks_async(
+    local_path: Path,
+    remote: RemoteBlocks
+) -> List[int]:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, get_unchanged_blocks, local_path, remote)
+
+
+async def changed_blocks(
+    chunks: AsyncIterable[bytes],
+    remote: RemoteBlocks
+) -> AsyncIterator[Tuple[int, int, Optional[bytes]]]:
+    """Cuts the chunks of a stream into blocks and yields their offset,
+    length and data, the data is None for the blocks already in place."""
+    buffer = bytearray()
+    offset = 0
+
+    def block(data: bytes) -> Tuple[int, int, Optional[bytes]]:
+        unchanged = remote.is_unchanged(offset, data)
+        return offset, len(data), None if unchanged else data
+
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= remote.block_size:
+            data = bytes(buffer[:remote.block_size])
+            del buffer[:remote.block_size]
+            yield block(data)
+            offset += len(data)
+    if buffer:
+        yield block(bytes(buffer))
@@ -0,0 +1,55 @@
+import os
+import json
+import asyncio
+from typing import List, Optional
+
+from aiohttp import web
+from aiohttp.web_request import Request
+
+import hpc.api.utils.events as events
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Seconds between keep-alive comments on idle streams
+EVENT_HEARTBEAT = float(os.getenv("HPC_GATEWAY_EVENT_HEARTBEAT", 15.0))
+
+
+def format_event(event: events.Event) -> bytes:
+    return "event: {}\nid: {}\ndata: {}\n\n".format(
+        event.kind, event.id, json.dumps(event.data)).encode()
+
+
+async def stream(
+    request: Request,
+    ids: Optional[List[str]] = None,
+    infrastructure: Optional[str] = None,
+    kinds: Optional[List[str]] = None,
+    heartbeat: float = EVENT_HEARTBEAT
+) -> web.StreamResponse:
+    """Writes the matching record changes to the client as Server-Sent
+    Events until it disconnects."""
+    bus = events.get_bus()
+    subscription = bus.subscribe(
+        events.Subscription(ids, infrastructure, kinds))
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        # disable response buffering of nginx
+        "X-Accel-Buffering": "no",
+    })
+    try:
+        await response.prepare(request)
+        await response.write(b": connected\n\n")
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), heartbeat)
+                await response.write(format_event(event))
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+    except ConnectionResetError:
+        logger.debug("Event stream closed by the client")
+    finally:
+        bus.unsubscribe(subscription)
+    return response
@@ -1,33 +1,72 @@
+import os
+import re
 import json
 import asyncio
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import uuid4
 
 import hpc.api.utils.ssh as ssh
 import hpc.api.utils.persistence as persistence
 import hpc.api.utils.template as template
+import hpc.api.services.tuning as tuning
+import hpc.api.services.binary_data as binary_data
 from hpc.api.utils.scheduler_helper import SchedulerHelperFactory
+from hpc.api.utils.polling import PollingPolicy
 from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_batch_request import JobBatchRequest
+from hpc.api.openapi.models.job_batch_result import JobBatchResult
 from hpc.api.openapi.models.job_status import JobStatus
 from hpc.api.openapi.models.job_status_code import JobStatusCode
+from hpc.api.log import get_logger
 
 
-DEFAULT_WATCH_PERIOD = 10.0
+logger = get_logger(__name__)
 
+DEFAULT_WATCH_PERIOD = float(os.getenv("HPC_GATEWAY_WATCH_PERIOD", 10.0))
+# A tracked job absent from the scheduler output for this many ticks is
+# considered finished and already purged by the scheduler
+MISSING_TICKS_LIMIT = 3
+# Jobs whose next poll is closer than this fraction of their polling
+# interval are folded into the current query
+COALESCE_FRACTION = 0.25
+# Scheduler errors about jobs that already left its records; such jobs are
+# left to MISSING_TICKS_LIMIT
+UNKNOWN_JOB_ERROR = re.compile(
+    r"unknown job id|job has finished|invalid job id", re.IGNORECASE)
 
-async def submit(job_request: JobRequest) -> JobStatus:
+
+def is_unknown_job_error(stderr: str) -> bool:
+    """Tells whether stderr only reports jobs unknown to the scheduler."""
+    return all(UNKNOWN_JOB_ERROR.search(line)
+               for line in stderr.splitlines() if line.strip())
+
+
+async def connect_infrastructure(
+    infrastructure_name: str
+) -> Tuple[Dict[str, Any], Any]:
+    """Returns the infrastructure record and its SSH key."""
     infrastructure = json.loads(await persistence.get(
-        persistence.get_cluster_directory(job_request.infrastructure)))
+        persistence.get_cluster_directory(infrastructure_name)))
     key_path = infrastructure["ssh_key"]["path"]
     key_password = infrastructure["ssh_key"]["password"]
     pkey = await ssh.get_pkey(key_path, key_password)
+    return infrastructure, pkey
+
+
+async def submit(job_request: JobRequest) -> JobStatus:
+    infrastructure, pkey = await connect_infrastructure(
+        job_request.infrastructure)
     host = infrastructure["host"]
     username = infrastructure["username"]
-    scheduler = infrastructure["scheduler"]
-    helper = SchedulerHelperFactory.helper(scheduler)
+    helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
 
-    rendered_template = template.render(job_request)
+    await tuning.apply_tuned_params(
+        host, username, pkey, infrastructure["name"], [job_request])
+    job_binary_data, = await binary_data.check(
+        host, username, pkey, [job_request])
+    rendered_template = template.render(job_request, job_binary_data)
     batch_cmd = helper.get_submit_command()
-    command = f"{batch_cmd} <<\EOF\n{rendered_template}\nEOF"
+    command = f"{batch_cmd} <<\\EOF\n{rendered_template}\nEOF"
 
     stdout, stderr = await ssh.exec_command(host, username, pkey, command)
     job_id = str(uuid4())
@@ -44,36 +83,372 @@ async def submit(job_request: JobRequest) -> JobStatus:
 
     period = float(job_request.watch_period) \
         if job_request.watch_period else DEFAULT_WATCH_PERIOD
-    asyncio.create_task(
-        watch_job_status(job_status, period), name=job_status.id)
+    watch_job_status(job_status, period)
 
     return job_status
 
 
-async def watch_job_status(job_status: JobStatus, period: float):
-    prev_status = job_status.status
-    infrastructure = json.loads(await persistence.get(
-        persistence.get_cluster_directory(job_status.infrastructure)))
-    key_path = infrastructure["ssh_key"]["path"]
-    key_password = infrastructure["ssh_key"]["password"]
-    pkey = await ssh.get_pkey(key_path, key_password)
+def split_script(script: str) -> Tuple[str, str]:
+    """Splits a job script into its leading comments, which hold the
+    scheduler directives, and the commands."""
+    lines = script.split("\n")
+    for i, line in enumerate(lines):
+        if line.strip() and not line.startswith("#"):
+            return "\n".join(lines[:i]), "\n".join(lines[i:])
+    return script, ""
+
+
+def get_array_script(scripts: List[str], index_variable: str) -> str:
+    """One job script running the commands of scripts[i] as array
+    element i, the scripts must have the same directives."""
+    directives = split_script(scripts[0])[0]
+    cases = "".join(
+        "{})\n{}\n;;\n".format(i, split_script(script)[1])
+        for i, script in enumerate(scripts))
+    return "{}\ncase \"{}\" in\n{}esac".format(
+        directives, index_variable, cases)
+
+
+async def submit_batch(
+    job_batch_request: JobBatchRequest,
+    sequential: bool = False,
+    convert: bool = False
+) -> List[JobBatchResult]:
+    """Submits the jobs of every infrastructure over one connection, the
+    results are returned in the order of the requests. A job that could
+    not be submitted gets an error, it does not prevent the others. With
+    sequential, the jobs of an infrastructure run one at a time. With
+    convert, the jobs convert their inputs even when the binary data are
+    up to date."""
+    groups: Dict[str, List[int]] = {}
+    for i, job_request in enumerate(job_batch_request.jobs):
+        groups.setdefault(job_request.infrastructure, []).append(i)
+
+    results = await asyncio.gather(*[
+        submit_group(
+            infrastructure_name,
+            [job_batch_request.jobs[i] for i in indexes],
+            bool(job_batch_request.array),
+            sequential,
+            convert)
+        for infrastructure_name, indexes in groups.items()],
+        return_exceptions=True)
+
+    job_results: List[JobBatchResult] = [None] * len(job_batch_request.jobs)
+    for (infrastructure_name, indexes), group_results in zip(
+            groups.items(), results):
+        if isinstance(group_results, Exception):
+            logger.error("Submitting the jobs of {} failed".format(
+                infrastructure_name), exc_info=group_results)
+            group_results = [
+                JobBatchResult(error=str(group_results))] * len(indexes)
+        for i, job_result in zip(indexes, group_results):
+            job_results[i] = job_result
+    return job_results
+
+
+async def submit_group(
+    infrastructure_name: str,
+    job_requests: List[JobRequest],
+    array: bool = False,
+    sequential: bool = False,
+    convert: bool = False
+) -> List[JobBatchResult]:
+    """Submits jobs of one infrastructure over one connection. Sequential
+    jobs run one at a time, in the order of the requests."""
+    infrastructure, pkey = await connect_infrastructure(infrastructure_name)
     host = infrastructure["host"]
     username = infrastructure["username"]
-    scheduler = infrastructure["scheduler"]
-    helper = SchedulerHelperFactory.helper(scheduler)
-    command = helper.get_job_status_code_command(job_status.scheduler_id)
+    helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
 
-    stdout, stderr = await ssh.exec_command(host, username, pkey, command)
-    new_status = helper.get_job_status_code(stdout)
+    await tuning.apply_tuned_params(
+        host, username, pkey, infrastructure["name"], job_requests)
+    jobs_binary_data = await binary_data.check(
+        host, username, pkey, job_requests, convert)
+    # a job whose script cannot be rendered fails alone
+    scripts: List[Optional[str]] = []
+    errors: List[str] = []
+    for job_request, job_binary_data in zip(job_requests, jobs_binary_data):
+        try:
+            scripts.append(template.render(job_request, job_binary_data))
+            errors.append("")
+        except Exception as ex:
+            logger.exception("Rendering a job script failed")
+            scripts.append(None)
+            errors.append(str(ex))
+    rendered = [i for i, script in enumerate(scripts) if script is not None]
+    rendered_scripts = [scripts[i] for i in rendered]
+
+    array = array and len(rendered_scripts) > 1
+    if array and len({split_script(script)[0]
+                      for script in rendered_scripts}) > 1:
+        logger.info("Jobs differ in their directives, submitting {} jobs "
+                    "instead of an array job".format(len(rendered_scripts)))
+        array = False
+
+    max_running = 1 if sequential else None
+    if not rendered_scripts:
+        submitted, submit_errors = [], []
+    elif array:
+        batch_cmd = helper.get_array_submit_command(
+            len(rendered_scripts), max_running)
+        array_script = get_array_script(
+            rendered_scripts, helper.get_array_index_variable())
+        command = f"{batch_cmd} <<\\EOF\n{array_script}\nEOF"
+        stdout, stderr = await ssh.exec_command(host, username, pkey, command)
+        submitted = helper.get_array_element_ids(
+            helper.parse_job_scheduler_id(stdout), len(rendered_scripts))
+        submit_errors = [stderr] * len(rendered_scripts)
+    elif sequential:
+        submitted, submit_errors = await submit_chain(
+            host, username, pkey, helper, rendered_scripts)
+    else:
+        # one command per job, so that every job gets its own error output
+        batch_cmd = helper.get_submit_command()
+        outputs = await asyncio.gather(*[
+            submit_script(host, username, pkey, helper, batch_cmd, script)
+            for script in rendered_scripts])
+        submitted = [scheduler_id for scheduler_id, _ in outputs]
+        submit_errors = [stderr for _, stderr in outputs]
+
+    scheduler_ids: List[Optional[str]] = [None] * len(scripts)
+    for i, scheduler_id, error in zip(rendered, submitted, submit_errors):
+        scheduler_ids[i] = scheduler_id
+        errors[i] = error
+
+    job_results = []
+    job_statuses = []
+    for job_request, scheduler_id, error in zip(
+            job_requests, scheduler_ids, errors):
+        if scheduler_id is None:
+            job_results.append(JobBatchResult(
+                error="The job was not submitted: {}".format(
+                    error.strip() or "no output")))
+            continue
+        job_status = JobStatus(
+            id=str(uuid4()),
+            scheduler_id=scheduler_id,
+            infrastructure=infrastructure["name"],
+            status=JobStatusCode.QUEUED
+        )
+        job_results.append(JobBatchResult(job=job_status))
+        job_statuses.append((job_request, job_status))
+
+    await asyncio.gather(*[save_status(j) for _, j in job_statuses])
+    # all elements are polled with the same scheduler command
+    for job_request, job_status in job_statuses:
+        period = float(job_request.watch_period) \
+            if job_request.watch_period else DEFAULT_WATCH_PERIOD
+        watch_job_status(job_status, period)
+
+    if len(job_statuses) < len(scripts):
+        logger.error("{} of {} jobs were not submitted to {}".format(
+            len(scripts) - len(job_statuses), len(scripts),
+            infrastructure["name"]))
+    return job_results
+
+
+async def submit_chain(
+    host: str,
+    username: str,
+    pkey: Any,
+    helper: Any,
+    scripts: List[str]
+) -> Tuple[List[Optional[str]], List[str]]:
+    """Submits the scripts one by one, every job depending on the end of
+    the previously submitted one. Returns the scheduler IDs, None for the
+    scripts not submitted, and the error output of every submission."""
+    scheduler_ids: List[Optional[str]] = []
+    errors: List[str] = []
+    previous = None
+    for script in scripts:
+        batch_cmd = helper.get_submit_command() if previous is None \
+            else helper.get_dependent_submit_command(previous)
+        scheduler_id, stderr = await submit_script(
+            host, username, pkey, helper, batch_cmd, script)
+        scheduler_ids.append(scheduler_id)
+        errors.append(stderr)
+        previous = scheduler_id or previous
+    return scheduler_ids, errors
+
+
+async def submit_script(
+    host: str,
+    username: str,
+    pkey: Any,
+    helper: Any,
+    batch_cmd: str,
+    script: str
+) -> Tuple[Optional[str], str]:
+    """Submits one script with batch_cmd. Returns its scheduler ID, None
+    when it was not submitted, and the error output of the submission."""
+    command = f"{batch_cmd} <<\\EOF\n{script}\nEOF"
+    try:
+        stdout, stderr = await ssh.exec_command(host, username, pkey, command)
+    except Exception as ex:
+        logger.exception("Submitting a job failed")
+        return None, str(ex)
+    scheduler_id = helper.parse_job_scheduler_id(stdout) \
+        if stdout.strip() else None
+    return scheduler_id, stderr
+
+
+class TrackedJob:
+    def __init__(self, job_status: JobStatus, period: float):
+        self.job_status = job_status
+        self.period = period
+        self.interval = period
+        self.due = 0.0
+        self.unchanged_polls = 0
+        self.missing_polls = 0
+        self.time_left = None
+
+
+class JobStatusPoller:
+    """Watches all tracked jobs of one infrastructure. Every job is due at
+    the time given by the polling policy, all jobs due at a tick are
+    queried with a single scheduler command and only the changed records
+    are persisted."""
+
+    def __init__(self, infrastructure_name: str, policy: PollingPolicy = None):
+        self.loop = asyncio.get_event_loop()
+        self.infrastructure_name = infrastructure_name
+        self.policy = policy or PollingPolicy()
+        self.jobs: Dict[str, TrackedJob] = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def track(self, job_status: JobStatus, period: float) -> None:
+        tracked = TrackedJob(job_status, period)
+        self.jobs[job_status.scheduler_id] = tracked
+        self.schedule(tracked)
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(
+                self.run(), name=f"poller-{self.infrastructure_name}")
+
+    def untrack(self, scheduler_id: str) -> None:
+        self.jobs.pop(scheduler_id, None)
+
+    def due_jobs(self) -> List[str]:
+        now = self.loop.time()
+        return [
+            sid for sid, t in self.jobs.items()
+            if t.due - now <= t.interval * COALESCE_FRACTION]
+
+    async def run(self) -> None:
+        while self.jobs:
+            self.wakeup.clear()
+            timeout = min(t.due for t in self.jobs.values()) - self.loop.time()
+            if timeout > 0:
+                try:
+                    # a newly tracked job may be due before the others
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.poll(self.due_jobs())
+            except Exception:
+                logger.exception("Polling of job statuses failed: {}".format(
+                    self.infrastructure_name))
+                self.reschedule(self.due_jobs())
+
+    def schedule(self, tracked: TrackedJob) -> None:
+        tracked.interval = self.policy.next_delay(
+            tracked.job_status.status,
+            tracked.period,
+            tracked.unchanged_polls,
+            tracked.time_left)
+        tracked.due = self.loop.time() + tracked.interval
+
+    def reschedule(self, scheduler_ids: List[str]) -> None:
+        for scheduler_id in scheduler_ids:
+            tracked = self.jobs.get(scheduler_id)
+            if tracked is not None:
+                self.schedule(tracked)
+
+    async def poll(self, scheduler_ids: List[str] = None) -> None:
+        if scheduler_ids is None:
+            scheduler_ids = list(self.jobs)
+        if not scheduler_ids:
+            return
+        infrastructure, pkey = await connect_infrastructure(
+            self.infrastructure_name)
+        host = infrastructure["host"]
+        username = infrastructure["username"]
+        helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
+        command = helper.get_jobs_status_command(scheduler_ids)
+
+        stdout, stderr = await ssh.exec_command(host, username, pkey, command)
+        statuses = helper.get_jobs_status(stdout)
+        if not statuses and not is_unknown_job_error(stderr):
+            raise RuntimeError(stderr)
+
+        changed = []
+        for scheduler_id in scheduler_ids:
+            tracked = self.jobs.get(scheduler_id)
+            if tracked is None:
+                continue
+            job_status = tracked.job_status
+            if scheduler_id in statuses:
+                tracked.missing_polls = 0
+                tracked.time_left = statuses[scheduler_id].time_left
+                try:
+                    new_status = helper.get_job_status_code(
+                        statuses[scheduler_id].state)
+                except NotImplementedError:
+                    logger.warning("Unsupported status of job {}: {}".format(
+                        scheduler_id, statuses[scheduler_id].state))
+                    new_status = job_status.status
+            else:
+                tracked.missing_polls += 1
+                if tracked.missing_polls < MISSING_TICKS_LIMIT:
+                    new_status = job_status.status
+                else:
+                    new_status = JobStatusCode.COMPLETED
+
+            if job_status.status != new_status:
+                job_status.status = new_status
+                tracked.unchanged_polls = 0
+                changed.append(job_status)
+            else:
+                tracked.unchanged_polls += 1
+            if new_status == JobStatusCode.COMPLETED:
+                self.untrack(scheduler_id)
+
+        self.reschedule(scheduler_ids)
+        await asyncio.gather(*[save_status(j) for j in changed])
+
+
+_pollers: Dict[str, JobStatusPoller] = {}
+
+
+def get_poller(infrastructure_name: str) -> JobStatusPoller:
+    poller = _pollers.get(infrastructure_name)
+    if poller is None or poller.loop is not asyncio.get_event_loop():
+        poller = JobStatusPoller(infrastructure_name)
+        _pollers[infrastructure_name] = poller
+    return poller
+
+
+def watch_job_status(job_status: JobStatus, period: float) -> None:
+    get_poller(job_status.infrastructure).track(job_status, period)
 
-    if prev_status != new_status:
-        job_status.status = new_status
-        await save_status(job_status)
 
-    if new_status != JobStatusCode.COMPLETED:
-        await asyncio.sleep(period)
-        asyncio.create_task(
-            watch_job_status(job_status, period), name=job_status.id)
+async def recover() -> int:
+    """Tracks the jobs left queued or running by a previous process
+    again, every infrastructure polls them with a single query."""
+    recovered = 0
+    for status in (JobStatusCode.QUEUED, JobStatusCode.RUNNING):
+        for data in await persistence.find(
+                persistence.get_jobs_collection(), status=status):
+            job_status = JobStatus.from_dict(persistence.load_record(data))
+            watch_job_status(job_status, DEFAULT_WATCH_PERIOD)
+            recovered += 1
+    if recovered:
+        logger.info("Watching {} recovered jobs".format(recovered))
+    return recovered
 
 
 async def save_status(job_status: JobStatus) -> None:
@@ -0,0 +1,149 @@
+import os
+import shlex
+import asyncio
+from pathlib import Path
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+import asyncssh
+
+import hpc.api.utils.ssh as ssh
+from hpc.api.openapi.models.transfer_strategy import TransferStrategy
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Seconds between the checks of a download running on the infrastructure
+PULL_POLL_PERIOD = float(os.getenv("HPC_GATEWAY_PULL_POLL_PERIOD", 2.0))
+# Presigned S3 URLs given to the infrastructures stay valid this long
+PRESIGNED_URL_EXPIRY = int(os.getenv("HPC_GATEWAY_PRESIGNED_URL_EXPIRY", 3600))
+# Seconds a download running on the infrastructure may take before it is
+# stopped and the transfer failed, 0 for no limit
+PULL_TIMEOUT = float(os.getenv("HPC_GATEWAY_PULL_TIMEOUT", 86400))
+# Checks in a row failing before the download is given up
+MAX_POLL_FAILURES = 3
+PULL_SCHEMES = ("http", "https", "ftp")
+# The download is written next to dst and renamed once complete
+PART_SUFFIX = ".hpc-gateway-pull"
+# $1 part, $2 dst, $3 file holding the url. The url only goes through the
+# file and a pipe, it never shows in the process list of the shared login
+# node
+PULL_SCRIPT = (
+    'if command -v curl >/dev/null 2>&1; '
+    'then printf \'url = "%s"\\n\' "$(sed \'s/[\\\\"]/\\\\&/g\' "$3")" | '
+    'curl -fsSL --retry 3 -o "$1" -K -; '
+    'else wget -q -O "$1" -i "$3"; fi && mv -f "$1" "$2"; '
+    'echo $? > "$1.status"; rm -f "$3"')
+POLL_ERRORS = (asyncssh.Error, OSError, asyncio.TimeoutError)
+
+
+class RemotePullError(Exception):
+    pass
+
+
+class RemotePullTimeout(RemotePullError):
+    pass
+
+
+def is_enabled(infrastructure: dict) -> bool:
+    return infrastructure.get("transfer_strategy") == \
+        TransferStrategy.REMOTE_PULL
+
+
+def is_pullable(url: str) -> bool:
+    return urlparse(url).scheme in PULL_SCHEMES
+
+
+def get_start_command(remote_dst: Path) -> str:
+    # the url is read from stdin into a file only the user can read, only
+    # the download runs in the background, it outlives the SSH channel and
+    # its exit status is written to a file. Prints the PID of the download
+    part = shlex.quote(str(remote_dst) + PART_SUFFIX)
+    return (
+        "mkdir -p {directory} && rm -f {part} {part}.status && "
+        "(umask 077 && cat > {part}.url) && "
+        "{{ nohup sh -c {script} sh {part} {dst} {part}.url "
+        "> {part}.log 2>&1 < /dev/null & echo $!; }}").format(
+            directory=shlex.quote(str(remote_dst.parent)),
+            part=part,
+            script=shlex.quote(PULL_SCRIPT),
+            dst=shlex.quote(str(remote_dst)))
+
+
+def get_poll_command(remote_dst: Path, pid: str) -> str:
+    # prints whether the download is running, checked first so that a
+    # download ending in between still has its exit status read, the exit
+    # status, empty while running, and the bytes written
+    part = shlex.quote(str(remote_dst) + PART_SUFFIX)
+    return (
+        'echo "$(kill -0 {pid} 2>/dev/null && echo running)|'
+        '$(cat {part}.status 2>/dev/null)|'
+        '$(stat -c %s {part} 2>/dev/null)"').format(pid=pid, part=part)
+
+
+def get_stop_command(pid: str) -> str:
+    return "pkill -P {pid}; kill {pid}".format(pid=pid)
+
+
+def get_cleanup_command(remote_dst: Path) -> str:
+    # prints the output of a failed download
+    part = shlex.quote(str(remote_dst) + PART_SUFFIX)
+    return "tail -c 1000 {part}.log; rm -f {part} {part}.status {part}.log {part}.url".format(
+        part=part)
+
+
+async def pull(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    url: str,
+    remote_dst: Path,
+    on_progress: Callable[[int], Awaitable[None]] = None
+) -> None:
+    """Downloads the url into remote_dst on the infrastructure itself
+    and waits until the download is complete. on_progress is awaited
+    with the bytes written so far."""
+    stdout, stderr = await ssh.exec_command(
+        host, username, pkey, get_start_command(remote_dst), input=url + "\n")
+    pid = stdout.strip()
+    if not pid.isdigit():
+        raise RemotePullError("Starting the download on the infrastructure failed: {}".format(
+            stderr))
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + PULL_TIMEOUT
+    failures = 0
+    while True:
+        if PULL_TIMEOUT and loop.time() > deadline:
+            output, _ = await ssh.exec_command(
+                host, username, pkey, "{}; {}".format(
+                    get_stop_command(pid), get_cleanup_command(remote_dst)))
+            raise RemotePullTimeout(
+                "Download on the infrastructure took more than {}s: {}".format(
+                    PULL_TIMEOUT, output))
+        await asyncio.sleep(PULL_POLL_PERIOD)
+        try:
+            stdout, stderr = await ssh.exec_command(
+                host, username, pkey, get_poll_command(remote_dst, pid))
+        except POLL_ERRORS:
+            failures += 1
+            if failures >= MAX_POLL_FAILURES:
+                raise
+            logger.warning("Checking the download of {} failed".format(
+                remote_dst), exc_info=True)
+            continue
+        failures = 0
+        running, exit_status, size = (stdout.split("|") + ["", ""])[:3]
+        if size and on_progress is not None:
+            await on_progress(int(size))
+        if exit_status:
+            break
+        if not running:
+            # killed before it could write its exit status
+            exit_status = "killed"
+            break
+    output, _ = await ssh.exec_command(
+        host, username, pkey, get_cleanup_command(remote_dst))
+    if exit_status != "0":
+        raise RemotePullError("Download on the infrastructure failed ({}): {}".format(
+            exit_status, output))
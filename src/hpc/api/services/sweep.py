@@ -0,0 +1,231 @@
+import os
+import json
+import asyncio
+import itertools
+from typing import List, Optional
+from uuid import uuid4
+
+import hpc.api.utils.ssh as ssh
+import hpc.api.utils.events as events
+import hpc.api.utils.persistence as persistence
+import hpc.api.services.job as job
+import hpc.api.services.tuning as tuning
+from hpc.api.utils.scheduler_helper import SchedulerHelperFactory
+from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_request_params import JobRequestParams
+from hpc.api.openapi.models.job_batch_request import JobBatchRequest
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+from hpc.api.openapi.models.sweep_request import SweepRequest
+from hpc.api.openapi.models.sweep_space import SweepSpace
+from hpc.api.openapi.models.sweep_status import SweepStatus
+from hpc.api.openapi.models.sweep_candidate import SweepCandidate
+from hpc.api.openapi.models.sweep_objective import SweepObjective
+from hpc.api.openapi.models.tuned_params import TunedParams
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+MAX_SWEEP_CANDIDATES = int(os.getenv("HPC_GATEWAY_MAX_SWEEP_CANDIDATES", 256))
+# Written by exe.sh.j2 into the profiling workspace
+KERNEL_TIME_FILE = "kernel_time_ms"
+
+
+def get_candidates(space: SweepSpace) -> List[TunedParams]:
+    values = {k: v for k, v in space.to_dict().items() if v}
+    if not values:
+        raise ValueError("The sweep space is empty")
+    return [
+        TunedParams.from_dict(dict(zip(values, combination)))
+        for combination in itertools.product(*values.values())]
+
+
+def get_job_request(
+    sweep_request: SweepRequest,
+    sweep_id: str,
+    index: int,
+    candidate: TunedParams
+) -> JobRequest:
+    params = JobRequestParams.from_dict(sweep_request.params.to_dict())
+    for name, value in candidate.to_dict().items():
+        if value is not None:
+            setattr(params, name, value)
+    if sweep_request.objective == SweepObjective.KERNEL_TIME:
+        # every candidate keeps its file until the runtimes are collected
+        params.profiling_workspace = "{}/sweep-{}/{}".format(
+            params.profiling_workspace, sweep_id, index)
+    return JobRequest(
+        services=list(sweep_request.services),
+        infrastructure=sweep_request.infrastructure,
+        params=params,
+        watch_period=sweep_request.watch_period
+    )
+
+
+async def submit(sweep_request: SweepRequest) -> SweepStatus:
+    """Launches a job per candidate of the sweep space. The jobs share the
+    workspace of the sweep params, so they run one at a time, and all of
+    them convert the input so that their runtimes compare. Once all of
+    them completed, the fastest candidate is stored as the tuned parameters of
+    the services on the infrastructure for inputs of this size."""
+    if sweep_request.objective is None:
+        sweep_request.objective = SweepObjective.WALL_TIME
+    candidates = get_candidates(sweep_request.space)
+    if len(candidates) > MAX_SWEEP_CANDIDATES:
+        raise ValueError("The sweep has {} candidates, at most {} are allowed".format(
+            len(candidates), MAX_SWEEP_CANDIDATES))
+
+    sweep_id = str(uuid4())
+    job_requests = [
+        get_job_request(sweep_request, sweep_id, i, candidate)
+        for i, candidate in enumerate(candidates)]
+
+    infrastructure, pkey = await job.connect_infrastructure(
+        sweep_request.infrastructure)
+    input_size, = await tuning.get_input_sizes(
+        infrastructure["host"], infrastructure["username"], pkey,
+        [tuning.get_input_path(sweep_request.params)])
+    job_results = await job.submit_batch(JobBatchRequest(
+        jobs=job_requests, array=sweep_request.array),
+        sequential=True, convert=True)
+    submitted = [i for i, r in enumerate(job_results) if r.job is not None]
+    if not submitted:
+        raise RuntimeError("No candidate of the sweep was submitted: {}".format(
+            job_results[0].error))
+    if len(submitted) < len(job_results):
+        logger.warning("{} of {} candidates of sweep {} were not submitted".format(
+            len(job_results) - len(submitted), len(job_results), sweep_id))
+    job_requests = [job_requests[i] for i in submitted]
+
+    sweep_status = SweepStatus(
+        id=sweep_id,
+        infrastructure=infrastructure["name"],
+        services=list(sweep_request.services),
+        input_size=input_size,
+        objective=sweep_request.objective,
+        status=JobStatusCode.QUEUED,
+        candidates=[
+            SweepCandidate(job_id=job_results[i].job.id, params=candidates[i])
+            for i in submitted]
+    )
+    await save_status(sweep_status)
+    asyncio.create_task(watch_sweep(sweep_status, job_requests))
+    return sweep_status
+
+
+async def watch_sweep(
+    sweep_status: SweepStatus,
+    job_requests: Optional[List[JobRequest]]
+) -> None:
+    try:
+        await wait_for_jobs(sweep_status)
+        await collect_runtimes(sweep_status, job_requests)
+        finished = [c for c in sweep_status.candidates if c.runtime is not None]
+        if finished:
+            best = min(finished, key=lambda c: c.runtime)
+            sweep_status.best = best.params
+            await tuning.save_tuned_params(
+                sweep_status.infrastructure, sweep_status.services,
+                sweep_status.input_size, best.params, best.runtime,
+                sweep_status.id)
+        else:
+            logger.warning("No candidate of sweep {} succeeded".format(
+                sweep_status.id))
+            sweep_status.reason = "No candidate succeeded"
+    except Exception as ex:
+        logger.exception("Sweep failed: {}".format(sweep_status.id))
+        sweep_status.reason = str(ex)
+    sweep_status.status = JobStatusCode.COMPLETED
+    await save_status(sweep_status)
+
+
+async def wait_for_jobs(sweep_status: SweepStatus) -> None:
+    job_ids = [c.job_id for c in sweep_status.candidates]
+    bus = events.get_bus()
+    # a job changes its status at most twice, no change is dropped
+    subscription = bus.subscribe(events.Subscription(
+        ids=job_ids, kinds=[events.JOB], max_size=3 * len(job_ids)))
+    try:
+        statuses = {
+            job_id: (await job.get(job_id)).status for job_id in job_ids}
+        while True:
+            if sweep_status.status == JobStatusCode.QUEUED and any(
+                    s != JobStatusCode.QUEUED for s in statuses.values()):
+                sweep_status.status = JobStatusCode.RUNNING
+                await save_status(sweep_status)
+            if all(s == JobStatusCode.COMPLETED for s in statuses.values()):
+                return
+            event = await subscription.get()
+            statuses[event.id] = event.data.get("status")
+    finally:
+        bus.unsubscribe(subscription)
+
+
+async def collect_runtimes(
+    sweep_status: SweepStatus,
+    job_requests: Optional[List[JobRequest]]
+) -> None:
+    """Sets the runtime of the candidates, the job requests are only
+    needed for the kernel time objective."""
+    infrastructure, pkey = await job.connect_infrastructure(
+        sweep_status.infrastructure)
+    host = infrastructure["host"]
+    username = infrastructure["username"]
+
+    if sweep_status.objective == SweepObjective.KERNEL_TIME:
+        command = "; ".join(
+            "cat {} 2>/dev/null || echo".format(tuning.quote_path("{}{}/{}".format(
+                r.params.root_dir, r.params.profiling_workspace,
+                KERNEL_TIME_FILE)))
+            for r in job_requests)
+        stdout, stderr = await ssh.exec_command(host, username, pkey, command)
+        lines = stdout.split("\n")
+        lines += [""] * (len(job_requests) - len(lines))
+        for candidate, line in zip(sweep_status.candidates, lines):
+            line = line.strip()
+            candidate.runtime = int(line) / 1000 if line.isdigit() else None
+    else:
+        helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
+        scheduler_ids = [
+            (await job.get(c.job_id)).scheduler_id
+            for c in sweep_status.candidates]
+        command = helper.get_jobs_runtime_command(scheduler_ids)
+        stdout, stderr = await ssh.exec_command(host, username, pkey, command)
+        runtimes = helper.get_jobs_runtime(stdout)
+        for candidate, scheduler_id in zip(
+                sweep_status.candidates, scheduler_ids):
+            candidate.runtime = runtimes.get(scheduler_id)
+
+
+async def recover() -> int:
+    """Watches the sweeps left unfinished by a previous process again.
+    The profiling workspaces of the candidates are not persisted, so
+    kernel time sweeps are completed without a best candidate."""
+    recovered = 0
+    for status in (JobStatusCode.QUEUED, JobStatusCode.RUNNING):
+        for data in await persistence.find(
+                persistence.get_sweeps_collection(), status=status):
+            sweep_status = SweepStatus.from_dict(persistence.load_record(data))
+            if sweep_status.objective == SweepObjective.KERNEL_TIME:
+                sweep_status.status = JobStatusCode.COMPLETED
+                sweep_status.reason = "Interrupted by a restart"
+                await save_status(sweep_status)
+                continue
+            asyncio.create_task(watch_sweep(sweep_status, None))
+            recovered += 1
+    if recovered:
+        logger.info("Watching {} recovered sweeps".format(recovered))
+    return recovered
+
+
+async def save_status(sweep_status: SweepStatus) -> None:
+    await persistence.save(
+        persistence.get_sweep_directory(sweep_status.id),
+        json.dumps(sweep_status.to_dict())
+    )
+
+
+async def get(sweep_id: str) -> SweepStatus:
+    return SweepStatus.from_dict(
+        json.loads(
+            await persistence.get(persistence.get_sweep_directory(sweep_id))))
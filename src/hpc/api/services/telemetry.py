@@ -1,4 +1,11 @@
+import os
+import copy
 import json
+import time
+import asyncio
+from collections import Counter
+from itertools import compress
+from typing import Dict, Tuple
 
 import hpc.api.utils.persistence as persistence
 import hpc.api.utils.ssh as ssh
@@ -9,42 +16,84 @@ from hpc.api.openapi.models.partition_telemetry import PartitionTelemetry
 from hpc.api.openapi.models.job_status_code import JobStatusCode
 from hpc.api.openapi.models.infrastructure_summary import InfrastructureSummary
 from hpc.api.utils.scheduler_helper import SchedulerHelperFactory
+from hpc.api.utils.resource_parser import (
+    JOB_STATE_CODES, NODE_STATE_CODES, JobColumns, NodeColumns
+)
+from hpc.api.log import get_logger
 
 
-def derive_slurm_telemetry(infrastructure, nodes, jobs):
-
-    partitions = []
-    partitions_dict = {}
-
-    for node in nodes:
-        if not (node.partition in partitions_dict):
-            partitions_dict[node.partition] = {
-                "name": node.partition,
-                "total_nodes": 0,
-                "avail_nodes": 0,
-                "total_cpus": 0,
-                "avail_cpus": 0,
-                "running_jobs": 0,
-                "queued_jobs": 0,
-            }
-        partitions_dict[node.partition]["total_nodes"] = partitions_dict[node.partition]["total_nodes"] + 1
-        if node.state == NodeStateCode.IDLE:
-            partitions_dict[node.partition]["avail_nodes"] = partitions_dict[node.partition]["avail_nodes"] + 1
-        partitions_dict[node.partition]["total_cpus"] = partitions_dict[node.partition]["total_cpus"] + node.cpus
-        partitions_dict[node.partition]["avail_cpus"] = partitions_dict[node.partition]["total_cpus"]
-        partitions_dict[node.partition]["running_jobs"] = 0
-        partitions_dict[node.partition]["queued_jobs"] = 0
-
-    for job in jobs:
-        if job.state == JobStatusCode.RUNNING:
-            partitions_dict[job.partition]["avail_cpus"] = partitions_dict[job.partition]["avail_cpus"] - job.cpus
-            partitions_dict[node.partition]["running_jobs"] = partitions_dict[node.partition]["running_jobs"] + 1
-        elif job.state == JobStatusCode.QUEUED:
-            partitions_dict[node.partition]["queued_jobs"] = partitions_dict[node.partition]["queued_jobs"] + 1
-
-    for partition in partitions_dict:
-        partitions.append(PartitionTelemetry.from_dict(
-            partitions_dict[partition]))
+logger = get_logger(__name__)
+
+# Seconds a telemetry snapshot is served before it is collected again
+TELEMETRY_TTL = float(os.getenv("HPC_GATEWAY_TELEMETRY_TTL", 10.0))
+# Seconds between background refreshes of the requested infrastructures,
+# 0 disables the refresher
+TELEMETRY_REFRESH_PERIOD = float(
+    os.getenv("HPC_GATEWAY_TELEMETRY_REFRESH_PERIOD", 0))
+# The refresher drops the infrastructures not requested within this many
+# ttls (or refresh periods, when longer)
+TELEMETRY_IDLE_TTLS = 3
+
+
+def group_count(keys, groups, selected=None):
+    """Counts the rows per group, optionally only the selected ones."""
+    counts = [0] * groups
+    if selected is None:
+        for key, count in Counter(keys).items():
+            counts[key] = count
+    else:
+        for key, count in Counter(compress(keys, selected)).items():
+            counts[key] = count
+    return counts
+
+
+def group_sum(keys, values, groups, selected=None):
+    sums = [0] * groups
+    if selected is not None:
+        keys, values = compress(keys, selected), compress(values, selected)
+    for key, value in zip(keys, values):
+        sums[key] += value
+    return sums
+
+
+def derive_telemetry(infrastructure, nodes, jobs):
+    """Aggregates nodes and jobs per partition (Slurm) or queue (PBS)."""
+    if not isinstance(nodes, NodeColumns):
+        nodes = NodeColumns.from_nodes(nodes)
+    if not isinstance(jobs, JobColumns):
+        jobs = JobColumns.from_jobs(jobs)
+
+    groups = len(nodes.partitions)
+    idle = NODE_STATE_CODES[NodeStateCode.IDLE]
+    running = JOB_STATE_CODES[JobStatusCode.RUNNING]
+    queued = JOB_STATE_CODES[JobStatusCode.QUEUED]
+
+    # jobs of partitions without nodes are left out
+    index = {name: i for i, name in enumerate(nodes.partitions)}
+    job_group = [index.get(name, groups) for name in jobs.partitions]
+    job_partition = [job_group[p] for p in jobs.partition]
+    is_running = [s == running for s in jobs.state]
+    is_queued = [s == queued for s in jobs.state]
+
+    total_nodes = group_count(nodes.partition, groups)
+    avail_nodes = group_count(
+        nodes.partition, groups, [s == idle for s in nodes.state])
+    total_cpus = group_sum(nodes.partition, nodes.cpus, groups)
+    used_cpus = group_sum(job_partition, jobs.cpus, groups + 1, is_running)
+    running_jobs = group_count(job_partition, groups + 1, is_running)
+    queued_jobs = group_count(job_partition, groups + 1, is_queued)
+
+    partitions = [
+        PartitionTelemetry(
+            name=name,
+            total_nodes=total_nodes[i],
+            avail_nodes=avail_nodes[i],
+            total_cpus=total_cpus[i],
+            avail_cpus=total_cpus[i] - used_cpus[i],
+            running_jobs=running_jobs[i],
+            queued_jobs=queued_jobs[i])
+        for i, name in enumerate(nodes.partitions)
+    ]
 
     return InfrastructureTelemetry(
         name=infrastructure.name,
@@ -55,7 +104,7 @@ def derive_slurm_telemetry(infrastructure, nodes, jobs):
     )
 
 
-async def get(infrastructure_name: str):
+async def collect(infrastructure_name: str) -> InfrastructureTelemetry:
     infrastructure = json.loads(await persistence.get(
         persistence.get_cluster_directory(infrastructure_name)))
     key_path = infrastructure["ssh_key"]["path"]
@@ -63,17 +112,118 @@ async def get(infrastructure_name: str):
     pkey = await ssh.get_pkey(key_path, key_password)
     host = infrastructure["host"]
     username = infrastructure["username"]
-    scheduler = infrastructure["scheduler"]
-    helper = SchedulerHelperFactory.helper(scheduler)
-    command = helper.get_nodes_info_command()
+    helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
+    # nodes and jobs are queried in one remote invocation
+    command = helper.get_telemetry_command()
 
     stdout, stderr = await ssh.exec_command(host, username, pkey, command)
-    nodes = helper.get_nodes_info(stdout)
+    # the output of large clusters takes a while to parse, the other
+    # requests are served meanwhile
+    loop = asyncio.get_event_loop()
+    nodes, jobs = await loop.run_in_executor(None, helper.get_telemetry, stdout)
 
-    command = helper.get_jobs_info_command()
+    return derive_telemetry(InfrastructureSummary.from_dict(infrastructure), nodes, jobs)
+
+
+class TelemetryCache:
+    """Per infrastructure telemetry snapshots.
+
+    A snapshot younger than ttl is served as is. Requests arriving while
+    a snapshot is being collected share that collection instead of
+    starting their own. With a refresh period, the snapshots of the
+    infrastructures requested recently are collected in the background,
+    so requests do not wait for the scheduler.
+    """
+
+    def __init__(
+        self,
+        ttl: float = TELEMETRY_TTL,
+        refresh_period: float = TELEMETRY_REFRESH_PERIOD
+    ):
+        self.loop = asyncio.get_event_loop()
+        self.ttl = ttl
+        self.refresh_period = refresh_period
+        self.snapshots: Dict[str, Tuple[float, InfrastructureTelemetry]] = {}
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.last_read: Dict[str, float] = {}
+        self.refresher = None
+
+    async def get(self, infrastructure_name: str) -> InfrastructureTelemetry:
+        if self.refresh_period > 0 and self.refresher is None:
+            self.refresher = asyncio.ensure_future(self.refresh())
+        self.last_read[infrastructure_name] = time.monotonic()
+        snapshot = self.snapshots.get(infrastructure_name)
+        if snapshot is None or time.monotonic() - snapshot[0] > self.ttl:
+            snapshot = await self.collect(infrastructure_name)
+        collected, telemetry = snapshot
+        # responses share the snapshot, only the age is their own
+        telemetry = copy.copy(telemetry)
+        telemetry.age = round(time.monotonic() - collected, 3)
+        return telemetry
+
+    async def collect(
+        self,
+        infrastructure_name: str
+    ) -> Tuple[float, InfrastructureTelemetry]:
+        future = self.inflight.get(infrastructure_name)
+        if future is None:
+            future = asyncio.ensure_future(self._collect(infrastructure_name))
+            self.inflight[infrastructure_name] = future
+            future.add_done_callback(
+                lambda _: self.inflight.pop(infrastructure_name, None))
+        # a cancelled request must not cancel the shared collection
+        return await asyncio.shield(future)
+
+    async def _collect(
+        self,
+        infrastructure_name: str
+    ) -> Tuple[float, InfrastructureTelemetry]:
+        telemetry = await collect(infrastructure_name)
+        snapshot = time.monotonic(), telemetry
+        self.snapshots[infrastructure_name] = snapshot
+        return snapshot
+
+    async def refresh(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_period)
+            idle = TELEMETRY_IDLE_TTLS * max(self.ttl, self.refresh_period)
+            for infrastructure_name in list(self.last_read):
+                read = self.last_read[infrastructure_name]
+                if time.monotonic() - read > idle:
+                    self.last_read.pop(infrastructure_name, None)
+                    self.snapshots.pop(infrastructure_name, None)
+                    continue
+                try:
+                    await self.collect(infrastructure_name)
+                except Exception:
+                    logger.exception(
+                        "Refreshing the telemetry of {} failed".format(
+                            infrastructure_name))
+
+    def close(self) -> None:
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+
+
+_cache = None
+
+
+def get_cache() -> TelemetryCache:
+    # the in-flight collections are bound to the loop they run in
+    global _cache
+    loop = asyncio.get_event_loop()
+    if _cache is None or _cache.loop is not loop:
+        _cache = TelemetryCache()
+    return _cache
+
+
+def close() -> None:
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
 
-    stdout, stderr = await ssh.exec_command(host, username, pkey, command)
-    jobs = helper.get_jobs_info(stdout)
 
-    # TODO: so far, only Slurm is supported
-    return derive_slurm_telemetry(InfrastructureSummary.from_dict(infrastructure), nodes, jobs)
+async def get(infrastructure_name: str) -> InfrastructureTelemetry:
+    return await get_cache().get(infrastructure_name)
@@ -0,0 +1,112 @@
+import re
+import json
+from typing import Iterable, List, Optional
+
+import asyncssh
+
+import hpc.api.utils.ssh as ssh
+import hpc.api.utils.persistence as persistence
+from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_request_params import JobRequestParams
+from hpc.api.openapi.models.tuned_params import TunedParams
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def quote_path(path: str) -> str:
+    # double quotes keep variables such as the default ${HOME} expandable
+    return '"{}"'.format(re.sub(r'(["\\`])', r"\\\1", path))
+
+
+def get_input_path(params: JobRequestParams) -> str:
+    # the kernel reads its input relative to the workspace
+    return "{}{}{}".format(
+        params.root_dir, params.workspace, params.read_input_data)
+
+
+def get_tuning_key(
+    infrastructure_name: str,
+    services: Iterable[str],
+    input_size: int
+) -> str:
+    # inputs within the same power of two share their parameters
+    return "{}:{}:{}".format(
+        infrastructure_name, ",".join(sorted(services)),
+        input_size.bit_length())
+
+
+async def get_input_sizes(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    paths: List[str]
+) -> List[int]:
+    """Sizes of the remote files with a single command, 0 for the
+    missing ones."""
+    command = "; ".join(
+        "stat -c %s {} 2>/dev/null || echo 0".format(quote_path(path))
+        for path in paths)
+    stdout, stderr = await ssh.exec_command(host, username, pkey, command)
+    lines = stdout.split("\n")
+    lines += [""] * (len(paths) - len(lines))
+    return [int(line) if line.strip().isdigit() else 0
+            for line in lines[:len(paths)]]
+
+
+async def save_tuned_params(
+    infrastructure_name: str,
+    services: List[str],
+    input_size: int,
+    tuned_params: TunedParams,
+    runtime: float,
+    sweep_id: str
+) -> None:
+    key = get_tuning_key(infrastructure_name, services, input_size)
+    await persistence.save(
+        persistence.get_tuned_params_directory(key),
+        json.dumps({
+            "infrastructure": infrastructure_name,
+            "services": list(services),
+            "input_size": input_size,
+            "params": tuned_params.to_dict(),
+            "runtime": runtime,
+            "sweep_id": sweep_id,
+        })
+    )
+
+
+async def get_tuned_params(key: str) -> Optional[TunedParams]:
+    try:
+        data = json.loads(await persistence.get(
+            persistence.get_tuned_params_directory(key)))
+    except KeyError:
+        return None
+    return TunedParams.from_dict(data["params"])
+
+
+async def apply_tuned_params(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    infrastructure_name: str,
+    job_requests: List[JobRequest]
+) -> None:
+    """Overrides the parameters of the requests opting into tuned
+    parameters, the input sizes are read with a single command."""
+    job_requests = [
+        r for r in job_requests if r.use_tuned_params and r.params]
+    if not job_requests:
+        return
+    sizes = await get_input_sizes(
+        host, username, pkey, [get_input_path(r.params) for r in job_requests])
+    for job_request, size in zip(job_requests, sizes):
+        key = get_tuning_key(infrastructure_name, job_request.services, size)
+        tuned_params = await get_tuned_params(key)
+        if tuned_params is None:
+            logger.info("No tuned parameters for {}".format(key))
+            continue
+        for name, value in tuned_params.to_dict().items():
+            if value is not None:
+                setattr(job_request.params, name, value)
@@ -0,0 +1,148 @@
+import json
+import asyncio
+from typing import Any, Callable, List
+from uuid import uuid4
+
+import hpc.api.utils.events as events
+import hpc.api.utils.persistence as persistence
+import hpc.api.services.job as job
+from hpc.api.services.data_manager import DataManagerFactory
+from hpc.api.openapi.models.workflow_request import WorkflowRequest
+from hpc.api.openapi.models.workflow_status import WorkflowStatus
+from hpc.api.openapi.models.workflow_status_code import WorkflowStatusCode
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+from hpc.api.openapi.models.file_transfer_status_code import FileTransferStatusCode
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class WorkflowError(Exception):
+    pass
+
+
+async def submit(workflow_request: WorkflowRequest) -> WorkflowStatus:
+    """Runs the input transfers, the job and the result transfers of the
+    workflow on the server, every stage starts as soon as the change of
+    the last record of the previous stage is persisted."""
+    workflow_status = WorkflowStatus(
+        id=str(uuid4()),
+        infrastructure=workflow_request.job.infrastructure,
+        status=WorkflowStatusCode.TRANSFERRING_INPUTS,
+        inputs=[],
+        s3_inputs=[],
+        s3_results=[],
+        reason="")
+    await save_status(workflow_status)
+    asyncio.create_task(
+        run(workflow_request, workflow_status),
+        name=workflow_status.id)
+    return workflow_status
+
+
+async def run(
+    workflow_request: WorkflowRequest,
+    workflow_status: WorkflowStatus
+) -> None:
+    try:
+        http_manager = DataManagerFactory.get_data_manager(
+            DataManagerFactory.HTTP)
+        s3_manager = DataManagerFactory.get_data_manager(
+            DataManagerFactory.S3)
+        await asyncio.gather(
+            run_transfers(
+                workflow_status, http_manager, workflow_request.inputs or [],
+                workflow_status.inputs, events.FILE_TRANSFER),
+            run_transfers(
+                workflow_status, s3_manager, workflow_request.s3_inputs or [],
+                workflow_status.s3_inputs, events.S3_TRANSFER))
+
+        workflow_status.status = WorkflowStatusCode.RUNNING
+        job_status = await job.submit(workflow_request.job)
+        workflow_status.job = job_status.id
+        await save_status(workflow_status)
+        await events.wait_until(
+            lambda: job.get(job_status.id), events.JOB, job_status.id,
+            lambda j: j.status == JobStatusCode.COMPLETED)
+
+        workflow_status.status = WorkflowStatusCode.TRANSFERRING_RESULTS
+        await save_status(workflow_status)
+        result_manager = DataManagerFactory.get_data_manager(
+            DataManagerFactory.S3_RESULT)
+        await run_transfers(
+            workflow_status, result_manager, workflow_request.s3_results or [],
+            workflow_status.s3_results, events.S3_TRANSFER)
+        workflow_status.status = WorkflowStatusCode.COMPLETED
+    except Exception as e:
+        logger.exception("Workflow failed: {}".format(workflow_status.id))
+        workflow_status.status = WorkflowStatusCode.FAILURE
+        workflow_status.reason = str(e) if isinstance(e, WorkflowError) \
+            else repr(e)
+    finally:
+        await save_status(workflow_status)
+
+
+async def run_transfers(
+    workflow_status: WorkflowStatus,
+    manager: Any,
+    ft_requests: List[Any],
+    transfer_ids: List[str],
+    kind: str
+) -> None:
+    """Starts the transfers at once and waits for all of them, the IDs
+    are recorded in the workflow status as soon as they are known."""
+    if not ft_requests:
+        return
+    ft_statuses = [await manager.transfer(r) for r in ft_requests]
+    transfer_ids.extend(ft_status.id for ft_status in ft_statuses)
+    await save_status(workflow_status)
+    ft_statuses = await asyncio.gather(*[
+        events.wait_until(
+            get_transfer(manager, ft_status.id), kind, ft_status.id,
+            lambda t: t.status in (FileTransferStatusCode.COMPLETED,
+                                   FileTransferStatusCode.FAILURE))
+        for ft_status in ft_statuses])
+    failed = [t for t in ft_statuses
+              if t.status != FileTransferStatusCode.COMPLETED]
+    if failed:
+        raise WorkflowError("Transfer {} failed: {}".format(
+            failed[0].id, failed[0].reason))
+
+
+def get_transfer(manager: Any, transfer_id: str) -> Callable:
+    return lambda: manager.get(transfer_id)
+
+
+async def recover() -> int:
+    """Fails the workflows interrupted by a restart, the requests of their
+    remaining stages are not persisted."""
+    failed = 0
+    for status in (WorkflowStatusCode.TRANSFERRING_INPUTS,
+                   WorkflowStatusCode.RUNNING,
+                   WorkflowStatusCode.TRANSFERRING_RESULTS):
+        for data in await persistence.find(
+                persistence.get_workflows_collection(), status=status):
+            workflow_status = WorkflowStatus.from_dict(
+                persistence.load_record(data))
+            workflow_status.status = WorkflowStatusCode.FAILURE
+            workflow_status.reason = "Interrupted by a restart"
+            await save_status(workflow_status)
+            failed += 1
+    if failed:
+        logger.info("Failed {} interrupted workflows".format(failed))
+    return failed
+
+
+async def save_status(workflow_status: WorkflowStatus) -> None:
+    await persistence.save(
+        persistence.get_workflow_directory(workflow_status.id),
+        json.dumps(workflow_status.to_dict())
+    )
+
+
+async def get(workflow_id: str) -> WorkflowStatus:
+    return WorkflowStatus.from_dict(
+        json.loads(
+            await persistence.get(
+                persistence.get_workflow_directory(workflow_id))))
@@ -0,0 +1,145 @@
+import os
+import asyncio
+import hashlib
+from pathlib import Path
+from shlex import quote
+
+import asyncssh
+
+import hpc.api.utils.ssh as ssh
+from hpc.api.utils.s3 import MD5_ETAG
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Relative paths are resolved against the home directory of the user
+DATASET_CACHE_DIR = os.getenv(
+    "HPC_GATEWAY_DATASET_CACHE_DIR", ".hpc-gateway/cache")
+# Size budget in bytes of the cache on every infrastructure, 0 disables it
+DATASET_CACHE_SIZE = int(os.getenv("HPC_GATEWAY_DATASET_CACHE_SIZE", 0))
+
+MB = 1048576  # 1 MB in bytes
+
+
+def s3_key(endpoint: str, bucket: str, obj: str, head: dict) -> str:
+    """Cache key of an S3 object. MD5 based ETags identify the content
+    itself, other ETags only a version of this very object."""
+    etag = (head.get("ETag") or "").strip('"')
+    size = head.get("ContentLength")
+    if MD5_ETAG.match(etag):
+        source = f"s3:{etag}:{size}"
+    else:
+        version = head.get("VersionId") or etag
+        source = f"s3:{endpoint}/{bucket}/{obj}:{version}:{size}"
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+async def file_key(path: Path) -> str:
+    """Cache key of a local file, the SHA-256 of its content."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _sha256_file, path)
+
+
+def _sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as src:
+        for chunk in iter(lambda: src.read(MB), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_copy_command(src: str, dst: str) -> str:
+    # cp of other than GNU coreutils knows no --reflink, src and dst are
+    # quoted already
+    return (f"{{ cp --reflink=auto -f {src} {dst} 2>/dev/null || "
+            f"cp -f {src} {dst}; }}")
+
+
+class DatasetCache:
+    """Content-addressed store of transferred files on an infrastructure.
+
+    Entries are files named by their key in directory. Entries and
+    destinations never share an inode, the gateway rewrites destinations
+    in place (sync, resumed uploads), so entries are copied, as reflinks
+    where the file system supports them. Entries are evicted least
+    recently used first once they exceed max_size bytes.
+    """
+
+    def __init__(
+        self,
+        directory: str = DATASET_CACHE_DIR,
+        max_size: int = DATASET_CACHE_SIZE
+    ):
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get_entry(self, key: str) -> str:
+        return f"{self.directory}/{key}"
+
+    def get_fetch_command(self, key: str, dst: Path) -> str:
+        parent = quote(str(dst.parent))
+        tmp = quote(f"{dst}.hpc-gateway-cache")
+        entry, dst = quote(self.get_entry(key)), quote(str(dst))
+        return (
+            f"if [ -f {entry} ]; then touch -c {entry} && "
+            f"mkdir -p {parent} && {get_copy_command(entry, tmp)} && "
+            f"mv -f {tmp} {dst} && echo hit; fi")
+
+    def get_store_command(self, key: str, src: Path) -> str:
+        directory = quote(self.directory)
+        entry, src = quote(self.get_entry(key)), quote(str(src))
+        tmp = quote(f"{self.get_entry(key)}.tmp")
+        return (
+            f"mkdir -p {directory} && {get_copy_command(src, tmp)} && "
+            f"mv -f {tmp} {entry} && "
+            f"{self.get_evict_command()}")
+
+    def get_evict_command(self) -> str:
+        # newest first, remove everything past the size budget
+        return (
+            f"find {quote(self.directory)} -maxdepth 1 -type f "
+            f"-printf '%T@ %s %p\\n' | sort -rn | "
+            f"awk -v max={self.max_size} '{{ total += $2; "
+            f"if (total > max) print $3 }}' | xargs -r rm -f")
+
+    async def fetch(
+        self,
+        host: str,
+        username: str,
+        pkey: asyncssh.SSHKey,
+        key: str,
+        dst: Path
+    ) -> bool:
+        """Places the cached content of key at dst, returns whether the
+        cache had it."""
+        stdout, _ = await ssh.exec_command(
+            host, username, pkey, self.get_fetch_command(key, dst))
+        return stdout == "hit"
+
+    async def store(
+        self,
+        host: str,
+        username: str,
+        pkey: asyncssh.SSHKey,
+        key: str,
+        src: Path
+    ) -> None:
+        """Adds the transferred file src under key. Failures are only
+        logged, the transfer itself has succeeded already."""
+        try:
+            _, stderr = await ssh.exec_command(
+                host, username, pkey, self.get_store_command(key, src))
+            if stderr:
+                logger.warning("Caching {} on {} failed: {}".format(
+                    src, host, stderr))
+        except Exception:
+            logger.exception("Caching {} on {} failed".format(src, host))
+
+
+def get_cache() -> DatasetCache:
+    return DatasetCache(DATASET_CACHE_DIR, DATASET_CACHE_SIZE)
@@ -0,0 +1,157 @@
+import os
+import json
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Events buffered per subscriber, the oldest are dropped beyond that
+EVENT_QUEUE_SIZE = int(os.getenv("HPC_GATEWAY_EVENT_QUEUE_SIZE", 1000))
+# Upper bound in seconds of long polling waits
+MAX_WAIT = float(os.getenv("HPC_GATEWAY_MAX_WAIT", 60.0))
+
+JOB = "job"
+FILE_TRANSFER = "file_transfer"
+S3_TRANSFER = "s3_transfer"
+WORKFLOW = "workflow"
+
+
+class Event:
+    def __init__(self, kind: str, directory: str, data: Dict[str, Any]):
+        self.kind = kind
+        self.directory = directory
+        self.data = data
+
+    @property
+    def id(self) -> Optional[str]:
+        return self.data.get("id")
+
+    @property
+    def infrastructure(self) -> Optional[str]:
+        return self.data.get("infrastructure")
+
+
+class Subscription:
+    """Queue of the events matching all given filters."""
+
+    def __init__(
+        self,
+        ids: Optional[Iterable[str]] = None,
+        infrastructure: Optional[str] = None,
+        kinds: Optional[Iterable[str]] = None,
+        max_size: int = EVENT_QUEUE_SIZE
+    ):
+        self.ids = set(ids) if ids else None
+        self.infrastructure = infrastructure
+        self.kinds = set(kinds) if kinds else None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+
+    def matches(self, event: Event) -> bool:
+        return (self.ids is None or event.id in self.ids) \
+            and (self.infrastructure is None
+                 or event.infrastructure == self.infrastructure) \
+            and (self.kinds is None or event.kind in self.kinds)
+
+    def put(self, event: Event) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            logger.warning("Event subscriber too slow, dropped an event")
+        self.queue.put_nowait(event)
+
+    async def get(self) -> Event:
+        return await self.queue.get()
+
+
+class EventBus:
+    """In-process fan-out of job and transfer record changes."""
+
+    def __init__(self):
+        self.subscriptions: Set[Subscription] = set()
+        # collection -> event kind, records of other collections are
+        # not published
+        self.kinds: Dict[str, str] = {}
+
+    def register(self, collection: str, kind: str) -> None:
+        self.kinds[collection] = kind
+
+    def subscribe(self, subscription: Subscription) -> Subscription:
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+
+    def publish(self, collection: str, directory: str, data: Any) -> None:
+        kind = self.kinds.get(collection)
+        if kind is None or not self.subscriptions:
+            return
+        if isinstance(data, (str, bytes)):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                return
+        event = Event(kind, directory, data)
+        for subscription in list(self.subscriptions):
+            if subscription.matches(event):
+                subscription.put(event)
+
+
+_bus = EventBus()
+
+
+def get_bus() -> EventBus:
+    return _bus
+
+
+async def wait_for_change(
+    get: Callable[[], Awaitable[Any]],
+    kind: str,
+    id: str,
+    timeout: float,
+    if_status_not: Optional[str] = None
+) -> Any:
+    """Long polling. Returns the record from get() once its status
+    differs from if_status_not, or after its next change when no status
+    is given, at the latest after timeout (capped by MAX_WAIT)."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + min(timeout, MAX_WAIT)
+    # subscribe before reading, so no change can slip in between
+    subscription = _bus.subscribe(Subscription(ids=[id], kinds=[kind]))
+    try:
+        record = await get()
+        while if_status_not is None or record.status == if_status_not:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(subscription.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            record = await get()
+            if if_status_not is None:
+                break
+        return record
+    finally:
+        _bus.unsubscribe(subscription)
+
+
+async def wait_until(
+    get: Callable[[], Awaitable[Any]],
+    kind: str,
+    id: str,
+    done: Callable[[Any], bool]
+) -> Any:
+    """Returns the record from get() once done(record), without a
+    timeout."""
+    subscription = _bus.subscribe(Subscription(ids=[id], kinds=[kind]))
+    try:
+        record = await get()
+        while not done(record):
+            await subscription.get()
+            record = await get()
+        return record
+    finally:
+        _bus.unsubscribe(subscription)
@@ -1,27 +1,412 @@
-from typing import Any
+import os
+import json
+import time
+import asyncio
+import sqlite3
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-_storage = {}
+import hpc.api.utils.events as events
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# "memory" (default) or "sqlite"
+STORAGE_BACKEND = os.getenv("HPC_GATEWAY_STORAGE_BACKEND", "memory")
+STORAGE_PATH = os.getenv("HPC_GATEWAY_STORAGE_PATH", "hpc-gateway.db")
+# Writes arriving within this window are committed in one transaction
+BATCH_WINDOW = float(os.getenv("HPC_GATEWAY_STORAGE_BATCH_WINDOW", 0.01))
+
+
+def get_clusters_collection() -> str:
+    return "/serrano/orchestrator/clusters/cluster/hpc"
+
+
+def get_jobs_collection() -> str:
+    return "/serrano/orchestrator/jobs/job/hpc"
+
+
+def get_file_transfers_collection() -> str:
+    return "/serrano/orchestrator/file_transfers/file_transfer/hpc"
+
+
+def get_s3_transfers_collection() -> str:
+    return "/serrano/orchestrator/s3_transfers/s3_transfer/hpc"
+
+
+def get_workflows_collection() -> str:
+    return "/serrano/orchestrator/workflows/workflow/hpc"
+
+
+def get_sweeps_collection() -> str:
+    return "/serrano/orchestrator/sweeps/sweep/hpc"
+
+
+def get_tuned_params_collection() -> str:
+    return "/serrano/orchestrator/tuned_params/tuned_param/hpc"
 
 
 def get_cluster_directory(name: str) -> str:
-    return f"/serrano/orchestrator/clusters/cluster/hpc/{name}"
+    return f"{get_clusters_collection()}/{name}"
 
 
 def get_job_directory(id: str) -> str:
-    return f"/serrano/orchestrator/jobs/job/hpc/{id}"
+    return f"{get_jobs_collection()}/{id}"
 
 
 def get_file_transfer_directory(id: str) -> str:
-    return f"/serrano/orchestrator/file_transfers/file_transfer/hpc/{id}"
+    return f"{get_file_transfers_collection()}/{id}"
 
 
 def get_s3_transfer_directory(id: str) -> str:
-    return f"/serrano/orchestrator/s3_transfers/s3_transfer/hpc/{id}"
+    return f"{get_s3_transfers_collection()}/{id}"
+
+
+def get_workflow_directory(id: str) -> str:
+    return f"{get_workflows_collection()}/{id}"
+
+
+def get_sweep_directory(id: str) -> str:
+    return f"{get_sweeps_collection()}/{id}"
+
+
+def get_tuned_params_directory(key: str) -> str:
+    return f"{get_tuned_params_collection()}/{key}"
+
+
+def get_collection(directory: str) -> str:
+    return directory.rsplit("/", 1)[0]
+
+
+def load_record(data: Any) -> Any:
+    """Records are usually stored as JSON documents."""
+    if isinstance(data, (str, bytes)):
+        return json.loads(data)
+    return data
+
+
+def get_index_fields(data: Any) -> Tuple[Optional[str], Optional[str]]:
+    """Extracts the indexed (status, infrastructure) fields of a record.
+    Records are usually stored as JSON documents."""
+    if isinstance(data, (str, bytes)):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return None, None
+    if not isinstance(data, dict):
+        return None, None
+    return data.get("status"), data.get("infrastructure")
+
+
+class StorageBackend:
+    async def save(self, directory: str, data: Any) -> None:
+        raise NotImplementedError
+
+    async def save_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        raise NotImplementedError
+
+    async def get(self, directory: str) -> Any:
+        raise NotImplementedError
+
+    async def find(
+        self,
+        collection: str,
+        status: Optional[str] = None,
+        infrastructure: Optional[str] = None,
+        created_after: Optional[float] = None,
+        created_before: Optional[float] = None
+    ) -> List[Any]:
+        """Returns records of a collection matching all given filters,
+        ordered by creation time."""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(StorageBackend):
+    def __init__(self):
+        self._storage: Dict[str, Any] = {}
+        self._created: Dict[str, float] = {}
+        self._fields: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        # collection -> sorted [(created, directory)]
+        self._by_created: Dict[str, List[Tuple[float, str]]] = {}
+        # (collection, field, value) -> {directory}
+        self._by_field: Dict[Tuple[str, str, str], set] = {}
+
+    async def save(self, directory: str, data: Any) -> None:
+        collection = get_collection(directory)
+        if directory not in self._created:
+            created = time.time()
+            self._created[directory] = created
+            insort(self._by_created.setdefault(collection, []),
+                   (created, directory))
+        old_status, old_infrastructure = self._fields.get(
+            directory, (None, None))
+        status, infrastructure = get_index_fields(data)
+        self._reindex(collection, "status", directory, old_status, status)
+        self._reindex(collection, "infrastructure", directory,
+                      old_infrastructure, infrastructure)
+        self._fields[directory] = (status, infrastructure)
+        self._storage[directory] = data
+
+    async def save_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        for directory, data in items:
+            await self.save(directory, data)
+
+    async def get(self, directory: str) -> Any:
+        return self._storage[directory]
+
+    async def find(
+        self,
+        collection: str,
+        status: Optional[str] = None,
+        infrastructure: Optional[str] = None,
+        created_after: Optional[float] = None,
+        created_before: Optional[float] = None
+    ) -> List[Any]:
+        candidates = None
+        for field, value in (("status", status),
+                             ("infrastructure", infrastructure)):
+            if value is None:
+                continue
+            matches = self._by_field.get((collection, field, value), set())
+            candidates = matches if candidates is None \
+                else candidates & matches
+        if candidates is None:
+            # the time bounds are bisected in the creation order
+            by_created = self._by_created.get(collection, [])
+            start = 0 if created_after is None else bisect_right(
+                by_created, (created_after, chr(0x10ffff)))
+            end = len(by_created) if created_before is None else bisect_left(
+                by_created, (created_before, ""))
+            return [self._storage[d] for _, d in by_created[start:end]]
+        # only the indexed matches are visited
+        directories = sorted(candidates, key=self._created.__getitem__)
+        return [
+            self._storage[d] for d in directories
+            if (created_after is None or self._created[d] > created_after)
+            and (created_before is None or self._created[d] < created_before)]
+
+    def _reindex(self, collection, field, directory, old, new):
+        if old == new:
+            return
+        if old is not None:
+            self._by_field.get((collection, field, old), set()).discard(
+                directory)
+        if new is not None:
+            self._by_field.setdefault(
+                (collection, field, new), set()).add(directory)
+
+
+class SqliteBackend(StorageBackend):
+    """Durable store in an embedded SQLite database in WAL mode.
+
+    Concurrent saves are grouped: every write arriving within the batch
+    window is committed in a single transaction, the callers return once
+    their write is durable.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS records (
+            directory TEXT PRIMARY KEY,
+            collection TEXT NOT NULL,
+            status TEXT,
+            infrastructure TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS records_status
+            ON records (collection, status);
+        CREATE INDEX IF NOT EXISTS records_infrastructure
+            ON records (collection, infrastructure);
+        CREATE INDEX IF NOT EXISTS records_created
+            ON records (collection, created);
+    """
+
+    def __init__(self, path: str = STORAGE_PATH,
+                 batch_window: float = BATCH_WINDOW):
+        self.path = path
+        self.batch_window = batch_window
+        # sqlite connections must stay on the thread that created them
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = None
+        self._pending: Dict[str, Any] = {}
+        self._flushed = None
+        self._flush_handle = None
+
+    def _connect(self) -> None:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(self.SCHEMA)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def save(self, directory: str, data: Any) -> None:
+        await self.save_many([(directory, data)])
+
+    async def save_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        loop = asyncio.get_event_loop()
+        for directory, data in items:
+            self._pending[directory] = data
+        if self._flushed is None:
+            self._flushed = loop.create_future()
+            self._flush_handle = loop.call_later(
+                self.batch_window, self._schedule_flush)
+        await asyncio.shield(self._flushed)
+
+    def _schedule_flush(self) -> None:
+        asyncio.ensure_future(self._flush())
+
+    async def _flush(self) -> None:
+        if self._flushed is None:
+            # already flushed by close
+            return
+        pending, self._pending = self._pending, {}
+        flushed, self._flushed = self._flushed, None
+        self._flush_handle = None
+        try:
+            await self._run(self._write, pending)
+            flushed.set_result(None)
+        except Exception as e:
+            logger.exception("Writing to the storage failed")
+            flushed.set_exception(e)
+
+    def _write(self, pending: Dict[str, Any]) -> None:
+        self._connect()
+        now = time.time()
+        rows = []
+        for directory, data in pending.items():
+            status, infrastructure = get_index_fields(data)
+            rows.append((
+                directory, get_collection(directory), status, infrastructure,
+                now, now, json.dumps(data)))
+        with self._db:
+            self._db.executemany(
+                """
+                INSERT INTO records
+                    (directory, collection, status, infrastructure,
+                     created, updated, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (directory) DO UPDATE SET
+                    status = excluded.status,
+                    infrastructure = excluded.infrastructure,
+                    updated = excluded.updated,
+                    data = excluded.data
+                """,
+                rows)
+
+    async def get(self, directory: str) -> Any:
+        if directory in self._pending:
+            return self._pending[directory]
+        row = await self._run(self._read, directory)
+        if row is None:
+            raise KeyError(directory)
+        return json.loads(row[0])
+
+    def _read(self, directory: str):
+        self._connect()
+        return self._db.execute(
+            "SELECT data FROM records WHERE directory = ?",
+            (directory,)).fetchone()
+
+    async def find(
+        self,
+        collection: str,
+        status: Optional[str] = None,
+        infrastructure: Optional[str] = None,
+        created_after: Optional[float] = None,
+        created_before: Optional[float] = None
+    ) -> List[Any]:
+        if self._flushed is not None:
+            await asyncio.shield(self._flushed)
+        query = "SELECT data FROM records WHERE collection = ?"
+        args = [collection]
+        for clause, value in (("status = ?", status),
+                              ("infrastructure = ?", infrastructure),
+                              ("created > ?", created_after),
+                              ("created < ?", created_before)):
+            if value is not None:
+                query += f" AND {clause}"
+                args.append(value)
+        query += " ORDER BY created"
+        rows = await self._run(self._query, query, args)
+        return [json.loads(row[0]) for row in rows]
+
+    def _query(self, query: str, args: List[Any]):
+        self._connect()
+        return self._db.execute(query, args).fetchall()
+
+    async def close(self) -> None:
+        if self._flushed is not None:
+            self._flush_handle.cancel()
+            await self._flush()
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+
+
+def create_backend(name: str = STORAGE_BACKEND) -> StorageBackend:
+    if name == "memory":
+        return MemoryBackend()
+    elif name == "sqlite":
+        return SqliteBackend()
+    else:
+        raise NotImplementedError(f"Unknown storage backend: {name}")
+
+
+_backend = create_backend()
+
+# changes of these records are pushed to event subscribers
+events.get_bus().register(get_jobs_collection(), events.JOB)
+events.get_bus().register(get_file_transfers_collection(), events.FILE_TRANSFER)
+events.get_bus().register(get_s3_transfers_collection(), events.S3_TRANSFER)
+events.get_bus().register(get_workflows_collection(), events.WORKFLOW)
+
+
+def get_backend() -> StorageBackend:
+    return _backend
+
+
+def set_backend(backend: StorageBackend) -> None:
+    global _backend
+    _backend = backend
 
 
 async def save(directory: str, data: Any) -> None:
-    _storage[directory] = data
+    await _backend.save(directory, data)
+    events.get_bus().publish(get_collection(directory), directory, data)
+
+
+async def save_many(items: Iterable[Tuple[str, Any]]) -> None:
+    items = list(items)
+    await _backend.save_many(items)
+    for directory, data in items:
+        events.get_bus().publish(get_collection(directory), directory, data)
 
 
 async def get(directory: str) -> Any:
-    return _storage[directory]
+    return await _backend.get(directory)
+
+
+async def find(
+    collection: str,
+    status: Optional[str] = None,
+    infrastructure: Optional[str] = None,
+    created_after: Optional[float] = None,
+    created_before: Optional[float] = None
+) -> List[Any]:
+    return await _backend.find(
+        collection, status, infrastructure, created_after, created_before)
+
+
+async def close() -> None:
+    await _backend.close()
@@ -0,0 +1,58 @@
+import os
+import random
+from typing import Optional
+
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+
+
+MAX_WATCH_PERIOD = float(os.getenv("HPC_GATEWAY_WATCH_MAX_PERIOD", 300.0))
+WATCH_BACKOFF = float(os.getenv("HPC_GATEWAY_WATCH_BACKOFF", 2.0))
+WATCH_JITTER = float(os.getenv("HPC_GATEWAY_WATCH_JITTER", 0.1))
+# Below this remaining wall time (seconds) a running job is polled at
+# its base period, as it is about to finish or to be killed
+NEAR_TIME_LIMIT = 60.0
+
+
+class PollingPolicy:
+    """Decides when a watched job has to be polled next.
+
+    The base period is the freshness requested by the client. While the
+    state of a job does not change, the interval grows exponentially up
+    to max_period. For running jobs the interval never exceeds half of
+    the remaining wall time, so the polls get denser towards the time
+    limit. Jitter spreads the polls of jobs submitted at the same time.
+    """
+
+    def __init__(
+        self,
+        max_period: float = MAX_WATCH_PERIOD,
+        backoff: float = WATCH_BACKOFF,
+        jitter: float = WATCH_JITTER,
+        near_time_limit: float = NEAR_TIME_LIMIT
+    ):
+        self.max_period = max_period
+        self.backoff = backoff
+        self.jitter = jitter
+        self.near_time_limit = near_time_limit
+
+    def next_delay(
+        self,
+        status: JobStatusCode,
+        base_period: float,
+        unchanged_polls: int = 0,
+        time_left: Optional[float] = None
+    ) -> float:
+        max_period = max(self.max_period, base_period)
+        # cap the exponent, the result is bounded by max_period anyway
+        exponent = min(unchanged_polls, 32)
+        delay = min(base_period * self.backoff ** exponent, max_period)
+
+        if status == JobStatusCode.RUNNING and time_left is not None:
+            if time_left <= self.near_time_limit:
+                delay = base_period
+            else:
+                delay = min(delay, max(base_period, time_left / 2))
+
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return delay
@@ -1,5 +1,59 @@
-import hpc.api.utils.scheduler_helper as scheduler_helper
-from hpc.api.openapi.models.hpc_scheduler_type import HPCSchedulerType
+import re
+import json
+import time
+from array import array
+
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+from hpc.api.openapi.models.node_state_code import NodeStateCode
+
+SLURM_JOB_STATES = {
+    "COMPLETED": JobStatusCode.COMPLETED,
+    "FAILED": JobStatusCode.COMPLETED,
+    "CANCELLED": JobStatusCode.COMPLETED,
+    "TIMEOUT": JobStatusCode.COMPLETED,
+    "OUT_OF_MEMORY": JobStatusCode.COMPLETED,
+    "NODE_FAIL": JobStatusCode.COMPLETED,
+    "BOOT_FAIL": JobStatusCode.COMPLETED,
+    "DEADLINE": JobStatusCode.COMPLETED,
+    "PREEMPTED": JobStatusCode.COMPLETED,
+    "PENDING": JobStatusCode.QUEUED,
+    "REQUEUED": JobStatusCode.QUEUED,
+    "CONFIGURING": JobStatusCode.RUNNING,
+    "COMPLETING": JobStatusCode.RUNNING,
+    "RUNNING": JobStatusCode.RUNNING,
+    "SUSPENDED": JobStatusCode.RUNNING,
+}
+
+# Interned state codes of the columnar parsers, 0 stands for any other state
+NODE_STATE_CODES = {
+    NodeStateCode.IDLE: 1,
+    NodeStateCode.ALLOCATED: 2,
+    NodeStateCode.MIXED: 3,
+}
+JOB_STATE_CODES = {
+    JobStatusCode.QUEUED: 1,
+    JobStatusCode.RUNNING: 2,
+    JobStatusCode.COMPLETED: 3,
+}
+SLURM_JOB_STATE_CODES = {
+    name: JOB_STATE_CODES[state] for name, state in SLURM_JOB_STATES.items()
+}
+
+PBS_JOB_STATES = {
+    "C": JobStatusCode.COMPLETED,
+    "F": JobStatusCode.COMPLETED,
+    "Q": JobStatusCode.QUEUED,
+    "H": JobStatusCode.QUEUED,
+    "W": JobStatusCode.QUEUED,
+    "R": JobStatusCode.RUNNING,
+    "E": JobStatusCode.RUNNING,
+}
+PBS_JOB_STATE_CODES = {
+    name: JOB_STATE_CODES[state] for name, state in PBS_JOB_STATES.items()
+}
+# PBS nodes not bound to a queue are counted in this partition when no
+# queue is known at all
+PBS_DEFAULT_QUEUE = "default"
 
 class SlurmNode():
     def __init__(self,
@@ -33,10 +87,77 @@ class SlurmJob():
         self.min_memory = int(min_memory)
         self.nodelist = nodelist
         self.partition = partition
-        helper = scheduler_helper.SchedulerHelperFactory.helper(HPCSchedulerType.SLURM)
-        self.state = helper.get_job_status_code(state)
+        if state not in SLURM_JOB_STATES:
+            raise NotImplementedError("Slurm status is undefined or not supported: {}".format(state))
+        self.state = SLURM_JOB_STATES[state]
         self.schednodes = schednodes
 
+class NodeColumns():
+    """Nodes (sinfo, pbsnodes) stored per field rather than per node.
+    Partitions are interned into indices of partitions, states into
+    NODE_STATE_CODES."""
+    def __init__(self, partitions, partition, state, cpus):
+        self.partitions = partitions
+        self.partition = partition
+        self.state = state
+        self.cpus = cpus
+
+    def __len__(self):
+        return len(self.partition)
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        return get_nodes_columns_from_fields(
+            [n.partition for n in nodes], [n.state for n in nodes],
+            [n.cpus for n in nodes])
+
+class JobColumns():
+    """Jobs (squeue, qstat) stored per field, states are interned into
+    JOB_STATE_CODES."""
+    def __init__(self, partitions, partition, state, cpus):
+        self.partitions = partitions
+        self.partition = partition
+        self.state = state
+        self.cpus = cpus
+
+    def __len__(self):
+        return len(self.partition)
+
+    @classmethod
+    def from_jobs(cls, jobs):
+        partitions, partition = intern_column(j.partition for j in jobs)
+        state = array("B", (JOB_STATE_CODES.get(j.state, 0) for j in jobs))
+        return cls(partitions, partition, state,
+                   array("q", (j.cpus for j in jobs)))
+
+class JobStatusInfo():
+    def __init__(self, scheduler_id, state, time_left=None):
+        self.scheduler_id = scheduler_id
+        self.state = state
+        # remaining wall time in seconds, None if unknown or unlimited
+        self.time_left = time_left
+
+def parse_duration(value):
+    """Parses Slurm/PBS durations, i.e. [D-]HH:MM:SS, MM:SS or MM,
+    into seconds. Returns None for UNLIMITED, INVALID, etc."""
+    days = 0
+    if "-" in value:
+        days, _, value = value.partition("-")
+        if not days.isdigit():
+            return None
+        days = int(days)
+    parts = value.split(":")
+    if not all(p.isdigit() for p in parts) or len(parts) > 3:
+        return None
+    parts = [int(p) for p in parts]
+    if len(parts) == 1:
+        hours, minutes, seconds = 0, parts[0], 0
+    elif len(parts) == 2:
+        hours, minutes, seconds = 0, parts[0], parts[1]
+    else:
+        hours, minutes, seconds = parts
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
 def get_slurm_nodes_info(data):
     nodes = []
     if data:
@@ -49,4 +170,338 @@ def get_slurm_jobs_info(data):
     if data:
         for job_line in data.splitlines():
             jobs.append(SlurmJob(*job_line.split(",")))
-    return jobs
\ No newline at end of file
+    return jobs
+
+def intern_column(values):
+    """Returns the distinct values in order of appearance and the
+    column of their indices."""
+    if not isinstance(values, list):
+        values = list(values)
+    index = {v: i for i, v in enumerate(dict.fromkeys(values))}
+    return list(index), array("I", map(index.__getitem__, values))
+
+def code_column(values, codes):
+    """Column of the codes of values, 0 for the values not in codes."""
+    codes = {v: codes.get(v, 0) for v in set(values)}
+    return array("B", map(codes.__getitem__, values))
+
+def split_columns(data, indices):
+    """Returns the columns at indices of comma separated lines. The whole
+    output is split at once, lines are only split one by one when they
+    do not all have as many fields as the first one."""
+    data = data.strip("\n")
+    if not data:
+        return [[] for _ in indices]
+    first_line = data.find("\n")
+    width = data.count(",", 0, first_line if first_line >= 0 else len(data)) + 1
+    fields = data.replace("\n", ",").split(",")
+    if len(fields) != width * (data.count("\n") + 1):
+        rows = [line.split(",") for line in data.splitlines() if line]
+        return [[row[i] for row in rows] for i in indices]
+    return [fields[i::width] for i in indices]
+
+def get_nodes_columns_from_fields(partitions, states, cpus):
+    partitions, partition = intern_column(partitions)
+    return NodeColumns(partitions, partition,
+                       code_column(states, NODE_STATE_CODES),
+                       array("q", map(int, cpus)))
+
+def get_slurm_nodes_columns(data):
+    """Columnar counterpart of get_slurm_nodes_info."""
+    partitions, states, cpus = split_columns(data, (2, 3, 4))
+    return get_nodes_columns_from_fields(partitions, states, cpus)
+
+def get_slurm_jobs_columns(data):
+    """Columnar counterpart of get_slurm_jobs_info. Unknown states are
+    kept as 0 instead of failing the whole output."""
+    cpus, partitions, states = split_columns(data, (1, 10, 11))
+    partitions, partition = intern_column(partitions)
+    return JobColumns(partitions, partition,
+                      code_column(states, SLURM_JOB_STATE_CODES),
+                      array("q", map(int, cpus)))
+
+def expand_slurm_array_ids(job_id, tasks=None):
+    """Element IDs of an array job, whose pending elements Slurm reports
+    together, e.g. 123_[0-3,7%2] or the task string 0-3,7."""
+    match = re.match(r"(\d+)_\[(.*)\]$", job_id)
+    if match:
+        job_id, tasks = match.groups()
+    if not tasks:
+        return [job_id]
+    scheduler_ids = []
+    # the % suffix limits the running elements
+    for task in tasks.split("%")[0].split(","):
+        bounds, _, step = task.partition(":")
+        first, _, last = bounds.partition("-")
+        for i in range(int(first), int(last or first) + 1, int(step or 1)):
+            scheduler_ids.append("{}_{}".format(job_id, i))
+    return scheduler_ids
+
+def get_slurm_jobs_status(data):
+    statuses = {}
+    for line in data.splitlines():
+        fields = line.split("|")
+        if len(fields) < 2 or not fields[1]:
+            continue
+        time_left = None
+        if len(fields) >= 4:
+            elapsed = parse_duration(fields[2])
+            limit = parse_duration(fields[3])
+            if elapsed is not None and limit is not None:
+                time_left = max(limit - elapsed, 0)
+        for scheduler_id in expand_slurm_array_ids(fields[0]):
+            # e.g. "CANCELLED by 1000"
+            statuses[scheduler_id] = JobStatusInfo(
+                scheduler_id, fields[1].split()[0], time_left)
+    return statuses
+
+def get_pbs_jobs_status(data):
+    statuses = {}
+    walltimes = {}
+    scheduler_id = None
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith("Job Id:"):
+            scheduler_id = line.split(":", 1)[1].strip()
+            walltimes[scheduler_id] = {}
+            continue
+        if scheduler_id is None or "=" not in line:
+            continue
+        name, value = [f.strip() for f in line.split("=", 1)]
+        if name == "job_state":
+            statuses[scheduler_id] = JobStatusInfo(scheduler_id, value)
+        else:
+            walltimes[scheduler_id][name] = value
+
+    for scheduler_id, status in statuses.items():
+        walltime = walltimes[scheduler_id]
+        if "Walltime.Remaining" in walltime:
+            # Torque reports the remaining time in seconds
+            remaining = walltime["Walltime.Remaining"]
+            status.time_left = int(remaining) if remaining.isdigit() else None
+        elif "Resource_List.walltime" in walltime:
+            limit = parse_duration(walltime["Resource_List.walltime"])
+            used = parse_duration(
+                walltime.get("resources_used.walltime", "00:00:00"))
+            if limit is not None and used is not None:
+                status.time_left = max(limit - used, 0)
+    return statuses
+
+def get_slurm_jobs_runtime(data):
+    """Elapsed seconds of the jobs of `sacct -o JobID,State,ElapsedRaw`,
+    None for the jobs that did not complete successfully."""
+    runtimes = {}
+    for line in data.splitlines():
+        fields = line.split("|")
+        if len(fields) < 3:
+            continue
+        succeeded = fields[1] == "COMPLETED" and fields[2].isdigit()
+        runtimes[fields[0]] = int(fields[2]) if succeeded else None
+    return runtimes
+
+def get_pbs_jobs_runtime(data):
+    """Used wall time in seconds of the finished jobs of `qstat -x -f`,
+    None for the jobs with a non-zero exit status."""
+    runtimes = {}
+    for scheduler_id, attributes in parse_pbs_attributes(
+            data, get_pbs_job_header).items():
+        if attributes.get("Exit_status") == "0":
+            runtimes[scheduler_id] = parse_duration(
+                attributes.get("resources_used.walltime", ""))
+        else:
+            runtimes[scheduler_id] = None
+    return runtimes
+
+# Node state flags making a node unavailable regardless of its base state
+SLURM_UNAVAILABLE_NODE_FLAGS = {
+    "DOWN", "DRAIN", "FAIL", "MAINTENANCE", "NOT_RESPONDING", "RESERVED",
+    "PLANNED", "POWERED_DOWN", "POWERING_DOWN",
+}
+
+def get_slurm_json_number(value):
+    """Slurm 23.02+ wraps numbers as {"set": .., "infinite": .., "number": ..}."""
+    if isinstance(value, dict):
+        if not value.get("set", True) or value.get("infinite"):
+            return None
+        return value.get("number")
+    return value
+
+def get_slurm_json_states(value):
+    """Job and node states are strings up to 22.05, lists of flags since."""
+    if isinstance(value, dict):
+        value = value.get("current")
+    if isinstance(value, str):
+        value = [value]
+    return [v.upper() for v in value or []]
+
+def get_slurm_json_nodes_columns(data):
+    """Columnar nodes of `scontrol show nodes --json` or the slurmrestd
+    nodes endpoint, a node is listed once per partition like in sinfo."""
+    partitions, states, cpus = [], [], []
+    for node in json.loads(data).get("nodes", []) if data else []:
+        node_states = get_slurm_json_states(node.get("state"))
+        state = node_states[0].lower() if node_states else ""
+        if SLURM_UNAVAILABLE_NODE_FLAGS.intersection(node_states):
+            state = "unavailable"
+        for partition in node.get("partitions") or []:
+            partitions.append(partition)
+            states.append(state)
+            cpus.append(get_slurm_json_number(node.get("cpus")) or 0)
+    return get_nodes_columns_from_fields(partitions, states, cpus)
+
+def get_slurm_json_jobs_columns(data):
+    """Columnar jobs of `squeue --json` or the slurmrestd jobs endpoint."""
+    jobs = json.loads(data).get("jobs", []) if data else []
+    partitions, partition = intern_column(j.get("partition") for j in jobs)
+    state = array("B")
+    cpus = array("q")
+    for job in jobs:
+        job_states = get_slurm_json_states(job.get("job_state"))
+        state.append(SLURM_JOB_STATE_CODES.get(
+            job_states[0] if job_states else "", 0))
+        cpus.append(get_slurm_json_number(job.get("cpus")) or 0)
+    return JobColumns(partitions, partition, state, cpus)
+
+# Slurm's NO_VAL, the task ID of the record of pending array elements
+SLURM_NO_VAL = 0xfffffffe
+
+def get_slurm_json_job_ids(job):
+    """sacct nests the array fields, squeue and slurmrestd flatten them."""
+    array_info = job.get("array", {})
+    array_job_id = get_slurm_json_number(
+        array_info.get("job_id", job.get("array_job_id")))
+    if not array_job_id:
+        return [str(job.get("job_id"))]
+    task_id = get_slurm_json_number(
+        array_info.get("task_id", job.get("array_task_id")))
+    if task_id is not None and task_id != SLURM_NO_VAL:
+        return ["{}_{}".format(array_job_id, task_id)]
+    return expand_slurm_array_ids(
+        str(array_job_id),
+        array_info.get("task", job.get("array_task_string")))
+
+def get_slurm_json_jobs_status(data, now=None):
+    """Statuses of `sacct --json` jobs, or of `squeue --json` / slurmrestd
+    jobs, whose time left is derived from the start time."""
+    now = time.time() if now is None else now
+    statuses = {}
+    for job in json.loads(data).get("jobs", []) if data else []:
+        job_states = get_slurm_json_states(
+            job.get("state", job.get("job_state")))
+        if not job_states:
+            continue
+        time_left = None
+        if "time" in job:
+            elapsed = get_slurm_json_number(job["time"].get("elapsed"))
+            limit = get_slurm_json_number(job["time"].get("limit"))
+        else:
+            start = get_slurm_json_number(job.get("start_time"))
+            elapsed = now - start if start else None
+            limit = get_slurm_json_number(job.get("time_limit"))
+        if elapsed is not None and limit is not None:
+            # limits are in minutes
+            time_left = max(int(limit * 60 - elapsed), 0)
+        for scheduler_id in get_slurm_json_job_ids(job):
+            statuses[scheduler_id] = JobStatusInfo(
+                scheduler_id, job_states[0], time_left)
+    return statuses
+
+def parse_pbs_attributes(data, header):
+    """Parses the text output of `pbsnodes -a` or `qstat -f` into
+    {name: {attribute: value}}. header extracts the record name from a
+    record's first line."""
+    records = {}
+    attributes = None
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        name = header(line)
+        if name is not None:
+            attributes = records.setdefault(name, {})
+        elif attributes is not None and " = " in line:
+            # values wrapped onto continuation lines are not needed
+            key, value = line.split(" = ", 1)
+            attributes[key.strip()] = value.strip()
+    return records
+
+def flatten_pbs_json(record):
+    """Turns the nested attributes of PBS JSON output, e.g.
+    {"Resource_List": {"ncpus": 4}}, into the text form Resource_List.ncpus."""
+    attributes = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            for subkey, subvalue in value.items():
+                attributes[f"{key}.{subkey}"] = str(subvalue)
+        else:
+            attributes[key] = str(value)
+    return attributes
+
+def load_pbs_records(data, json_key, header):
+    """Records of PBS JSON output (-F json) or, for servers without JSON
+    support such as Torque, of the text output."""
+    data = data.strip()
+    if data.startswith("{"):
+        records = json.loads(data).get(json_key) or {}
+        return {name: flatten_pbs_json(r) for name, r in records.items()}
+    return parse_pbs_attributes(data, header)
+
+def get_pbs_node_header(line):
+    return line.strip() if not line[0].isspace() else None
+
+def get_pbs_job_header(line):
+    if line.startswith("Job Id:"):
+        return line.split(":", 1)[1].strip()
+    return None
+
+def get_pbs_job_cpus(attributes):
+    if "Resource_List.ncpus" in attributes:
+        return int(attributes["Resource_List.ncpus"])
+    # Torque: nodes=2:ppn=8+1:ppn=4
+    nodes = attributes.get("Resource_List.nodes")
+    if nodes:
+        cpus = 0
+        for chunk in nodes.split("+"):
+            count, _, options = chunk.partition(":")
+            ppn = re.search(r"ppn=(\d+)", options)
+            cpus += (int(count) if count.isdigit() else 1) * \
+                (int(ppn.group(1)) if ppn else 1)
+        return cpus
+    return 1
+
+def get_pbs_jobs_columns(data):
+    """Columnar jobs of `qstat -f`, the queue of a job is its partition."""
+    jobs = load_pbs_records(data, "Jobs", get_pbs_job_header)
+    partitions, partition = intern_column(
+        j.get("queue", PBS_DEFAULT_QUEUE) for j in jobs.values())
+    state = array("B", (
+        PBS_JOB_STATE_CODES.get(j.get("job_state"), 0) for j in jobs.values()))
+    cpus = array("q", (get_pbs_job_cpus(j) for j in jobs.values()))
+    return JobColumns(partitions, partition, state, cpus)
+
+def get_pbs_node_state(attributes):
+    states = attributes.get("state", "").split(",")
+    if states == ["free"]:
+        assigned = attributes.get("resources_assigned.ncpus", "0")
+        busy = attributes.get("jobs") or (assigned.isdigit() and int(assigned))
+        return NodeStateCode.MIXED if busy else NodeStateCode.IDLE
+    if states[0] in ("job-busy", "job-exclusive", "job-sharing", "busy"):
+        return NodeStateCode.ALLOCATED
+    return "unavailable"
+
+def get_pbs_nodes_columns(data, queues=()):
+    """Columnar nodes of `pbsnodes -a`. A node bound to a queue is listed
+    in that partition, any other node in each of the given queues, like
+    Slurm lists nodes once per partition."""
+    nodes = load_pbs_records(data, "nodes", get_pbs_node_header)
+    queues = list(queues) or [PBS_DEFAULT_QUEUE]
+    partitions, states, cpus = [], [], []
+    for attributes in nodes.values():
+        node_cpus = attributes.get(
+            "resources_available.ncpus", attributes.get("np", "0"))
+        state = get_pbs_node_state(attributes)
+        node_queue = attributes.get("queue")
+        for queue in [node_queue] if node_queue else queues:
+            partitions.append(queue)
+            states.append(state)
+            cpus.append(int(node_cpus) if node_cpus.isdigit() else 0)
+    return get_nodes_columns_from_fields(partitions, states, cpus)
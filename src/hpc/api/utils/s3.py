@@ -1,14 +1,31 @@
+import os
+import re
+import base64
 import asyncio
+import hashlib
 from functools import partial
 from pathlib import Path
+from typing import AsyncIterator
 
 import boto3
 from botocore.client import Config
-from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 
 
 MB = 1048576  # 1 MB in bytes
 
+# Streaming transfers keep at most STREAM_BUFFERED_CHUNKS chunks in memory
+STREAM_CHUNK_SIZE = int(os.getenv("HPC_GATEWAY_STREAM_CHUNK_SIZE", 8 * MB))
+STREAM_BUFFERED_CHUNKS = int(os.getenv("HPC_GATEWAY_STREAM_BUFFERED_CHUNKS", 4))
+
+# Chunked transfers. S3 requires parts of at least 5 MB, except the last.
+PART_SIZE = int(os.getenv("HPC_GATEWAY_S3_PART_SIZE", 8 * MB))
+CONCURRENCY = int(os.getenv("HPC_GATEWAY_S3_CONCURRENCY", 4))
+# Error codes of backends without multipart upload support
+MULTIPART_UNSUPPORTED = {"NotImplemented", "MethodNotAllowed", "501"}
+
+MD5_ETAG = re.compile(r"^[0-9a-f]{32}(-\d+)?$")
+
 
 def get_client(endpoint, region, access_key, secret_key):
     return boto3.client(
@@ -45,26 +62,34 @@ async def delete_bucket(s3, bucket):
     return await loop.run_in_executor(None, delete_bucket_partial)
 
 
-async def upload_file(s3, src_path: Path, bucket, obj):
-    """
-    TODO: here we disable multipart by setting a threshold
-    ideally S3 backend should support multipart
-    TODO: files are double in size, therefore trying to use put_object
+async def upload_file(
+    s3,
+    src_path: Path,
+    bucket,
+    obj,
+    part_size: int = PART_SIZE,
+    concurrency: int = CONCURRENCY
+):
     """
+    Uploads the file in parts of part_size, up to concurrency at once.
+    Files not larger than one part, and backends without multipart
+    support, are uploaded with a single put_object. The ETag returned
+    by the backend is checked against the MD5 of the uploaded data.
     """
+    size = src_path.stat().st_size
+    if size > part_size:
+        try:
+            return await _upload_multipart(
+                s3, src_path, bucket, obj, size, part_size, concurrency)
+        except ClientError as e:
+            if _error_code(e) not in MULTIPART_UNSUPPORTED:
+                raise
+    return await _upload_single(s3, src_path, bucket, obj)
+
+
+async def _upload_single(s3, src_path: Path, bucket, obj):
     loop = asyncio.get_event_loop()
-    src = str(src_path.resolve())
-    multipart_threshold = src_path.stat().st_size + MB
-    upload_file_partial = partial(
-        s3.upload_file,
-        Filename=src,
-        Bucket=bucket,
-        Key=obj,
-        Config=TransferConfig(multipart_threshold=multipart_threshold)
-    )
-    return await loop.run_in_executor(None, upload_file_partial)
-    """
-    loop = asyncio.get_event_loop()
+    digest = await loop.run_in_executor(None, _md5_file, src_path)
     with src_path.open("rb") as src:
         put_object_partial = partial(
             s3.put_object,
@@ -72,50 +97,207 @@ async def upload_file(s3, src_path: Path, bucket, obj):
             Bucket=bucket,
             Key=obj,
         )
-        return await loop.run_in_executor(None, put_object_partial)
+        res = await loop.run_in_executor(None, put_object_partial)
+    verify_etag(res.get("ETag"), [digest], obj)
+    return res
 
 
-async def download_file(s3, bucket, obj, dst_path: Path):
-    """
-    TODO: here again we disable multipart by setting a threshold
-    but in this case we should determine the object size first to set the threshold
-    ideally S3 backend should support multipart
-    TODO: Somehow this does not work on download. Use previous version. Raises:
-        boto ResponseParserError(\'Unable to parse response
-        (not well-formed (invalid token): line 1, column 0),
-        invalid XML received. Further retries may succeed
-    TODO: use get_object version, as the download double in size
-    """
-    """ 
-    res = await get_object_attributes(s3, bucket, obj)
-    multipart_threshold = res["ObjectSize"] + MB
+async def _upload_multipart(
+    s3, src_path: Path, bucket, obj, size, part_size, concurrency
+):
     loop = asyncio.get_event_loop()
-    dst = str(dst_path.resolve())
-    download_file_partial = partial(
-        s3.download_file,
+    create_partial = partial(
+        s3.create_multipart_upload,
         Bucket=bucket,
         Key=obj,
-        Filename=dst,
-        Config=TransferConfig(multipart_threshold=multipart_threshold)
     )
-    return await loop.run_in_executor(None, download_file_partial)
+    upload_id = (await loop.run_in_executor(None, create_partial))["UploadId"]
+    semaphore = asyncio.Semaphore(concurrency)
+    digests = {}
+    # requests running in the executor, they outlive a cancelled task
+    in_flight = set()
+
+    async def upload_part(number, offset):
+        async with semaphore:
+            data = await loop.run_in_executor(
+                None, _read_range, src_path, offset, part_size)
+            digests[number] = hashlib.md5(data)
+            upload_part_partial = partial(
+                s3.upload_part,
+                Body=data,
+                Bucket=bucket,
+                Key=obj,
+                PartNumber=number,
+                UploadId=upload_id,
+                ContentMD5=base64.b64encode(
+                    digests[number].digest()).decode(),
+            )
+            upload = loop.run_in_executor(None, upload_part_partial)
+            in_flight.add(upload)
+            upload.add_done_callback(in_flight.discard)
+            res = await asyncio.shield(upload)
+            return {"PartNumber": number, "ETag": res["ETag"]}
+
+    tasks = [
+        asyncio.ensure_future(upload_part(number, offset))
+        for number, offset in enumerate(range(0, size, part_size), 1)]
+    try:
+        parts = await asyncio.gather(*tasks)
+        complete_partial = partial(
+            s3.complete_multipart_upload,
+            Bucket=bucket,
+            Key=obj,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        res = await loop.run_in_executor(None, complete_partial)
+    except BaseException:
+        # no part may be stored after the abort
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if in_flight:
+            await asyncio.wait(set(in_flight))
+        abort_partial = partial(
+            s3.abort_multipart_upload,
+            Bucket=bucket,
+            Key=obj,
+            UploadId=upload_id,
+        )
+        await loop.run_in_executor(None, abort_partial)
+        raise
+    verify_etag(
+        res.get("ETag"), [digests[n] for n in sorted(digests)], obj)
+    return res
+
+
+def verify_etag(etag, part_digests, obj) -> None:
     """
+    Compares an S3 ETag with the MD5 digests of the transferred parts.
+    ETags that are not MD5 based (e.g. with SSE-KMS) cannot be verified
+    and are skipped.
     """
-    loop = asyncio.get_event_loop()
-    dst = str(dst_path.resolve())
-    return await loop.run_in_executor(None, s3.download_file, bucket, obj, dst)
+    etag = (etag or "").strip('"')
+    if not MD5_ETAG.match(etag):
+        return
+    if len(part_digests) == 1:
+        expected = part_digests[0].hexdigest()
+    else:
+        combined = hashlib.md5(b"".join(d.digest() for d in part_digests))
+        expected = f"{combined.hexdigest()}-{len(part_digests)}"
+    if etag != expected:
+        raise ValueError(
+            f"Checksum mismatch for {obj}: ETag {etag}, expected {expected}")
+
+
+def _error_code(error: ClientError) -> str:
+    return error.response.get("Error", {}).get("Code", "")
+
+
+def _md5_file(path: Path):
+    digest = hashlib.md5()
+    with path.open("rb") as src:
+        for chunk in iter(lambda: src.read(MB), b""):
+            digest.update(chunk)
+    return digest
+
+
+def _read_range(path: Path, offset: int, size: int) -> bytes:
+    with path.open("rb") as src:
+        src.seek(offset)
+        return src.read(size)
+
+
+async def stream_object(
+    s3,
+    bucket,
+    obj,
+    offset: int = 0,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+    max_buffered_chunks: int = STREAM_BUFFERED_CHUNKS
+) -> AsyncIterator[bytes]:
+    """
+    Yields the object body from offset on in chunks. The body is read
+    ahead in the background into a bounded buffer, so the consumer can
+    write a chunk while the next ones are downloaded, and a slow
+    consumer throttles the download instead of growing the memory usage.
     """
     loop = asyncio.get_event_loop()
-    with dst_path.open("wb") as dst:
-        get_object_partial = partial(
-            s3.get_object,
-            Bucket=bucket,
-            Key=obj,
-        )
-        res = await loop.run_in_executor(None, get_object_partial)
-        for d in res["Body"]:
-            dst.write(d)
-        return res
+    get_object_partial = partial(
+        s3.get_object,
+        Bucket=bucket,
+        Key=obj,
+        **({"Range": f"bytes={offset}-"} if offset else {}),
+    )
+    res = await loop.run_in_executor(None, get_object_partial)
+    body = res["Body"]
+    buffer = asyncio.Queue(maxsize=max_buffered_chunks)
+    # read running in the executor, it outlives a cancelled reader
+    in_flight = set()
+
+    async def read_ahead():
+        try:
+            while True:
+                read = loop.run_in_executor(None, body.read, chunk_size)
+                in_flight.add(read)
+                read.add_done_callback(in_flight.discard)
+                chunk = await asyncio.shield(read)
+                await buffer.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            await buffer.put(e)
+
+    reader = asyncio.create_task(read_ahead())
+    try:
+        while True:
+            chunk = await buffer.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        # the body is closed only once nothing reads from it anymore
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        if in_flight:
+            await asyncio.wait(set(in_flight))
+        body.close()
+
+
+async def head_object(s3, bucket, obj):
+    loop = asyncio.get_event_loop()
+    head_object_partial = partial(
+        s3.head_object,
+        Bucket=bucket,
+        Key=obj
+    )
+    return await loop.run_in_executor(None, head_object_partial)
+
+
+def get_presigned_url(s3, bucket, obj, expires_in):
+    # signed locally, no request is made
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": obj},
+        ExpiresIn=expires_in)
+
+
+async def list_objects(s3, bucket, prefix):
+    """Returns the objects whose key starts with prefix, over all pages
+    of the listing."""
+    loop = asyncio.get_event_loop()
+
+    def list_all():
+        paginator = s3.get_paginator("list_objects_v2")
+        return [
+            obj
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get("Contents", [])
+        ]
+    return await loop.run_in_executor(None, list_all)
+
 
 async def delete_object(s3, bucket, obj):
     loop = asyncio.get_event_loop()
@@ -1,54 +1,142 @@
+import os
 import re
+import shlex
 import hpc.api.utils.resource_parser as parser
 from hpc.api.openapi.models.job_status_code import JobStatusCode
 from hpc.api.openapi.models.hpc_scheduler_type import HPCSchedulerType
+from hpc.api.openapi.models.scheduler_interface import SchedulerInterface
+
+# Separates the nodes and jobs sections of the telemetry command output
+TELEMETRY_DELIMITER = "--- hpc-gateway jobs ---"
+SLURMRESTD_API_VERSION = os.getenv("HPC_GATEWAY_SLURMRESTD_API_VERSION", "v0.0.39")
+
+
+def get_telemetry_command(nodes_info_command, jobs_info_command):
+    return "{}; echo '{}'; {}".format(
+        nodes_info_command, TELEMETRY_DELIMITER, jobs_info_command)
+
+
+def split_telemetry(data):
+    nodes_data, found, jobs_data = data.partition(TELEMETRY_DELIMITER)
+    if not found:
+        raise ValueError("Telemetry output is incomplete")
+    return nodes_data.strip(), jobs_data.strip()
 
 class SchedulerHelperFactory():
     @classmethod
-    def helper(cls, scheduler):
+    def helper(cls, scheduler, interface=None, slurmrestd_url=None):
         if scheduler == HPCSchedulerType.PBS:
             return PBSHelper()
         elif scheduler == HPCSchedulerType.SLURM:
+            if interface == SchedulerInterface.JSON:
+                return SlurmJsonHelper()
+            elif interface == SchedulerInterface.REST:
+                if not slurmrestd_url:
+                    raise ValueError("slurmrestd_url is required by the rest scheduler interface")
+                return SlurmRestHelper(slurmrestd_url)
             return SlurmHelper()
         else:
             raise NotImplementedError("Unknown scheduler: {}".format(scheduler))
 
+    @classmethod
+    def for_infrastructure(cls, infrastructure):
+        return cls.helper(
+            infrastructure["scheduler"],
+            infrastructure.get("scheduler_interface"),
+            infrastructure.get("slurmrestd_url"))
+
 class PBSHelper():
     def get_submit_command(self):
         return "qsub"
 
+    def get_array_submit_command(self, size, max_running=None):
+        # at most max_running elements run at the same time
+        if max_running:
+            return "qsub -J 0-{}%{}".format(size - 1, max_running)
+        return "qsub -J 0-{}".format(size - 1)
+
+    def get_dependent_submit_command(self, scheduler_id):
+        # the job starts once scheduler_id ended, whatever its outcome
+        return "qsub -W depend=afterany:{}".format(shlex.quote(scheduler_id))
+
+    def get_array_index_variable(self):
+        # PBS_ARRAYID on Torque
+        return "${PBS_ARRAY_INDEX:-$PBS_ARRAYID}"
+
+    def get_array_element_ids(self, scheduler_id, size):
+        # 123[].server -> 123[0].server, 123[1].server, ...
+        return [scheduler_id.replace("[]", "[{}]".format(i), 1) for i in range(size)]
+
     def parse_job_scheduler_id(self, data):
         return data
 
     def get_job_status_code_command(self, scheduler_id):
-        return "qstat -f {} | grep 'job_state' | grep -o '.$'".format(scheduler_id)
+        return "qstat -f {} | grep 'job_state' | grep -o '.$'".format(shlex.quote(scheduler_id))
+
+    # -x keeps finished jobs in the output instead of an "Unknown Job Id"
+    def get_jobs_status_command(self, scheduler_ids):
+        # array element IDs contain brackets, which the shell would glob
+        return "qstat -x -f {} | grep -E '^Job Id:|job_state|walltime|Walltime'".format(
+            " ".join(shlex.quote(i) for i in scheduler_ids))
+
+    def get_jobs_status(self, data):
+        return parser.get_pbs_jobs_status(data)
+
+    # -x includes finished jobs, which PBS Pro keeps in its job history
+    def get_jobs_runtime_command(self, scheduler_ids):
+        return "qstat -x -f {} | grep -E '^Job Id:|Exit_status|resources_used.walltime'".format(
+            " ".join(shlex.quote(i) for i in scheduler_ids))
+
+    def get_jobs_runtime(self, data):
+        return parser.get_pbs_jobs_runtime(data)
 
     def get_job_status_code(self, status):
-        if status == 'C':
-            return JobStatusCode.COMPLETED
-        elif status == 'Q':
-            return JobStatusCode.QUEUED
-        elif status == 'R':
-            return JobStatusCode.RUNNING
+        if status in parser.PBS_JOB_STATES:
+            return parser.PBS_JOB_STATES[status]
         else:
             raise NotImplementedError("PBS status is undefined or not supported: {}".format(status))
 
+    # JSON output needs PBS Pro 18+, Torque only has the text format
     def get_nodes_info_command(self):
-        return "pbsnodes -a"
+        return "pbsnodes -a -F json 2>/dev/null || pbsnodes -a"
 
     def get_jobs_info_command(self):
-        return "qstat -a"
+        return "qstat -f -F json 2>/dev/null || qstat -f"
 
-    def get_nodes_info(self, data):
-        return []
+    def get_telemetry_command(self):
+        return get_telemetry_command(
+            self.get_nodes_info_command(), self.get_jobs_info_command())
+
+    def get_nodes_info(self, data, queues=()):
+        return parser.get_pbs_nodes_columns(data, queues)
 
     def get_jobs_info(self, data):
-        return []
+        return parser.get_pbs_jobs_columns(data)
+
+    def get_telemetry(self, data):
+        nodes_data, jobs_data = split_telemetry(data)
+        jobs = self.get_jobs_info(jobs_data)
+        # nodes not bound to a queue serve all queues that have jobs
+        return self.get_nodes_info(nodes_data, jobs.partitions), jobs
 
 class SlurmHelper():
     def get_submit_command(self):
         return "sbatch"
 
+    def get_array_submit_command(self, size, max_running=None):
+        if max_running:
+            return "sbatch --array=0-{}%{}".format(size - 1, max_running)
+        return "sbatch --array=0-{}".format(size - 1)
+
+    def get_dependent_submit_command(self, scheduler_id):
+        return "sbatch --dependency=afterany:{}".format(shlex.quote(scheduler_id))
+
+    def get_array_index_variable(self):
+        return "$SLURM_ARRAY_TASK_ID"
+
+    def get_array_element_ids(self, scheduler_id, size):
+        return ["{}_{}".format(scheduler_id, i) for i in range(size)]
+
     def parse_job_scheduler_id(self, data):
         result = re.search(r"\d+|$", data).group()
         if len(result) == 0:
@@ -58,13 +146,21 @@ class SlurmHelper():
     def get_job_status_code_command(self, scheduler_id):
         return "scontrol show job -dd {} | grep -o 'JobState=[A-Z]*' | cut -d '=' -f 2".format(scheduler_id)
 
+    def get_jobs_status_command(self, scheduler_ids):
+        return "sacct -n -X -P -o JobID,State,Elapsed,Timelimit -j {}".format(",".join(scheduler_ids))
+
+    def get_jobs_status(self, data):
+        return parser.get_slurm_jobs_status(data)
+
+    def get_jobs_runtime_command(self, scheduler_ids):
+        return "sacct -n -X -P -o JobID,State,ElapsedRaw -j {}".format(",".join(scheduler_ids))
+
+    def get_jobs_runtime(self, data):
+        return parser.get_slurm_jobs_runtime(data)
+
     def get_job_status_code(self, status):
-        if status in ["COMPLETED", "FAILED"]:
-            return JobStatusCode.COMPLETED
-        elif status == "PENDING":
-            return JobStatusCode.QUEUED
-        elif status in ["COMPLETING", "RUNNING"]:
-            return JobStatusCode.RUNNING
+        if status in parser.SLURM_JOB_STATES:
+            return parser.SLURM_JOB_STATES[status]
         else:
             raise NotImplementedError("Slurm status is undefined or not supported: {}".format(status))
 
@@ -73,9 +169,63 @@ class SlurmHelper():
 
     def get_jobs_info_command(self):
         return "squeue -h -o '%A,%C,%D,%e,%H,%I,%J,%L,%m,%N,%P,%T,%Y'"
+
+    def get_telemetry_command(self):
+        return get_telemetry_command(
+            self.get_nodes_info_command(), self.get_jobs_info_command())
     
     def get_nodes_info(self, data):
         return parser.get_slurm_nodes_info(data)
     
     def get_jobs_info(self, data):
-        return parser.get_slurm_jobs_info(data)
\ No newline at end of file
+        return parser.get_slurm_jobs_info(data)
+
+    def get_telemetry(self, data):
+        # columnar, large clusters produce many thousands of lines
+        nodes_data, jobs_data = split_telemetry(data)
+        return parser.get_slurm_nodes_columns(nodes_data), \
+            parser.get_slurm_jobs_columns(jobs_data)
+
+class SlurmJsonHelper(SlurmHelper):
+    """Queries Slurm through the JSON output of its commands, which does
+    not break on separators within fields."""
+    def get_jobs_status_command(self, scheduler_ids):
+        return "sacct --json -j {}".format(",".join(scheduler_ids))
+
+    def get_jobs_status(self, data):
+        return parser.get_slurm_json_jobs_status(data)
+
+    def get_nodes_info_command(self):
+        return "scontrol show nodes --json"
+
+    def get_jobs_info_command(self):
+        return "squeue --json"
+
+    def get_telemetry(self, data):
+        nodes_data, jobs_data = split_telemetry(data)
+        return parser.get_slurm_json_nodes_columns(nodes_data), \
+            parser.get_slurm_json_jobs_columns(jobs_data)
+
+class SlurmRestHelper(SlurmJsonHelper):
+    """Queries slurmrestd with curl on the login node, authenticated with
+    SLURM_JWT or a token issued by scontrol. Job statuses come from the
+    jobs known to slurmctld in one request, finished jobs are purged
+    after MinJobAge and then reported missing."""
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def get_request_command(self, path):
+        return (
+            "curl -sf"
+            " -H \"X-SLURM-USER-NAME: $(whoami)\""
+            " -H \"X-SLURM-USER-TOKEN: ${{SLURM_JWT:-$(scontrol token | cut -d= -f2)}}\""
+            " '{}/slurm/{}/{}'".format(self.url, SLURMRESTD_API_VERSION, path))
+
+    def get_jobs_status_command(self, scheduler_ids):
+        return self.get_request_command("jobs")
+
+    def get_nodes_info_command(self):
+        return self.get_request_command("nodes")
+
+    def get_jobs_info_command(self):
+        return self.get_request_command("jobs")
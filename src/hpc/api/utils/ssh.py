@@ -1,8 +1,41 @@
-from typing import Tuple
+import os
+import asyncio
+from typing import (
+    AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, List, Optional,
+    Set, Tuple
+)
 from pathlib import Path
+from contextlib import asynccontextmanager
 
 import aiofiles.os
 import asyncssh
+from asyncssh import FXF_CREAT, FXF_TRUNC, FXF_WRITE
+
+from hpc.api.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Pool tuning. A connection carries several channels (commands, SFTP
+# sessions) at once, sshd limits those with MaxSessions (10 by default).
+MAX_CONNECTIONS_PER_HOST = int(
+    os.getenv("HPC_GATEWAY_SSH_MAX_CONNECTIONS_PER_HOST", 4))
+MAX_CHANNELS_PER_CONNECTION = int(
+    os.getenv("HPC_GATEWAY_SSH_MAX_CHANNELS_PER_CONNECTION", 8))
+# Channels of a host that SFTP transfers cannot take, so that commands
+# (job submissions, status polls) still run during large transfers
+RESERVED_CHANNELS = int(os.getenv("HPC_GATEWAY_SSH_RESERVED_CHANNELS", 8))
+IDLE_TIMEOUT = float(os.getenv("HPC_GATEWAY_SSH_IDLE_TIMEOUT", 300.0))
+KEEPALIVE_INTERVAL = float(os.getenv("HPC_GATEWAY_SSH_KEEPALIVE_INTERVAL", 30.0))
+KEEPALIVE_COUNT_MAX = 3
+
+MB = 1048576  # 1 MB in bytes
+# Files larger than one part are transferred as parallel ranges
+SFTP_PART_SIZE = int(os.getenv("HPC_GATEWAY_SFTP_PART_SIZE", 16 * MB))
+SFTP_CONCURRENCY = int(os.getenv("HPC_GATEWAY_SFTP_CONCURRENCY", 4))
+
+# awaited with (offset, length, file size) of every transferred part
+PartCallback = Callable[[int, int, int], Awaitable[None]]
 
 
 async def key_exists(key_path: str) -> bool:
@@ -15,19 +48,231 @@ async def get_pkey(key_path: str, key_password: str) -> asyncssh.SSHKey:
     return asyncssh.read_private_key(key_path, key_password)
 
 
+class _PooledConnection:
+    def __init__(self, key: Tuple[str, str, str]):
+        self.key = key
+        self.conn = None
+        self.channels = 0
+        self.closed = False
+        self.idle_handle = None
+
+    def usable(self) -> bool:
+        return self.conn is not None and not self.closed
+
+
+class _PoolClient(asyncssh.SSHClient):
+    """Marks the pooled connection as dead once asyncssh drops it,
+    e.g. after missed keepalives or a server-side disconnect."""
+
+    def __init__(self, pooled: _PooledConnection):
+        self._pooled = pooled
+
+    def connection_lost(self, exc) -> None:
+        self._pooled.closed = True
+
+
+class SSHConnectionPool:
+    """Warm SSH connections keyed by (host, username, key fingerprint).
+
+    Commands and SFTP sessions are opened as channels over the pooled
+    connections, a new connection is only made when every existing one
+    is saturated and the per-host cap is not reached yet. Bulk channels,
+    the SFTP sessions of transfers, leave reserved_channels of every
+    host to the other ones.
+    """
+
+    def __init__(
+        self,
+        max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+        max_channels_per_connection: int = MAX_CHANNELS_PER_CONNECTION,
+        reserved_channels: int = RESERVED_CHANNELS,
+        idle_timeout: float = IDLE_TIMEOUT,
+        keepalive_interval: float = KEEPALIVE_INTERVAL
+    ):
+        self.loop = asyncio.get_event_loop()
+        self.max_connections_per_host = max_connections_per_host
+        self.max_channels_per_connection = max_channels_per_connection
+        # at least one bulk channel, whatever the reservation
+        self.max_bulk_channels = max(
+            1,
+            max_connections_per_host * max_channels_per_connection
+            - reserved_channels)
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self._connections: Dict[Tuple, List[_PooledConnection]] = {}
+        self._connecting: Dict[Tuple, int] = {}
+        self._conditions: Dict[Tuple, asyncio.Condition] = {}
+        self._bulk_channels: Dict[Tuple, int] = {}
+
+    @staticmethod
+    def get_key(host: str, username: str, pkey: asyncssh.SSHKey) -> Tuple:
+        return host, username, pkey.get_fingerprint()
+
+    @asynccontextmanager
+    async def connection(
+        self,
+        host: str,
+        username: str,
+        pkey: asyncssh.SSHKey,
+        bulk: bool = False
+    ) -> AsyncIterator[asyncssh.SSHClientConnection]:
+        pooled = await self._acquire(host, username, pkey, bulk)
+        try:
+            yield pooled.conn
+        finally:
+            await self._release(pooled, bulk)
+
+    async def _acquire(
+        self,
+        host: str,
+        username: str,
+        pkey: asyncssh.SSHKey,
+        bulk: bool = False
+    ) -> _PooledConnection:
+        key = self.get_key(host, username, pkey)
+        condition = self._conditions.setdefault(key, asyncio.Condition())
+        async with condition:
+            while True:
+                if bulk and self._bulk_channels.get(key, 0) >= \
+                        self.max_bulk_channels:
+                    await condition.wait()
+                    continue
+                entries = self._evict_closed(key)
+                available = [
+                    e for e in entries
+                    if e.channels < self.max_channels_per_connection]
+                if available:
+                    pooled = min(available, key=lambda e: e.channels)
+                    self._reserve(pooled, bulk)
+                    return pooled
+                connecting = self._connecting.get(key, 0)
+                if len(entries) + connecting < self.max_connections_per_host:
+                    self._connecting[key] = connecting + 1
+                    if bulk:
+                        self._bulk_channels[key] = \
+                            self._bulk_channels.get(key, 0) + 1
+                    break
+                await condition.wait()
+
+        pooled = _PooledConnection(key)
+        try:
+            pooled.conn = await asyncssh.connect(
+                host,
+                username=username,
+                client_keys=[pkey],
+                known_hosts=None,  # TODO: security concern
+                client_factory=lambda: _PoolClient(pooled),
+                keepalive_interval=self.keepalive_interval,
+                keepalive_count_max=KEEPALIVE_COUNT_MAX,
+            )
+        finally:
+            async with condition:
+                self._connecting[key] -= 1
+                if pooled.conn is not None:
+                    self._connections.setdefault(key, []).append(pooled)
+                    # the bulk channel was counted before connecting
+                    self._reserve(pooled)
+                elif bulk:
+                    self._bulk_channels[key] -= 1
+                condition.notify_all()
+        logger.debug("Opened pooled SSH connection to {}@{}".format(
+            username, host))
+        return pooled
+
+    async def _release(
+        self,
+        pooled: _PooledConnection,
+        bulk: bool = False
+    ) -> None:
+        condition = self._conditions[pooled.key]
+        async with condition:
+            pooled.channels -= 1
+            if bulk:
+                self._bulk_channels[pooled.key] -= 1
+            if pooled.channels == 0:
+                if pooled.closed:
+                    self._evict_closed(pooled.key)
+                else:
+                    pooled.idle_handle = self.loop.call_later(
+                        self.idle_timeout, self._evict_idle, pooled)
+            condition.notify_all()
+
+    def _reserve(self, pooled: _PooledConnection, bulk: bool = False) -> None:
+        pooled.channels += 1
+        if bulk:
+            self._bulk_channels[pooled.key] = \
+                self._bulk_channels.get(pooled.key, 0) + 1
+        if pooled.idle_handle is not None:
+            pooled.idle_handle.cancel()
+            pooled.idle_handle = None
+
+    def _evict_closed(self, key: Tuple) -> List[_PooledConnection]:
+        entries = self._connections.get(key, [])
+        alive = [e for e in entries if e.usable() or e.channels > 0]
+        self._connections[key] = alive
+        return [e for e in alive if e.usable()]
+
+    def _evict_idle(self, pooled: _PooledConnection) -> None:
+        pooled.idle_handle = None
+        if pooled.channels > 0:
+            return
+        entries = self._connections.get(pooled.key, [])
+        if pooled in entries:
+            entries.remove(pooled)
+        pooled.closed = True
+        pooled.conn.close()
+        logger.debug("Closed idle SSH connection to {}@{}".format(
+            pooled.key[1], pooled.key[0]))
+
+    async def close(self) -> None:
+        for entries in self._connections.values():
+            for pooled in entries:
+                if pooled.idle_handle is not None:
+                    pooled.idle_handle.cancel()
+                pooled.closed = True
+                pooled.conn.close()
+        self._connections.clear()
+
+
+_pool = None
+
+
+def get_pool() -> SSHConnectionPool:
+    # connections are bound to the loop they were opened in
+    global _pool
+    loop = asyncio.get_event_loop()
+    if _pool is None or _pool.loop is not loop:
+        _pool = SSHConnectionPool()
+    return _pool
+
+
+async def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def connection(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    bulk: bool = False
+):
+    return get_pool().connection(host, username, pkey, bulk)
+
+
 async def exec_command(
     host: str,
     username: str,
     pkey: asyncssh.SSHKey,
-    command: str
+    command: str,
+    input: Optional[str] = None
 ) -> Tuple[str, str]:
-    async with asyncssh.connect(
-        host,
-        username=username,
-        client_keys=[pkey],
-        known_hosts=None,  # TODO: security concern
-    ) as conn:
-        result = await conn.run(command, check=False)
+    """Runs command on the host, input is written to its stdin and never
+    shows on its command line."""
+    async with connection(host, username, pkey) as conn:
+        result = await conn.run(command, input=input, check=False)
         stdout = "".join(result.stdout).rstrip()
         stderr = "".join(result.stderr).rstrip()
         return stdout, stderr
@@ -38,16 +283,98 @@ async def sftp_upload(
     username: str,
     pkey: asyncssh.SSHKey,
     local_src: Path,
-    remote_dst: Path
+    remote_dst: Path,
+    completed_parts: Set[int] = frozenset(),
+    on_part: PartCallback = None,
+    part_size: int = SFTP_PART_SIZE,
+    concurrency: int = SFTP_CONCURRENCY
 ) -> None:
-    async with asyncssh.connect(
-        host,
-        username=username,
-        client_keys=[pkey],
-        known_hosts=None,  # TODO: security concern
-    ) as conn:
+    """
+    Files larger than one part are written as ranges of part_size over
+    up to concurrency SFTP sessions. Parts whose offsets are listed in
+    completed_parts are skipped, on_part is awaited with the offset,
+    length and file size of every part once it has been written.
+    """
+    size = local_src.stat().st_size
+    if size <= part_size and not completed_parts:
+        async with connection(host, username, pkey, bulk=True) as conn:
+            async with conn.start_sftp_client() as sftp:
+                await sftp.put(local_src, remote_dst)
+        if on_part is not None:
+            await on_part(0, size, size)
+        return
+
+    loop = asyncio.get_event_loop()
+
+    async def upload_part(sftp, offset):
+        length = min(part_size, size - offset)
+        data = await loop.run_in_executor(
+            None, _read_range, local_src, offset, length)
+        async with sftp.open(remote_dst, FXF_WRITE | FXF_CREAT) as dst:
+            await dst.write(data, offset)
+        if on_part is not None:
+            await on_part(offset, length, size)
+
+    offsets = [o for o in range(0, size, part_size) if o not in completed_parts]
+    await _transfer_parts(
+        host, username, pkey, offsets, concurrency, upload_part)
+    async with connection(host, username, pkey, bulk=True) as conn:
+        async with conn.start_sftp_client() as sftp:
+            # drop leftovers of a previous, larger file
+            await sftp.truncate(remote_dst, size)
+
+
+async def sftp_upload_stream(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    chunks: AsyncIterable[bytes],
+    remote_dst: Path,
+    offset: int = 0,
+    on_chunk: Callable[[int], Awaitable[None]] = None
+) -> None:
+    """
+    Writes the chunks to the remote file starting at offset, i.e. a
+    previously interrupted stream is continued. on_chunk is awaited with
+    the offset up to which the file has been written.
+    """
+    pflags = FXF_WRITE | FXF_CREAT | (FXF_TRUNC if offset == 0 else 0)
+    async with connection(host, username, pkey, bulk=True) as conn:
         async with conn.start_sftp_client() as sftp:
-            await sftp.put(local_src, remote_dst)
+            async with sftp.open(remote_dst, pflags) as dst:
+                async for chunk in chunks:
+                    await dst.write(chunk, offset)
+                    offset += len(chunk)
+                    if on_chunk is not None:
+                        await on_chunk(offset)
+            await sftp.truncate(remote_dst, offset)
+
+
+async def sftp_write_blocks(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    blocks: AsyncIterable[Tuple[int, int, Optional[bytes]]],
+    remote_dst: Path,
+    on_block: Callable[[int, int, bool], Awaitable[None]] = None
+) -> None:
+    """
+    Writes the (offset, length, data) blocks into the remote file in
+    place, blocks without data are already there. The file is truncated
+    after the last block. on_block is awaited with the offset and length
+    of every block and whether it was written.
+    """
+    end = 0
+    async with connection(host, username, pkey, bulk=True) as conn:
+        async with conn.start_sftp_client() as sftp:
+            async with sftp.open(remote_dst, FXF_WRITE | FXF_CREAT) as dst:
+                async for offset, length, data in blocks:
+                    if data is not None:
+                        await dst.write(data, offset)
+                    end = offset + length
+                    if on_block is not None:
+                        await on_block(offset, length, data is not None)
+            await sftp.truncate(remote_dst, end)
 
 
 async def sftp_download(
@@ -55,13 +382,95 @@ async def sftp_download(
     username: str,
     pkey: asyncssh.SSHKey,
     remote_src: Path,
-    local_dst: Path
+    local_dst: Path,
+    completed_parts: Set[int] = frozenset(),
+    on_part: PartCallback = None,
+    part_size: int = SFTP_PART_SIZE,
+    concurrency: int = SFTP_CONCURRENCY
 ) -> None:
-    async with asyncssh.connect(
-        host,
-        username=username,
-        client_keys=[pkey],
-        known_hosts=None,  # TODO: security concern
-    ) as conn:
+    """
+    Counterpart of sftp_upload, remote files larger than one part are
+    read as concurrent ranges and written in place into local_dst.
+    """
+    async with connection(host, username, pkey, bulk=True) as conn:
+        async with conn.start_sftp_client() as sftp:
+            size = (await sftp.stat(remote_src)).size
+            if size <= part_size and not completed_parts:
+                await sftp.get(remote_src, local_dst)
+                if on_part is not None:
+                    await on_part(0, size, size)
+                return
+
+    loop = asyncio.get_event_loop()
+    fd = os.open(local_dst, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    async def download_part(sftp, offset):
+        length = min(part_size, size - offset)
+        async with sftp.open(remote_src, "rb") as src:
+            data = await src.read(length, offset)
+        await loop.run_in_executor(None, os.pwrite, fd, data, offset)
+        if on_part is not None:
+            await on_part(offset, length, size)
+
+    try:
+        offsets = [
+            o for o in range(0, size, part_size) if o not in completed_parts]
+        await _transfer_parts(
+            host, username, pkey, offsets, concurrency, download_part)
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+async def sftp_glob(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    pattern: str
+) -> List[Tuple[str, int]]:
+    """Returns the path and size of the regular files matching the glob
+    pattern, ** matches any number of directories."""
+    async with connection(host, username, pkey) as conn:
         async with conn.start_sftp_client() as sftp:
-            await sftp.get(remote_src, local_dst)
+            try:
+                names = await sftp.glob_sftpname(pattern)
+            except asyncssh.SFTPNoSuchFile:
+                return []
+    return [
+        (name.filename, name.attrs.size) for name in names
+        if name.attrs.type == asyncssh.FILEXFER_TYPE_REGULAR]
+
+
+async def _transfer_parts(
+    host: str,
+    username: str,
+    pkey: asyncssh.SSHKey,
+    offsets: List[int],
+    concurrency: int,
+    transfer_part: Callable[..., Awaitable[None]]
+) -> None:
+    """Runs transfer_part(sftp, offset) for all offsets, spread over up
+    to concurrency SFTP sessions on the pooled connections."""
+    pending = list(offsets)
+
+    async def worker():
+        async with connection(host, username, pkey, bulk=True) as conn:
+            async with conn.start_sftp_client() as sftp:
+                while pending:
+                    await transfer_part(sftp, pending.pop(0))
+
+    workers = [
+        asyncio.ensure_future(worker())
+        for _ in range(min(concurrency, len(pending)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for w in workers:
+            w.cancel()
+        raise
+
+
+def _read_range(path: Path, offset: int, size: int) -> bytes:
+    with path.open("rb") as src:
+        src.seek(offset)
+        return src.read(size)
@@ -1,12 +1,30 @@
-from jinja2 import Environment, PackageLoader, select_autoescape
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from typing import Any
+
+from jinja2 import BaseLoader, Environment, PackageLoader, Template, select_autoescape
 
 from hpc.api.services.listing import Listing
+from hpc.api.log import get_logger
 
 from hpc.api.openapi.models.job_request import JobRequest
 from hpc.api.openapi.models.service_name import ServiceName
 from hpc.api.openapi.models.job_request_params import *
 
 
+logger = get_logger(__name__)
+
+JOB_TEMPLATE = "exe.sh.j2"
+# Recompile templates whose file changed, costs a stat per render
+TEMPLATE_AUTO_RELOAD = os.getenv("HPC_GATEWAY_TEMPLATE_AUTO_RELOAD", "1") == "1"
+# Rendered scripts kept per distinct set of resolved parameters
+RENDER_CACHE_SIZE = int(os.getenv("HPC_GATEWAY_RENDER_CACHE_SIZE", 1024))
+
+FILTER_SERVICES = tuple(Listing().get_filter_services())
+
+
 def generate_params(request: JobRequest) -> JobRequestParams:
     params = request.params
     params.icase = resolve_icase(request)
@@ -32,8 +50,7 @@ def generate_params(request: JobRequest) -> JobRequestParams:
 
 
 def resolve_icase(request: JobRequest) -> JobRequestParamsFilter:
-    listing = Listing()
-    filter_services = set(listing.get_filter_services())
+    filter_services = set(FILTER_SERVICES)
     kmean_services = {ServiceName.KMEAN}
     knn_services = {ServiceName.KNN}
     req_services = set(request.services)
@@ -47,8 +64,7 @@ def resolve_icase(request: JobRequest) -> JobRequestParamsFilter:
 
 
 def resolve_filters(request: JobRequest) -> JobRequestParamsFilter:
-    listing = Listing()
-    filters = {k:int(k in request.services) for k in listing.get_filter_services()}
+    filters = {k:int(k in request.services) for k in FILTER_SERVICES}
     return JobRequestParamsFilter.from_dict(filters)
 
 
@@ -73,10 +89,69 @@ def resolve_knn_request(request: JobRequest) -> JobRequestParamsKnn:
         k_nearest_neighbor=k_nearest_neighbor)
 
 
-def render(request: JobRequest) -> str:
-    env = Environment(
-        loader=PackageLoader("hpc"),
-        autoescape=select_autoescape()
-    )
-    template = env.get_template("exe.sh.j2")
-    return template.render(params=generate_params(request))
+def get_params_hash(params: JobRequestParams) -> str:
+    """Canonical hash of resolved parameters, equal parameters give the
+    same hash regardless of the order they were set in."""
+    data = json.dumps(params.to_dict(), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class TemplateRegistry:
+    """Compiled job templates and a LRU cache of the scripts rendered
+    from them. Jinja checks the template files on every lookup when
+    auto_reload is set, a changed file is recompiled and invalidates the
+    scripts rendered from its previous version."""
+
+    def __init__(self, loader: BaseLoader = None,
+                 auto_reload: bool = TEMPLATE_AUTO_RELOAD,
+                 cache_size: int = RENDER_CACHE_SIZE):
+        self.env = Environment(
+            loader=loader or PackageLoader("hpc"),
+            autoescape=select_autoescape(),
+            auto_reload=auto_reload
+        )
+        self.cache_size = cache_size
+        self.rendered: OrderedDict = OrderedDict()
+
+    def load(self) -> None:
+        for name in self.env.list_templates():
+            self.env.get_template(name)
+        logger.info("Loaded templates: {}".format(
+            ", ".join(self.env.list_templates())))
+
+    def get_template(self, name: str = JOB_TEMPLATE) -> Template:
+        return self.env.get_template(name)
+
+    def render(self, params: JobRequestParams,
+               name: str = JOB_TEMPLATE, **variables: Any) -> str:
+        """Variables besides the params are part of the cache key, objects
+        are keyed by their attributes."""
+        template = self.get_template(name)
+        key = (name, get_params_hash(params),
+               json.dumps(variables, sort_keys=True, default=vars))
+        cached = self.rendered.get(key)
+        if cached is not None and cached[0] is template:
+            self.rendered.move_to_end(key)
+            return cached[1]
+        rendered = template.render(params=params, **variables)
+        if self.cache_size > 0:
+            self.rendered[key] = (template, rendered)
+            if len(self.rendered) > self.cache_size:
+                self.rendered.popitem(last=False)
+        return rendered
+
+
+_registry = TemplateRegistry()
+
+
+def get_registry() -> TemplateRegistry:
+    return _registry
+
+
+def load() -> None:
+    _registry.load()
+
+
+def render(request: JobRequest, binary_data: Any = None) -> str:
+    return _registry.render(
+        generate_params(request), binary_data=binary_data)
@@ -0,0 +1,100 @@
+import os
+import subprocess
+
+from hpc.api.services.binary_data import BinaryData
+import hpc.api.utils.template as template
+from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.service_name import ServiceName
+from hpc.api.openapi.models.job_request_params import JobRequestParams
+
+
+def run(command):
+    return subprocess.run(
+        command, shell=True, capture_output=True, text=True).stdout.strip()
+
+
+def job_params(root_dir="${HOME}/serrano", num_mpi_procs=4):
+    return JobRequestParams(
+        root_dir=root_dir,
+        read_input_data="/in.csv",
+        input_data_double="/double",
+        input_data_float="/float",
+        inference_knn_path="abc",
+        num_mpi_procs=num_mpi_procs,
+    )
+
+
+def test_binary_data_check(tmp_path):
+    (tmp_path / "data").mkdir()
+    input_path = tmp_path / "data" / "in.csv"
+    binary_data = BinaryData(job_params(str(tmp_path)))
+    assert binary_data.stamp_path == str(tmp_path / "data" / "double.hpc-gateway-stamp")
+    assert not binary_data.check(run(binary_data.get_check_command()))
+
+    input_path.write_text("1,2,3\n")
+    assert not binary_data.check(run(binary_data.get_check_command()))
+    # written by the job script after the conversion
+    run("echo \"$(stat -c '%s %Y' {}) {}\" > {}".format(
+        input_path, binary_data.params_hash, binary_data.stamp_path))
+    assert binary_data.check(run(binary_data.get_check_command()))
+
+    other = BinaryData(job_params(str(tmp_path), num_mpi_procs=8))
+    assert not other.check(run(other.get_check_command()))
+
+    input_path.write_text("1,2,3\n4,5,6\n")
+    os.utime(input_path, (1, 1))
+    assert not binary_data.check(run(binary_data.get_check_command()))
+
+
+def test_render_skips_conversion():
+    request = JobRequest(
+        services=[ServiceName.KALMAN],
+        infrastructure="some_infra",
+        params=job_params())
+    binary_data = BinaryData(request.params)
+
+    script = template.render(request, binary_data)
+    assert "# clear binary data: icase=-1" in script
+    assert "rm -f ${binary_data_stamp}" in script
+    assert '&& echo "${binary_data_fingerprint}" > ${binary_data_stamp}' in script
+    assert binary_data.params_hash in script
+
+    binary_data.up_to_date = True
+    script = template.render(request, binary_data)
+    # converted again when the stamp changed since, rather than failing
+    assert "convert_binary_data=0" in script
+    assert 'if [ "${convert_binary_data}" = 1 ]; then' in script
+    assert "# clear binary data: icase=-1" in script
+    assert "exit 1" not in script
+    assert "# run the kernel" in script
+    assert subprocess.run(["bash", "-n"], input=script, text=True).returncode == 0
+
+    script = template.render(request)
+    assert "binary_data_stamp" not in script
+    assert "# clear binary data: icase=-1" in script
+
+
+def test_script_converts_again_when_stamp_changed(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "in.csv").write_text("1,2,3\n")
+    request = JobRequest(
+        services=[ServiceName.KALMAN],
+        infrastructure="some_infra",
+        params=job_params(str(tmp_path)))
+    binary_data = BinaryData(request.params)
+    binary_data.up_to_date = True
+    script = tmp_path / "job.sh"
+    script.write_text(template.render(request, binary_data))
+
+    def run_job():
+        # mpirun prints the stage it runs instead
+        return subprocess.run(
+            ["bash", "-c", 'module() { :; }; mpirun() { echo "icase ${12}"; }; '
+             'source "$1"', "job", str(script)],
+            capture_output=True, text=True).stdout.split("\n")
+
+    # another job converted the input with other parameters
+    (tmp_path / "data" / "double.hpc-gateway-stamp").write_text("other\n")
+    assert run_job()[:3] == ["icase -1", "icase 0", "icase 1"]
+    # the stamp written by the conversion matches, nothing to convert
+    assert run_job()[:1] == ["icase 1"]
@@ -1,14 +1,22 @@
+import json
 import asyncio
 import pytest
 from uuid import UUID
+from pathlib import PurePosixPath
 
 from unittest.mock import patch
 from unittest.mock import DEFAULT
+from unittest.mock import AsyncMock
 
-from hpc.api.services.data_manager import DataManagerFactory
+from hpc.api.services.data_manager import DataManagerFactory, recover
+from hpc.api.services.data_manager import ScheduledTransfer, TransferScheduler
+from hpc.api.services.data_manager import get_object_key, get_relative_path, split_glob
+from hpc.api.services.data_manager import get_bulk_concurrency, BULK_TRANSFER_CONCURRENCY
 import hpc.api.utils.persistence as persistence
 from hpc.api.openapi.models.file_transfer_request import FileTransferRequest
 from hpc.api.openapi.models.s3_file_transfer_request import S3FileTransferRequest
+from hpc.api.openapi.models.file_transfer_status import FileTransferStatus
+from hpc.api.openapi.models.s3_file_transfer_status import S3FileTransferStatus
 from hpc.api.openapi.models.file_transfer_status_code import FileTransferStatusCode
 from hpc.api.openapi.models.s3_result_transfer_request import S3ResultTransferRequest
 
@@ -151,6 +159,41 @@ async def test_unsuccessful_http_file_transfer_sftp_upload_failed(
             break
 
 
+@patch("hpc.api.services.data_manager.TRANSFER_RETRY_DELAY", 0)
+@patch("hpc.api.utils.ssh.sftp_upload")
+@patch("hpc.api.utils.downloader.save_uri")
+@pytest.mark.asyncio
+async def test_http_file_transfer_resumes_after_disconnect(
+    downloader,
+    sftp,
+    submit_ft
+):
+    attempts = []
+
+    async def upload(*args, completed_parts, on_part, **kwargs):
+        attempts.append(set(completed_parts))
+        if len(attempts) == 1:
+            await on_part(0, 4, 10)
+            raise ConnectionResetError()
+        await on_part(4, 4, 10)
+        await on_part(8, 2, 10)
+
+    sftp.side_effect = upload
+    data_manager, _, ft_status = await submit_ft
+    while True:
+        ft_status = await data_manager.get(ft_status.id)
+        if ft_status.status == FileTransferStatusCode.TRANSFERRING:
+            await asyncio.sleep(0.1)
+            continue
+        else:
+            assert ft_status.status == FileTransferStatusCode.COMPLETED
+            assert attempts == [set(), {0}]
+            assert ft_status.progress.total_bytes == 10
+            assert ft_status.progress.transferred_bytes == 10
+            assert ft_status.progress.completed_parts == [0, 4, 8]
+            break
+
+
 @pytest.mark.asyncio
 async def test_non_existent_file_transfer():
     data_manager = DataManagerFactory.get_data_manager(DataManagerFactory.HTTP)
@@ -158,8 +201,8 @@ async def test_non_existent_file_transfer():
         await data_manager.get("non_existent_file")
 
 
-@patch("hpc.api.utils.ssh.sftp_upload", side_effect=sleep)
-@patch("hpc.api.utils.s3.download_file", side_effect=sleep)
+@patch("hpc.api.utils.ssh.sftp_upload_stream", side_effect=sleep)
+@patch("hpc.api.utils.s3.stream_object")
 @pytest.mark.asyncio
 async def test_successful_s3_transfer_waiting_long_execution(
     downloader,
@@ -201,8 +244,8 @@ async def test_successful_s3_transfer_waiting_long_execution(
             break
 
 
-@patch("hpc.api.utils.ssh.sftp_upload")
-@patch("hpc.api.utils.s3.download_file", side_effect=Exception("oops!"))
+@patch("hpc.api.utils.ssh.sftp_upload_stream")
+@patch("hpc.api.utils.s3.stream_object", side_effect=Exception("oops!"))
 @pytest.mark.asyncio
 async def test_unsuccessful_s3_file_transfer_download_file_failed(
     downloader,
@@ -222,8 +265,8 @@ async def test_unsuccessful_s3_file_transfer_download_file_failed(
             break
 
 
-@patch("hpc.api.utils.ssh.sftp_upload", side_effect=Exception("oops!"))
-@patch("hpc.api.utils.s3.download_file")
+@patch("hpc.api.utils.ssh.sftp_upload_stream", side_effect=Exception("oops!"))
+@patch("hpc.api.utils.s3.stream_object")
 @pytest.mark.asyncio
 async def test_unsuccessful_s3_file_transfer_sftp_upload_failed(
     downloader,
@@ -243,6 +286,33 @@ async def test_unsuccessful_s3_file_transfer_sftp_upload_failed(
             break
 
 
+@patch("hpc.api.utils.dataset_cache.DATASET_CACHE_SIZE", 1024)
+@patch("hpc.api.utils.ssh.exec_command", return_value=("hit", ""))
+@patch("hpc.api.utils.s3.head_object", return_value={"ETag": '"etag"'})
+@patch("hpc.api.utils.ssh.sftp_upload_stream")
+@patch("hpc.api.utils.s3.stream_object")
+@pytest.mark.asyncio
+async def test_s3_file_transfer_cache_hit(
+    downloader,
+    sftp,
+    head_object,
+    exec_command,
+    submit_s3_ft
+):
+    data_manager, _, ft_status = await submit_s3_ft
+    assert not ft_status.cache_hit
+    while True:
+        ft_status = await data_manager.get(ft_status.id)
+        if ft_status.status == FileTransferStatusCode.TRANSFERRING:
+            await asyncio.sleep(0.1)
+            continue
+        else:
+            assert ft_status.status == FileTransferStatusCode.COMPLETED
+            assert ft_status.cache_hit
+            sftp.assert_not_called()
+            break
+
+
 @pytest.mark.asyncio
 async def test_non_existent_s3_file_transfer():
     data_manager = DataManagerFactory.get_data_manager(DataManagerFactory.S3)
@@ -341,3 +411,257 @@ async def test_non_existent_s3_result_transfer():
         DataManagerFactory.S3_RESULT)
     with pytest.raises(KeyError):
         await data_manager.get("non_existent_file")
+
+
+@patch("hpc.api.services.data_manager.HTTPDataManager.copy")
+@pytest.mark.asyncio
+async def test_recover_interrupted_transfers(copy, mocker):
+    mocker.patch.object(persistence, "_backend", persistence.MemoryBackend())
+    http_manager = DataManagerFactory.get_data_manager(DataManagerFactory.HTTP)
+    ft_status = FileTransferStatus(
+        id="http-transfer", status=FileTransferStatusCode.TRANSFERRING,
+        infrastructure="slurm", src="https://example.com/in.csv",
+        dst="data/in.csv", reason="")
+    await http_manager.save_status(ft_status)
+    s3_manager = DataManagerFactory.get_data_manager(DataManagerFactory.S3)
+    await s3_manager.save_status(S3FileTransferStatus(
+        id="s3-transfer", status=FileTransferStatusCode.TRANSFERRING,
+        infrastructure="slurm", endpoint="https://s3", bucket="bucket",
+        object="in.csv", region="local", dst="data/in.csv", reason=""))
+
+    assert await recover() == 1
+    await asyncio.sleep(0.01)
+    ft_request = copy.call_args.args[0]
+    assert (ft_request.src, ft_request.dst) == (ft_status.src, ft_status.dst)
+    ft_status = await http_manager.get("http-transfer")
+    assert ft_status.status == FileTransferStatusCode.COMPLETED
+    s3_status = await s3_manager.get("s3-transfer")
+    assert s3_status.status == FileTransferStatusCode.FAILURE
+    assert s3_status.reason == "Interrupted by a restart"
+
+
+@pytest.mark.asyncio
+async def test_recover_more_transfers_than_the_limits(mocker):
+    mocker.patch.object(persistence, "_backend", persistence.MemoryBackend())
+    done = asyncio.Event()
+    copied = []
+
+    async def copy(self, ft_request, ft_status):
+        copied.append(ft_status.id)
+        await done.wait()
+
+    mocker.patch("hpc.api.services.data_manager.HTTPDataManager.copy", new=copy)
+    http_manager = DataManagerFactory.get_data_manager(DataManagerFactory.HTTP)
+    ids = ["t{}".format(i) for i in range(6)]
+    for transfer_id in ids:
+        await http_manager.save_status(FileTransferStatus(
+            id=transfer_id, status=FileTransferStatusCode.TRANSFERRING,
+            infrastructure="slurm", src="https://example.com/in.csv",
+            dst="data/{}.csv".format(transfer_id), reason=""))
+
+    # two of them are queued behind the limit of the infrastructure
+    assert await recover() == 6
+    done.set()
+    for transfer_id in ids:
+        ft_status = await wait_for_transfer(
+            http_manager, await http_manager.get(transfer_id))
+        assert ft_status.status == FileTransferStatusCode.COMPLETED
+    assert sorted(copied) == ids
+
+
+def scheduled_transfer(transfer_id, infrastructure, priority, done):
+    ft_status = FileTransferStatus(
+        id=transfer_id, infrastructure=infrastructure, priority=priority,
+        src="https://example.com/in.csv", dst="in.csv")
+    return ScheduledTransfer(
+        ft_status, done.wait, persistence.get_file_transfer_directory)
+
+
+def record_saves(mocker):
+    """Records the saved statuses and how many of them were saved at once."""
+    saved, batches = [], []
+
+    async def save_many(items):
+        items = list(items)
+        batches.append(len(items))
+        for _, data in items:
+            record = json.loads(data)
+            saved.append((record["id"], record["status"], record["queue_position"]))
+
+    async def save(directory, data):
+        await save_many([(directory, data)])
+
+    mocker.patch("hpc.api.utils.persistence.save", new=save)
+    mocker.patch("hpc.api.utils.persistence.save_many", new=save_many)
+    return saved, batches
+
+
+@pytest.mark.asyncio
+async def test_scheduler_limits_and_priorities(mocker):
+    saved, batches = record_saves(mocker)
+    scheduler = TransferScheduler(concurrency=2, concurrency_per_infrastructure=1)
+    done = asyncio.Event()
+    transfers = [
+        scheduled_transfer("a1", "a", 0, done),
+        scheduled_transfer("a2", "a", 0, done),
+        scheduled_transfer("a3", "a", 5, done),
+        scheduled_transfer("b1", "b", 0, done),
+    ]
+    for transfer in transfers:
+        await scheduler.submit(transfer)
+    statuses = {t.ft_status.id: t.ft_status for t in transfers}
+    assert set(scheduler.running) == {"a1", "b1"}
+    assert statuses["a3"].status == FileTransferStatusCode.QUEUED
+    assert statuses["a3"].queue_position == 0
+    assert statuses["a2"].queue_position == 1
+    assert ("a2", FileTransferStatusCode.QUEUED, 0) in saved
+    # a3 ahead of a2 moves both, their positions are saved at once
+    assert batches[-2:] == [2, 1]
+
+    done.set()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert statuses["a3"].status == FileTransferStatusCode.TRANSFERRING
+    assert statuses["a3"].queue_position is None
+    assert saved.index(("a3", FileTransferStatusCode.TRANSFERRING, None)) < \
+        saved.index(("a2", FileTransferStatusCode.TRANSFERRING, None))
+    assert not scheduler.running and not scheduler.queues
+
+
+@pytest.mark.asyncio
+async def test_scheduler_shares_bandwidth(mocker):
+    scheduler = TransferScheduler(bandwidth=1000)
+    done = asyncio.Event()
+    for transfer_id in ("a1", "a2"):
+        await scheduler.submit(
+            scheduled_transfer(transfer_id, "a", 0, done))
+    sleep = mocker.patch("asyncio.sleep", new=AsyncMock())
+    await scheduler.throttle("a1", 1000)
+    # two transfers running on the infrastructure, half of the bandwidth
+    assert sleep.await_args.args[0] == pytest.approx(2.0, abs=0.1)
+    sleep.reset_mock()
+    await scheduler.throttle("unknown", 1000)
+    sleep.assert_not_awaited()
+    mocker.stopall()
+    done.set()
+
+
+def test_split_glob():
+    assert split_glob("Output_Data") == ("Output_Data", "Output_Data/**/*")
+    assert split_glob("run/Output_Data/") == (
+        "run/Output_Data", "run/Output_Data/**/*")
+    assert split_glob("run/Output_Data/*.csv") == (
+        "run/Output_Data", "run/Output_Data/*.csv")
+    assert split_glob("*.csv") == ("", "*.csv")
+    assert str(get_relative_path("run/Output_Data/a/b.csv", "run/Output_Data")) \
+        == "a/b.csv"
+    with pytest.raises(ValueError):
+        get_relative_path("out/../../etc/passwd", "out/")
+    assert get_object_key("results", PurePosixPath("a/b.csv")) == "results/a/b.csv"
+    assert get_object_key("results/", PurePosixPath("b.csv")) == "results/b.csv"
+    assert get_object_key("", PurePosixPath("b.csv")) == "b.csv"
+
+
+async def wait_for_transfer(data_manager, ft_status):
+    while ft_status.status in (FileTransferStatusCode.QUEUED,
+                               FileTransferStatusCode.TRANSFERRING):
+        await asyncio.sleep(0.01)
+        ft_status = await data_manager.get(ft_status.id)
+    return ft_status
+
+
+@pytest.mark.asyncio
+async def test_s3_prefix_transfer(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    list_objects = mocker.patch("hpc.api.utils.s3.list_objects", return_value=[
+        {"Key": "runs/7/", "Size": 0},
+        {"Key": "runs/7/a.csv", "Size": 10},
+        {"Key": "runs/7/sub/b.csv", "Size": 20},
+    ])
+    exec_command = mocker.patch(
+        "hpc.api.utils.ssh.exec_command", return_value=("", ""))
+    upload = mocker.patch("hpc.api.utils.ssh.sftp_upload_stream")
+    mocker.patch("hpc.api.utils.s3.stream_object")
+    data_manager = DataManagerFactory.get_data_manager(DataManagerFactory.S3)
+    ft_request = S3FileTransferRequest(
+        endpoint="https://s3", bucket="bucket", prefix="runs/7",
+        region="local", access_key="a", secret_key="s", dst="data",
+        infrastructure=ssh_infrastructures[1]["name"])
+
+    ft_status = await wait_for_transfer(
+        data_manager, await data_manager.transfer(ft_request))
+    assert ft_status.status == FileTransferStatusCode.COMPLETED
+    assert ft_status.prefix == "runs/7"
+    # not the objects of runs/70
+    assert list_objects.call_args.args[2] == "runs/7/"
+    assert exec_command.call_args.args[3] == "mkdir -p data data/sub"
+    assert sorted(str(c.args[4]) for c in upload.call_args_list) == [
+        "data/a.csv", "data/sub/b.csv"]
+    assert ft_status.progress.total_files == 2
+    assert ft_status.progress.transferred_files == 2
+    assert ft_status.progress.transferred_bytes == 30
+
+    # nothing below the prefix
+    list_objects.return_value = [{"Key": "runs/7/", "Size": 0}]
+    ft_status = await wait_for_transfer(
+        data_manager, await data_manager.transfer(ft_request))
+    assert ft_status.status == FileTransferStatusCode.FAILURE
+    assert "No objects below the prefix runs/7" in ft_status.reason
+
+    with pytest.raises(ValueError):
+        ft_request.object = "runs/7/a.csv"
+        await data_manager.transfer(ft_request)
+
+
+@pytest.mark.asyncio
+async def test_s3_result_prefix_transfer(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    glob = mocker.patch("hpc.api.utils.ssh.sftp_glob", return_value=[
+        ("Output_Data/a.csv", 10), ("Output_Data/sub/b.csv", 20)])
+    mocker.patch("hpc.api.utils.ssh.sftp_download")
+    upload = mocker.patch("hpc.api.utils.s3.upload_file",
+                          side_effect=[None, ConnectionResetError(), None])
+    mocker.patch("hpc.api.services.data_manager.TRANSFER_RETRY_DELAY", 0)
+    data_manager = DataManagerFactory.get_data_manager(
+        DataManagerFactory.S3_RESULT)
+    rt_request = S3ResultTransferRequest(
+        endpoint="https://s3", bucket="bucket", prefix="results/",
+        region="local", access_key="a", secret_key="s",
+        src="Output_Data", infrastructure=ssh_infrastructures[1]["name"])
+
+    ft_status = await wait_for_transfer(
+        data_manager, await data_manager.transfer(rt_request))
+    assert ft_status.status == FileTransferStatusCode.COMPLETED
+    assert glob.call_args.args[3] == "Output_Data/**/*"
+    assert sorted(set(c.args[3] for c in upload.call_args_list)) == [
+        "results/a.csv", "results/sub/b.csv"]
+    assert ft_status.progress.transferred_files == 2
+    assert ft_status.progress.total_bytes == 30
+
+    # a prefix without a trailing slash is a directory all the same
+    upload.reset_mock(side_effect=True)
+    rt_request.prefix = "results"
+    ft_status = await wait_for_transfer(
+        data_manager, await data_manager.transfer(rt_request))
+    assert ft_status.status == FileTransferStatusCode.COMPLETED
+    assert sorted(c.args[3] for c in upload.call_args_list) == [
+        "results/a.csv", "results/sub/b.csv"]
+
+    # src matching no file, e.g. a single file
+    glob.return_value = []
+    rt_request.src = "Output_Data/a.csv"
+    ft_status = await wait_for_transfer(
+        data_manager, await data_manager.transfer(rt_request))
+    assert ft_status.status == FileTransferStatusCode.FAILURE
+    assert "No files match Output_Data/a.csv" in ft_status.reason
+
+
+@pytest.mark.asyncio
+async def test_bulk_concurrency_leaves_channels_to_commands(mocker):
+    # 4 connections of 8 channels, 8 of them reserved to the commands
+    assert get_bulk_concurrency() == 6
+    mocker.patch("hpc.api.utils.ssh.SFTP_CONCURRENCY", 16)
+    assert get_bulk_concurrency() == 1
+    mocker.patch("hpc.api.utils.ssh.SFTP_CONCURRENCY", 1)
+    assert get_bulk_concurrency() == \
+        BULK_TRANSFER_CONCURRENCY
@@ -0,0 +1,90 @@
+import os
+import subprocess
+import pytest
+from pathlib import Path
+
+from unittest.mock import patch
+
+import aiofiles.tempfile
+
+import hpc.api.utils.dataset_cache as dataset_cache
+from hpc.api.utils.dataset_cache import DatasetCache
+
+
+def run(command):
+    return subprocess.run(
+        command, shell=True, capture_output=True, text=True).stdout.strip()
+
+
+def test_s3_key():
+    head = {"ETag": '"9e107d9d372bb6826bd81d3542a419d6"', "ContentLength": 3}
+    key = dataset_cache.s3_key("https://a", "bucket", "obj", head)
+    # MD5 ETags identify the content wherever it is stored
+    assert key == dataset_cache.s3_key("https://b", "other", "obj2", head)
+    assert key != dataset_cache.s3_key(
+        "https://a", "bucket", "obj", dict(head, ContentLength=4))
+
+    head = {"ETag": '"kms-etag"', "ContentLength": 3, "VersionId": "v1"}
+    key = dataset_cache.s3_key("https://a", "bucket", "obj", head)
+    assert key != dataset_cache.s3_key("https://a", "other", "obj", head)
+    assert key != dataset_cache.s3_key(
+        "https://a", "bucket", "obj", dict(head, VersionId="v2"))
+
+
+@pytest.mark.asyncio
+async def test_file_key():
+    async with aiofiles.tempfile.TemporaryDirectory() as tmp_dir:
+        a, b = Path(tmp_dir) / "a", Path(tmp_dir) / "b"
+        a.write_text("same")
+        b.write_text("same")
+        assert await dataset_cache.file_key(a) == \
+            await dataset_cache.file_key(b)
+        b.write_text("other")
+        assert await dataset_cache.file_key(a) != \
+            await dataset_cache.file_key(b)
+
+
+@pytest.mark.asyncio
+async def test_cache_commands():
+    async with aiofiles.tempfile.TemporaryDirectory() as tmp_dir:
+        cache = DatasetCache(f"{tmp_dir}/cache", max_size=10)
+        src = Path(tmp_dir) / "input.csv"
+        src.write_text("123456")
+        dst = Path(tmp_dir) / "run 2" / "input.csv"
+
+        assert run(cache.get_fetch_command("key1", dst)) == ""
+        run(cache.get_store_command("key1", src))
+        assert run(cache.get_fetch_command("key1", dst)) == "hit"
+        assert dst.read_text() == "123456"
+        # rewriting the destination in place leaves the entry alone
+        with dst.open("r+") as f:
+            f.write("XX")
+        assert Path(cache.get_entry("key1")).read_text() == "123456"
+        assert run(cache.get_fetch_command("key1", dst)) == "hit"
+        assert dst.read_text() == "123456"
+        with src.open("r+") as f:
+            f.write("XX")
+        assert Path(cache.get_entry("key1")).read_text() == "123456"
+
+        os.utime(cache.get_entry("key1"), (0, 0))
+        other = Path(tmp_dir) / "other.csv"
+        other.write_text("abcdef")
+        run(cache.get_store_command("key2", other))
+        # over the size budget, the least recently used entry is evicted
+        assert not Path(cache.get_entry("key1")).exists()
+        assert Path(cache.get_entry("key2")).exists()
+
+
+@patch("hpc.api.utils.ssh.exec_command", side_effect=Exception("oops!"))
+@pytest.mark.asyncio
+async def test_cache_store_failure_is_ignored(exec_command, ssh_infrastructures):
+    cache = DatasetCache("/tmp/cache", max_size=10)
+    await cache.store("host", "user", None, "key", Path("/tmp/file"))
+    exec_command.assert_awaited_once()
+
+
+def test_cache_disabled_by_default():
+    with patch("hpc.api.utils.dataset_cache.DATASET_CACHE_SIZE", 0):
+        assert not dataset_cache.get_cache().enabled
+    with patch("hpc.api.utils.dataset_cache.DATASET_CACHE_SIZE", 1):
+        assert dataset_cache.get_cache().enabled
@@ -0,0 +1,74 @@
+import asyncio
+import subprocess
+import pytest
+
+import hpc.api.services.delta_sync as delta_sync
+from hpc.api.services.data_manager import DataManagerFactory
+from hpc.api.openapi.models.file_transfer_request import FileTransferRequest
+from hpc.api.openapi.models.file_transfer_status_code import FileTransferStatusCode
+
+
+def run(command, cwd):
+    return subprocess.run(
+        command, shell=True, capture_output=True, text=True, cwd=cwd).stdout
+
+
+def remote_blocks(tmp_path, name, block_size):
+    return delta_sync.parse_digests(
+        run(delta_sync.get_digests_command(name, block_size), tmp_path),
+        block_size)
+
+
+def test_unchanged_blocks_of_appended_file(tmp_path):
+    (tmp_path / "remote.csv").write_bytes(b"a" * 10 + b"b" * 10 + b"c" * 5)
+    local = tmp_path / "local.csv"
+    local.write_bytes(b"a" * 10 + b"B" * 10 + b"c" * 5 + b"d" * 12)
+
+    remote = remote_blocks(tmp_path, "remote.csv", 10)
+    assert remote.size == 25
+    assert len(remote.digests) == 3
+    # the second block changed, the last remote block was appended to
+    assert delta_sync.get_unchanged_blocks(local, remote) == [0]
+
+    assert remote_blocks(tmp_path, "missing.csv", 10).digests == []
+
+
+@pytest.mark.asyncio
+async def test_changed_blocks_of_stream():
+    remote = delta_sync.RemoteBlocks(
+        8, [delta_sync.hashlib.md5(b"abcd").hexdigest(),
+            delta_sync.hashlib.md5(b"efgh").hexdigest()], 4)
+
+    async def chunks():
+        for chunk in (b"ab", b"cdeXgh", b"ij"):
+            yield chunk
+
+    blocks = [b async for b in delta_sync.changed_blocks(chunks(), remote)]
+    assert blocks == [(0, 4, None), (4, 4, b"eXgh"), (8, 2, b"ij")]
+
+
+@pytest.mark.asyncio
+async def test_http_sync_sends_changed_blocks(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    mocker.patch.object(delta_sync, "SYNC_BLOCK_SIZE", 4)
+
+    async def save_uri(src, local_dst):
+        local_dst.write_bytes(b"abcdefghij")
+
+    digests = "8\n{}\n{}".format(
+        delta_sync.hashlib.md5(b"abcd").hexdigest(),
+        delta_sync.hashlib.md5(b"efgh").hexdigest())
+    mocker.patch("hpc.api.utils.downloader.save_uri", new=save_uri)
+    mocker.patch("hpc.api.utils.ssh.exec_command", return_value=(digests, ""))
+    upload = mocker.patch("hpc.api.utils.ssh.sftp_upload")
+    data_manager = DataManagerFactory.get_data_manager(DataManagerFactory.HTTP)
+
+    ft_status = await data_manager.transfer(FileTransferRequest(
+        src="https://example.com/log.csv", dst="data/log.csv",
+        infrastructure=ssh_infrastructures[1]["name"], sync=True))
+    while ft_status.status != FileTransferStatusCode.COMPLETED:
+        await asyncio.sleep(0.01)
+        ft_status = await data_manager.get(ft_status.id)
+    assert upload.call_args.kwargs["completed_parts"] == {0, 4}
+    assert upload.call_args.kwargs["part_size"] == 4
+    assert ft_status.progress.reused_bytes == 8
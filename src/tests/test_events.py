@@ -0,0 +1,117 @@
+import json
+import asyncio
+import pytest
+from functools import partial
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import hpc.api.utils.events as events
+import hpc.api.utils.persistence as persistence
+import hpc.api.services.event_stream as event_stream
+import hpc.api.services.job as job
+from hpc.api.openapi.models.job_status import JobStatus
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+
+
+async def save_job(id, status, infrastructure="cluster"):
+    await persistence.save(
+        persistence.get_job_directory(id),
+        json.dumps({"id": id, "status": status,
+                    "infrastructure": infrastructure}))
+
+
+@pytest.mark.asyncio
+async def test_subscription_filters():
+    bus = events.get_bus()
+    by_id = bus.subscribe(events.Subscription(ids=["a"]))
+    by_infrastructure = bus.subscribe(
+        events.Subscription(infrastructure="other"))
+    by_kind = bus.subscribe(
+        events.Subscription(kinds=[events.FILE_TRANSFER]))
+    try:
+        await save_job("a", "QUEUED")
+        await save_job("b", "QUEUED", infrastructure="other")
+        await persistence.save(
+            persistence.get_cluster_directory("cluster"), json.dumps({}))
+
+        event = by_id.queue.get_nowait()
+        assert (event.kind, event.id, event.data["status"]) == \
+            (events.JOB, "a", "QUEUED")
+        assert by_id.queue.empty()
+        assert by_infrastructure.queue.get_nowait().id == "b"
+        assert by_infrastructure.queue.empty()
+        assert by_kind.queue.empty()
+    finally:
+        for subscription in (by_id, by_infrastructure, by_kind):
+            bus.unsubscribe(subscription)
+
+
+def test_subscription_drops_oldest():
+    subscription = events.Subscription(max_size=2)
+    for i in range(3):
+        subscription.put(events.Event(events.JOB, str(i), {"id": str(i)}))
+    assert [subscription.queue.get_nowait().id for _ in range(2)] == ["1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_event_stream():
+    async def handler(request):
+        return await event_stream.stream(request, ids=["job-1"], heartbeat=0.05)
+
+    app = web.Application()
+    app.router.add_get("/events", handler)
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/events")
+        assert response.headers["Content-Type"] == "text/event-stream"
+        assert await response.content.readline() == b": connected\n"
+        await response.content.readline()
+
+        await save_job("job-2", "RUNNING")
+        await save_job("job-1", "RUNNING")
+        lines = [await response.content.readline() for _ in range(3)]
+        assert lines[0] == b"event: job\n"
+        assert lines[1] == b"id: job-1\n"
+        assert json.loads(lines[2][len(b"data: "):])["status"] == "RUNNING"
+
+        await response.content.readline()
+        # idle streams get keep-alive comments
+        assert await asyncio.wait_for(
+            response.content.readline(), 1) == b": keep-alive\n"
+        response.close()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_change():
+    status = JobStatus(id="job-w", scheduler_id="1", infrastructure="cluster",
+                       status=JobStatusCode.QUEUED)
+    await job.save_status(status)
+    get = partial(job.get, "job-w")
+
+    async def complete_later():
+        await asyncio.sleep(0.05)
+        status.status = JobStatusCode.RUNNING
+        await job.save_status(status)
+        await asyncio.sleep(0.05)
+        status.status = JobStatusCode.COMPLETED
+        await job.save_status(status)
+
+    # already differs, no waiting
+    res = await events.wait_for_change(
+        get, events.JOB, "job-w", 10, JobStatusCode.RUNNING)
+    assert res.status == JobStatusCode.QUEUED
+
+    task = asyncio.ensure_future(complete_later())
+    res = await events.wait_for_change(get, events.JOB, "job-w", 10)
+    assert res.status == JobStatusCode.RUNNING
+    res = await events.wait_for_change(
+        get, events.JOB, "job-w", 10, JobStatusCode.RUNNING)
+    assert res.status == JobStatusCode.COMPLETED
+    await task
+
+    start = asyncio.get_event_loop().time()
+    res = await events.wait_for_change(
+        get, events.JOB, "job-w", 0.1, JobStatusCode.COMPLETED)
+    assert res.status == JobStatusCode.COMPLETED
+    assert asyncio.get_event_loop().time() - start >= 0.1
+    assert not events.get_bus().subscriptions
@@ -5,7 +5,9 @@ import asyncio
 
 import hpc.api.services.job as job
 from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_batch_request import JobBatchRequest
 from hpc.api.openapi.models.service_name import ServiceName
+from hpc.api.openapi.models.job_status import JobStatus
 from hpc.api.openapi.models.job_status_code import JobStatusCode
 import hpc.api.utils.persistence as persistence
 from hpc.api.openapi.models.job_request_params import *
@@ -20,38 +22,42 @@ async def mock_ssh_command_new_scheduler_id_slurm(*args, **kwargs):
 
 
 async def mock_ssh_command_job_status_pbs(*args, **kwargs):
-    return "C", ""
+    return "Job Id: some_id\n    job_state = C", ""
 
 
 async def mock_ssh_command_job_status_slurm(*args, **kwargs):
-    return "COMPLETED", ""
+    return "1763|COMPLETED", ""
 
 
 def ssh_pbs_calls_responses(n):
+    # binary data check
+    yield "", ""
     i = 0
     while i < n:
         if i == 0:
             yield "some_id", ""
         elif i < 3:
-            yield "Q", ""
+            yield "Job Id: some_id\n    job_state = Q", ""
         elif i < 5:
-            yield "R", ""
+            yield "Job Id: some_id\n    job_state = R", ""
         else:
-            yield "C", ""
+            yield "Job Id: some_id\n    job_state = C", ""
         i += 1
 
 
 def ssh_slurm_calls_responses(n):
+    # binary data check
+    yield "", ""
     i = 0
     while i < n:
         if i == 0:
             yield "Submitted batch job 1763", ""
         elif i < 3:
-            yield "PENDING", ""
+            yield "1763|PENDING", ""
         elif i < 5:
-            yield "RUNNING", ""
+            yield "1763|RUNNING", ""
         else:
-            yield "COMPLETED", ""
+            yield "1763|COMPLETED", ""
         i += 1
 
 
@@ -144,3 +150,274 @@ async def test_job_submission_slurm(ssh_mock, submit_slurm_job):
 async def test_non_existent_job():
     with pytest.raises(KeyError):
         await job.get("non_existent_infrastructure")
+
+
+@pytest.mark.asyncio
+async def test_poller_single_query_for_all_jobs(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[1]["name"]
+    commands = []
+
+    async def exec_command(host, username, pkey, command):
+        commands.append(command)
+        return "101|RUNNING\n102|PENDING\n103|COMPLETED", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    save_mock = mocker.patch("hpc.api.services.job.save_status")
+    poller = job.JobStatusPoller(infrastructure)
+    for scheduler_id in ["101", "102", "103"]:
+        poller.jobs[scheduler_id] = job.TrackedJob(JobStatus(
+            id=scheduler_id, scheduler_id=scheduler_id,
+            infrastructure=infrastructure, status=JobStatusCode.QUEUED), 0.1)
+    await poller.poll()
+
+    assert len(commands) == 1
+    assert commands[0].startswith("sacct")
+    assert "101,102,103" in commands[0]
+    saved = sorted(c.args[0].scheduler_id for c in save_mock.call_args_list)
+    assert saved == ["101", "103"]
+    assert set(poller.jobs) == {"101", "102"}
+
+
+@pytest.mark.asyncio
+async def test_poller_completes_jobs_missing_from_scheduler(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]["name"]
+
+    async def exec_command(*args, **kwargs):
+        return "Job Id: 1.server\n    job_state = R", "qstat: Unknown Job Id 2.server"
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    mocker.patch("hpc.api.services.job.save_status")
+    poller = job.JobStatusPoller(infrastructure)
+    for scheduler_id in ["1.server", "2.server"]:
+        poller.jobs[scheduler_id] = job.TrackedJob(JobStatus(
+            id=scheduler_id, scheduler_id=scheduler_id,
+            infrastructure=infrastructure, status=JobStatusCode.RUNNING), 0.1)
+    purged = poller.jobs["2.server"].job_status
+    for _ in range(job.MISSING_TICKS_LIMIT):
+        assert "2.server" in poller.jobs
+        await poller.poll()
+    assert "2.server" not in poller.jobs
+    assert purged.status == JobStatusCode.COMPLETED
+    assert poller.jobs["1.server"].job_status.status == JobStatusCode.RUNNING
+
+
+@pytest.mark.asyncio
+async def test_poller_tolerates_unknown_job_errors(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]["name"]
+    stderr = "qstat: Unknown Job Id 1.server\nqstat: 2.server Job has finished, use -x or -H to obtain historical job information\n"
+
+    async def exec_command(*args, **kwargs):
+        return "", stderr
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    mocker.patch("hpc.api.services.job.save_status")
+    poller = job.JobStatusPoller(infrastructure)
+    for scheduler_id in ["1.server", "2.server"]:
+        poller.jobs[scheduler_id] = job.TrackedJob(JobStatus(
+            id=scheduler_id, scheduler_id=scheduler_id,
+            infrastructure=infrastructure, status=JobStatusCode.RUNNING), 0.1)
+    statuses = [t.job_status for t in poller.jobs.values()]
+    for _ in range(job.MISSING_TICKS_LIMIT):
+        await poller.poll()
+    assert not poller.jobs
+    assert all(s.status == JobStatusCode.COMPLETED for s in statuses)
+
+    stderr = "qstat: cannot connect to server"
+    poller.jobs["3.server"] = job.TrackedJob(JobStatus(
+        id="3.server", scheduler_id="3.server",
+        infrastructure=infrastructure, status=JobStatusCode.RUNNING), 0.1)
+    with pytest.raises(RuntimeError):
+        await poller.poll()
+
+
+@pytest.mark.asyncio
+async def test_poller_queries_only_due_jobs(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[1]["name"]
+    commands = []
+
+    async def exec_command(host, username, pkey, command):
+        commands.append(command)
+        return "201|PENDING\n202|RUNNING|00:00:10|01:00:00", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    poller = job.JobStatusPoller(infrastructure)
+    due = job.TrackedJob(JobStatus(
+        id="201", scheduler_id="201",
+        infrastructure=infrastructure, status=JobStatusCode.QUEUED), 0.1)
+    later = job.TrackedJob(JobStatus(
+        id="202", scheduler_id="202",
+        infrastructure=infrastructure, status=JobStatusCode.QUEUED), 100.0)
+    later.due = poller.loop.time() + 100.0
+    poller.jobs = {"201": due, "202": later}
+    assert poller.due_jobs() == ["201"]
+    await poller.poll(poller.due_jobs())
+    assert "-j 201" in commands[0]
+    assert due.unchanged_polls == 1
+    assert later.unchanged_polls == 0
+
+
+def batch_job_request(infrastructure, perforation_stride):
+    return JobRequest(
+        services=[ServiceName.KALMAN],
+        infrastructure=infrastructure,
+        params=JobRequestParams(
+            read_input_data="abc",
+            input_data_double="abc",
+            input_data_float="abc",
+            inference_knn_path="abc",
+            perforation_stride=perforation_stride,
+        ),
+        watch_period=0.1
+    )
+
+
+@pytest.mark.asyncio
+async def test_batch_submission_single_connection(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    pbs, slurm = ssh_infrastructures[0]["name"], ssh_infrastructures[1]["name"]
+    commands = []
+
+    async def exec_command(host, username, pkey, command):
+        if command.startswith("echo"):
+            return "", ""
+        commands.append(command)
+        if command.startswith("sbatch"):
+            if "perforation_stride=1" in command:
+                return "", "sbatch: error: invalid partition"
+            if "perforation_stride=2" in command:
+                return "Submitted batch job 13", ""
+            return "Submitted batch job 11", "sbatch: warning: default account"
+        return "5.server", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    watch_mock = mocker.patch("hpc.api.services.job.watch_job_status")
+    requests = [batch_job_request(slurm, 0), batch_job_request(pbs, 1)]
+    job_results = await job.submit_batch(JobBatchRequest(jobs=requests))
+    assert [r.job.scheduler_id for r in job_results] == ["11", "5.server"]
+    assert [r.job.infrastructure for r in job_results] == [slurm, pbs]
+    assert len(commands) == 2
+
+    commands.clear()
+    requests = [batch_job_request(slurm, i) for i in range(3)]
+    job_results = await job.submit_batch(JobBatchRequest(jobs=requests))
+    assert len(commands) == 3
+    assert all(c.count("sbatch <<") == 1 for c in commands)
+    # the submitted jobs are returned along with the error of the other
+    assert job_results[0].job.scheduler_id == "11"
+    assert job_results[1].job is None
+    assert job_results[1].error == \
+        "The job was not submitted: sbatch: error: invalid partition"
+    assert job_results[2].job.scheduler_id == "13"
+    assert await job.get(job_results[2].job.id)
+    tracked = [c.args[0].scheduler_id for c in watch_mock.call_args_list]
+    assert tracked[-2:] == ["11", "13"]
+
+    # a script that cannot be rendered fails its own job only
+    render = job.template.render
+
+    def render_mock(job_request, job_binary_data):
+        if job_request.params.perforation_stride == 0:
+            raise ValueError("undefined template variable")
+        return render(job_request, job_binary_data)
+
+    mocker.patch("hpc.api.utils.template.render", new=render_mock)
+    commands.clear()
+    requests = [batch_job_request(slurm, 0), batch_job_request(slurm, 2)]
+    job_results = await job.submit_batch(JobBatchRequest(jobs=requests))
+    assert len(commands) == 1
+    assert "undefined template variable" in job_results[0].error
+    assert job_results[1].job.scheduler_id == "13"
+    mocker.patch("hpc.api.utils.template.render", new=render)
+
+    # an unknown infrastructure fails its own jobs only
+    requests = [batch_job_request("missing", 1), batch_job_request(pbs, 1)]
+    job_results = await job.submit_batch(JobBatchRequest(jobs=requests))
+    assert job_results[0].job is None and job_results[0].error
+    assert job_results[1].job.scheduler_id == "5.server"
+
+
+@pytest.mark.asyncio
+async def test_batch_submission_array(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    pbs, slurm = ssh_infrastructures[0]["name"], ssh_infrastructures[1]["name"]
+    commands = []
+
+    async def exec_command(host, username, pkey, command):
+        if command.startswith("echo"):
+            return "", ""
+        commands.append(command)
+        if command.startswith("sbatch"):
+            return "Submitted batch job 20", ""
+        return "7[].server", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    mocker.patch("hpc.api.services.job.watch_job_status")
+    requests = [batch_job_request(slurm, i) for i in range(3)]
+    job_results = await job.submit_batch(
+        JobBatchRequest(jobs=requests, array=True))
+    assert [r.job.scheduler_id for r in job_results] == ["20_0", "20_1", "20_2"]
+    assert commands[0].startswith("sbatch --array=0-2 <<")
+    assert 'case "$SLURM_ARRAY_TASK_ID" in' in commands[0]
+    assert commands[0].index("#SBATCH") < commands[0].index("case")
+    assert "2)\nicase=1" in commands[0]
+    assert await job.get(job_results[2].job.id)
+
+    requests = [batch_job_request(pbs, i) for i in range(2)]
+    job_results = await job.submit_batch(
+        JobBatchRequest(jobs=requests, array=True))
+    assert [r.job.scheduler_id for r in job_results] == ["7[0].server", "7[1].server"]
+    assert commands[1].startswith("qsub -J 0-1 <<")
+
+
+@pytest.mark.asyncio
+async def test_sequential_submission(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    slurm = ssh_infrastructures[1]["name"]
+    commands = []
+
+    async def exec_command(host, username, pkey, command):
+        if command.startswith("echo"):
+            return "", ""
+        commands.append(command)
+        if len(commands) == 2:
+            return "", "sbatch: error: invalid partition"
+        return "Submitted batch job {}".format(40 + len(commands)), ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    mocker.patch("hpc.api.services.job.watch_job_status")
+    requests = [batch_job_request(slurm, i) for i in range(3)]
+    job_results = await job.submit_group(slurm, requests, sequential=True)
+    # every job waits for the previously submitted one
+    assert commands[0].startswith("sbatch <<")
+    assert commands[1].startswith("sbatch --dependency=afterany:41 <<")
+    assert commands[2].startswith("sbatch --dependency=afterany:41 <<")
+    assert job_results[0].job.scheduler_id == "41"
+    assert "invalid partition" in job_results[1].error
+    assert job_results[2].job.scheduler_id == "43"
+
+
+def test_split_script():
+    directives, commands = job.split_script(
+        "#!/bin/bash\n#SBATCH -N 1\n\n# comment\nicase=1\n# other\n")
+    assert directives == "#!/bin/bash\n#SBATCH -N 1\n\n# comment"
+    assert commands == "icase=1\n# other\n"
+
+
+@pytest.mark.asyncio
+async def test_recover_watches_unfinished_jobs(mocker):
+    mocker.patch.object(persistence, "_backend", persistence.MemoryBackend())
+    for job_id, status in [("301", JobStatusCode.QUEUED),
+                           ("302", JobStatusCode.RUNNING),
+                           ("303", JobStatusCode.COMPLETED)]:
+        await job.save_status(JobStatus(
+            id=job_id, scheduler_id=job_id, infrastructure="slurm",
+            status=status))
+    watch_mock = mocker.patch("hpc.api.services.job.watch_job_status")
+
+    assert await job.recover() == 2
+    watched = sorted(c.args[0].id for c in watch_mock.call_args_list)
+    assert watched == ["301", "302"]
@@ -1,3 +1,7 @@
+import json
+import time
+import asyncio
+import sqlite3
 import pytest
 
 import hpc.api.utils.persistence as persistence
@@ -19,3 +23,98 @@ async def test_entry_creation():
 async def test_non_existent_entry():
     with pytest.raises(KeyError):
         await persistence.get("non-existent")
+
+
+def job_record(id, status, infrastructure):
+    return json.dumps({
+        "id": id, "status": status, "infrastructure": infrastructure})
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return persistence.MemoryBackend()
+    return persistence.SqliteBackend(str(tmp_path / "storage.db"))
+
+
+@pytest.mark.asyncio
+async def test_backend_find_by_indexes(backend):
+    collection = persistence.get_jobs_collection()
+    await backend.save_many([
+        (persistence.get_job_directory("1"), job_record("1", "queued", "a")),
+        (persistence.get_job_directory("2"), job_record("2", "running", "a")),
+        (persistence.get_job_directory("3"), job_record("3", "queued", "b")),
+        (persistence.get_s3_transfer_directory("4"),
+         job_record("4", "queued", "a")),
+    ])
+    await backend.save(
+        persistence.get_job_directory("2"), job_record("2", "completed", "a"))
+
+    def ids(records):
+        return sorted(json.loads(r)["id"] for r in records)
+
+    assert ids(await backend.find(collection)) == ["1", "2", "3"]
+    assert ids(await backend.find(collection, status="queued")) == ["1", "3"]
+    assert ids(await backend.find(collection, status="running")) == []
+    assert ids(await backend.find(
+        collection, status="queued", infrastructure="a")) == ["1"]
+    assert ids(await backend.find(
+        collection, created_after=time.time() + 60)) == []
+    assert json.loads(await backend.get(
+        persistence.get_job_directory("2")))["status"] == "completed"
+    with pytest.raises(KeyError):
+        await backend.get(persistence.get_job_directory("5"))
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_backend_is_durable(tmp_path):
+    path = str(tmp_path / "storage.db")
+    backend = persistence.SqliteBackend(path)
+    directory = persistence.get_job_directory("1")
+    await asyncio.gather(*[
+        backend.save(directory, job_record("1", status, "a"))
+        for status in ["queued", "running"]])
+    await backend.close()
+
+    backend = persistence.SqliteBackend(path)
+    assert json.loads(await backend.get(directory))["status"] == "running"
+    with sqlite3.connect(path) as db:
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_find_in_creation_order(mocker):
+    backend = persistence.MemoryBackend()
+    collection = persistence.get_jobs_collection()
+    clock = mocker.patch("time.time")
+    for i, status in enumerate(["queued", "running", "queued", "queued"]):
+        clock.return_value = float(i)
+        await backend.save(persistence.get_job_directory(str(i)),
+                           job_record(str(i), status, "a"))
+
+    def ids(records):
+        return [json.loads(r)["id"] for r in records]
+
+    assert ids(await backend.find(collection, status="queued")) == ["0", "2", "3"]
+    assert ids(await backend.find(
+        collection, status="queued", created_after=0.0,
+        created_before=3.0)) == ["2"]
+    assert ids(await backend.find(
+        collection, created_after=0.0, created_before=3.0)) == ["1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_sqlite_flush_after_close(tmp_path):
+    backend = persistence.SqliteBackend(str(tmp_path / "storage.db"), 10.0)
+    directory = persistence.get_job_directory("1")
+    save = asyncio.ensure_future(
+        backend.save(directory, job_record("1", "queued", "a")))
+    await asyncio.sleep(0)
+    # the batch window elapsed while closing
+    backend._schedule_flush()
+    await backend.close()
+    await save
+    await asyncio.sleep(0)
+    await backend._flush()
@@ -0,0 +1,30 @@
+from hpc.api.utils.polling import PollingPolicy
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+
+
+def test_queued_job_backs_off_exponentially():
+    policy = PollingPolicy(max_period=100.0, backoff=2.0, jitter=0)
+    delays = [
+        policy.next_delay(JobStatusCode.QUEUED, 10.0, polls)
+        for polls in range(5)]
+    assert delays == [10.0, 20.0, 40.0, 80.0, 100.0]
+
+
+def test_backoff_never_below_requested_period():
+    policy = PollingPolicy(max_period=5.0, backoff=2.0, jitter=0)
+    assert policy.next_delay(JobStatusCode.QUEUED, 10.0, 3) == 10.0
+
+
+def test_running_job_bounded_by_time_left():
+    policy = PollingPolicy(max_period=300.0, backoff=2.0, jitter=0)
+    assert policy.next_delay(JobStatusCode.RUNNING, 10.0, 10, 3600) == 300.0
+    assert policy.next_delay(JobStatusCode.RUNNING, 10.0, 10, 200) == 100.0
+    # close to the time limit -> poll at the requested period
+    assert policy.next_delay(JobStatusCode.RUNNING, 10.0, 10, 30) == 10.0
+
+
+def test_jitter_spreads_polls():
+    policy = PollingPolicy(max_period=300.0, backoff=2.0, jitter=0.1)
+    delays = {policy.next_delay(JobStatusCode.QUEUED, 10.0) for _ in range(20)}
+    assert len(delays) > 1
+    assert all(9.0 <= d <= 11.0 for d in delays)
@@ -0,0 +1,124 @@
+import os
+import json
+import asyncio
+import subprocess
+import pytest
+from pathlib import Path
+
+import hpc.api.services.remote_pull as remote_pull
+import hpc.api.utils.persistence as persistence
+from hpc.api.services.data_manager import DataManagerFactory
+from hpc.api.openapi.models.file_transfer_request import FileTransferRequest
+from hpc.api.openapi.models.file_transfer_status_code import FileTransferStatusCode
+from hpc.api.openapi.models.transfer_strategy import TransferStrategy
+
+
+def local_exec_command(cwd, commands, outputs=None):
+    # runs the commands meant for the login node in cwd
+    outputs = [] if outputs is None else outputs
+    async def exec_command(host, username, pkey, command, input=None):
+        commands.append(command)
+        result = subprocess.run(
+            command, shell=True, capture_output=True, text=True, cwd=cwd,
+            input=input)
+        outputs.append(result.stdout)
+        return result.stdout.rstrip(), result.stderr.rstrip()
+    return exec_command
+
+
+@pytest.mark.asyncio
+async def test_pull_downloads_on_the_infrastructure(tmp_path, mocker):
+    source = tmp_path / "source.csv"
+    source.write_text("1,2,3\n")
+    commands = []
+    mocker.patch("hpc.api.utils.ssh.exec_command",
+                 new=local_exec_command(tmp_path, commands))
+    mocker.patch.object(remote_pull, "PULL_POLL_PERIOD", 0.05)
+    sizes = []
+
+    async def on_progress(size):
+        sizes.append(size)
+
+    await remote_pull.pull(
+        "host", "user", None, source.as_uri(), Path("data dir/in.csv"),
+        on_progress)
+    assert (tmp_path / "data dir" / "in.csv").read_text() == "1,2,3\n"
+    assert sorted(p.name for p in (tmp_path / "data dir").iterdir()) == ["in.csv"]
+    # the url, a presigned one holds credentials, is not on a command line
+    assert not any(source.as_uri() in command for command in commands)
+
+    with pytest.raises(remote_pull.RemotePullError):
+        await remote_pull.pull(
+            "host", "user", None, (tmp_path / "missing").as_uri(),
+            Path("out.csv"))
+    assert not (tmp_path / "out.csv").exists()
+
+
+@pytest.mark.asyncio
+async def test_pull_stops_without_exit_status(tmp_path, mocker):
+    # reading a fifo without writer blocks the download
+    source = tmp_path / "source.fifo"
+    os.mkfifo(source)
+    commands, outputs = [], []
+    mocker.patch("hpc.api.utils.ssh.exec_command",
+                 new=local_exec_command(tmp_path, commands, outputs))
+    mocker.patch.object(remote_pull, "PULL_POLL_PERIOD", 0.05)
+
+    mocker.patch.object(remote_pull, "PULL_TIMEOUT", 0.2)
+    with pytest.raises(remote_pull.RemotePullTimeout):
+        await remote_pull.pull(
+            "host", "user", None, source.as_uri(), Path("timeout.csv"))
+    assert "kill {}".format(outputs[0].strip()) in commands[-1]
+
+    # the download was killed on the login node
+    mocker.patch.object(remote_pull, "PULL_TIMEOUT", 0)
+    commands.clear()
+    outputs.clear()
+    pull = asyncio.ensure_future(remote_pull.pull(
+        "host", "user", None, source.as_uri(), Path("killed.csv")))
+    await asyncio.sleep(0.1)
+    pid = outputs[0].strip()
+    subprocess.run("kill -9 $(pgrep -P {0}) {0}".format(pid), shell=True)
+    with pytest.raises(remote_pull.RemotePullError, match="killed"):
+        await asyncio.wait_for(pull, 2)
+
+    # the directory cannot be created
+    (tmp_path / "file").write_text("")
+    with pytest.raises(remote_pull.RemotePullError, match="Starting"):
+        await remote_pull.pull(
+            "host", "user", None, source.as_uri(), Path("file/out.csv"))
+
+
+@pytest.mark.asyncio
+async def test_http_transfer_strategy(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = dict(ssh_infrastructures[1], name="pull-infrastructure",
+                          transfer_strategy=TransferStrategy.REMOTE_PULL)
+    await persistence.save(
+        persistence.get_cluster_directory(infrastructure["name"]),
+        json.dumps(infrastructure))
+    pull = mocker.patch("hpc.api.services.remote_pull.pull")
+    save_uri = mocker.patch("hpc.api.utils.downloader.save_uri")
+    mocker.patch("hpc.api.services.data_manager.sftp_upload")
+    data_manager = DataManagerFactory.get_data_manager(DataManagerFactory.HTTP)
+    ft_request = FileTransferRequest(
+        src="https://example.com/in.csv", dst="data/in.csv",
+        infrastructure=infrastructure["name"])
+
+    async def transfer():
+        ft_status = await data_manager.transfer(ft_request)
+        while ft_status.status != FileTransferStatusCode.COMPLETED:
+            await asyncio.sleep(0.01)
+            ft_status = await data_manager.get(ft_status.id)
+        return ft_status
+
+    ft_status = await transfer()
+    assert ft_status.strategy == TransferStrategy.REMOTE_PULL
+    assert pull.call_args.args[3] == ft_request.src
+    save_uri.assert_not_called()
+
+    # the relay is the fallback
+    pull.side_effect = remote_pull.RemotePullError("curl: (6) Could not resolve host")
+    ft_status = await transfer()
+    assert ft_status.strategy == TransferStrategy.RELAY
+    save_uri.assert_called_once()
@@ -1,3 +1,4 @@
+import time
 import pytest
 import hpc.api.utils.resource_parser as parser
 from hpc.api.openapi.models.node_state_code import NodeStateCode
@@ -98,4 +99,204 @@ def test_slurm_jobs_parser(slurm_jobs):
     assert jobs[2].nodelist == ""
     assert jobs[2].partition == "profile"
     assert jobs[2].state == JobStatusCode.QUEUED
-    assert jobs[2].schednodes == "node01"
\ No newline at end of file
+    assert jobs[2].schednodes == "node01"
+
+def test_parse_duration():
+    assert parser.parse_duration("59:51") == 59 * 60 + 51
+    assert parser.parse_duration("1:00:00") == 3600
+    assert parser.parse_duration("2-01:00:00") == 2 * 86400 + 3600
+    assert parser.parse_duration("30") == 30 * 60
+    assert parser.parse_duration("UNLIMITED") is None
+    assert parser.parse_duration("Partition_Limit") is None
+
+def test_slurm_jobs_status_parser():
+    statuses = parser.get_slurm_jobs_status(
+        "1775|RUNNING|00:50:00|01:00:00\n1776|PENDING|00:00:00|UNLIMITED")
+    assert statuses["1775"].state == "RUNNING"
+    assert statuses["1775"].time_left == 600
+    assert statuses["1776"].state == "PENDING"
+    assert statuses["1776"].time_left is None
+
+def test_slurm_array_jobs_status_parser():
+    assert parser.expand_slurm_array_ids("7_[0-2,5,8-12:2%4]") == [
+        "7_0", "7_1", "7_2", "7_5", "7_8", "7_10", "7_12"]
+    statuses = parser.get_slurm_jobs_status("7_[1-2]|PENDING\n7_0|RUNNING")
+    assert {k: v.state for k, v in statuses.items()} == {
+        "7_0": "RUNNING", "7_1": "PENDING", "7_2": "PENDING"}
+    statuses = parser.get_slurm_json_jobs_status("""{"jobs": [
+        {"job_id": 8, "state": {"current": ["RUNNING"]},
+         "array": {"job_id": 7, "task_id": {"set": true, "number": 0}}},
+        {"job_id": 7, "state": {"current": ["PENDING"]},
+         "array": {"job_id": 7, "task_id": {"set": false, "number": 0}, "task": "1-2"}},
+        {"job_id": 9, "job_state": ["PENDING"],
+         "array_job_id": 0, "array_task_id": 4294967294}
+    ]}""")
+    assert {k: v.state for k, v in statuses.items()} == {
+        "7_0": "RUNNING", "7_1": "PENDING", "7_2": "PENDING", "9": "PENDING"}
+
+def test_pbs_jobs_status_parser():
+    statuses = parser.get_pbs_jobs_status("""\
+Job Id: 1.srv
+    job_state = R
+    Resource_List.walltime = 01:00:00
+    resources_used.walltime = 00:59:00
+Job Id: 2.srv
+    job_state = R
+    Walltime.Remaining = 42
+Job Id: 3.srv
+    job_state = Q""")
+    assert statuses["1.srv"].time_left == 60
+    assert statuses["2.srv"].time_left == 42
+    assert statuses["3.srv"].state == "Q"
+    assert statuses["3.srv"].time_left is None
+
+def test_slurm_json_nodes_columns():
+    nodes = parser.get_slurm_json_nodes_columns("""{"nodes": [
+        {"name": "node01", "partitions": ["gpu", "all"], "state": "idle", "cpus": 64},
+        {"name": "node02", "partitions": ["gpu"], "state": ["MIXED"], "cpus": 32},
+        {"name": "node03", "partitions": ["gpu"], "state": ["IDLE", "DRAIN"], "cpus": 32}
+    ]}""")
+    assert nodes.partitions == ["gpu", "all"]
+    assert list(nodes.partition) == [0, 1, 0, 0]
+    assert list(nodes.cpus) == [64, 64, 32, 32]
+    idle = parser.NODE_STATE_CODES[NodeStateCode.IDLE]
+    mixed = parser.NODE_STATE_CODES[NodeStateCode.MIXED]
+    assert list(nodes.state) == [idle, idle, mixed, 0]
+    assert len(parser.get_slurm_json_nodes_columns("")) == 0
+
+def test_slurm_json_jobs_columns():
+    jobs = parser.get_slurm_json_jobs_columns("""{"jobs": [
+        {"job_id": 1, "partition": "gpu", "job_state": "RUNNING", "cpus": 8},
+        {"job_id": 2, "partition": "gpu", "job_state": ["PENDING"],
+         "cpus": {"set": true, "infinite": false, "number": 4}}
+    ]}""")
+    assert jobs.partitions == ["gpu"]
+    assert list(jobs.cpus) == [8, 4]
+    assert list(jobs.state) == [
+        parser.JOB_STATE_CODES[JobStatusCode.RUNNING],
+        parser.JOB_STATE_CODES[JobStatusCode.QUEUED]]
+
+def test_slurm_json_jobs_status_parser():
+    # sacct --json
+    statuses = parser.get_slurm_json_jobs_status("""{"jobs": [
+        {"job_id": 1, "state": {"current": "RUNNING"},
+         "time": {"elapsed": 3000, "limit": 60}},
+        {"job_id": 2, "state": {"current": ["CANCELLED"]},
+         "time": {"elapsed": 0, "limit": {"set": true, "infinite": true, "number": 0}}}
+    ]}""")
+    assert statuses["1"].state == "RUNNING"
+    assert statuses["1"].time_left == 600
+    assert statuses["2"].state == "CANCELLED"
+    assert statuses["2"].time_left is None
+    # squeue --json and slurmrestd
+    statuses = parser.get_slurm_json_jobs_status("""{"jobs": [
+        {"job_id": 3, "job_state": ["RUNNING"],
+         "start_time": {"set": true, "number": 1000}, "time_limit": 10}
+    ]}""", now=1100)
+    assert statuses["3"].time_left == 500
+
+def test_pbs_json_telemetry_columns():
+    jobs = parser.get_pbs_jobs_columns("""{"Jobs": {
+        "1.srv": {"job_state": "R", "queue": "workq", "Resource_List": {"ncpus": 8}},
+        "2.srv": {"job_state": "Q", "queue": "gpu", "Resource_List": {"ncpus": 4}}
+    }}""")
+    assert jobs.partitions == ["workq", "gpu"]
+    assert list(jobs.cpus) == [8, 4]
+    assert list(jobs.state) == [
+        parser.JOB_STATE_CODES[JobStatusCode.RUNNING],
+        parser.JOB_STATE_CODES[JobStatusCode.QUEUED]]
+
+    nodes = parser.get_pbs_nodes_columns("""{"nodes": {
+        "node01": {"state": "free", "resources_available": {"ncpus": 64},
+                   "resources_assigned": {"ncpus": 8}},
+        "node02": {"state": "free", "queue": "gpu",
+                   "resources_available": {"ncpus": 32}},
+        "node03": {"state": "down,offline", "resources_available": {"ncpus": 16}}
+    }}""", jobs.partitions)
+    assert nodes.partitions == ["workq", "gpu"]
+    assert list(nodes.partition) == [0, 1, 1, 0, 1]
+    assert list(nodes.cpus) == [64, 64, 32, 16, 16]
+    mixed = parser.NODE_STATE_CODES[NodeStateCode.MIXED]
+    idle = parser.NODE_STATE_CODES[NodeStateCode.IDLE]
+    assert list(nodes.state) == [mixed, mixed, idle, 0, 0]
+
+def test_pbs_text_telemetry_columns():
+    jobs = parser.get_pbs_jobs_columns("""\
+Job Id: 1.torque
+    Job_Name = test
+    job_state = R
+    queue = batch
+    Resource_List.nodes = 2:ppn=8
+    Variable_List = PBS_O_HOME=/home/user,
+\tPBS_O_LANG=en_US.UTF-8
+Job Id: 2.torque
+    job_state = Q
+    queue = batch
+""")
+    assert jobs.partitions == ["batch"]
+    assert list(jobs.cpus) == [16, 1]
+
+    nodes = parser.get_pbs_nodes_columns("""\
+node01
+     state = free
+     np = 16
+     ntype = cluster
+
+node02
+     state = job-exclusive
+     np = 16
+     jobs = 0/1.torque, 1/1.torque
+""", jobs.partitions)
+    assert nodes.partitions == ["batch"]
+    assert list(nodes.cpus) == [16, 16]
+    assert list(nodes.state) == [
+        parser.NODE_STATE_CODES[NodeStateCode.IDLE],
+        parser.NODE_STATE_CODES[NodeStateCode.ALLOCATED]]
+    assert parser.get_pbs_nodes_columns("").partitions == []
+
+def test_jobs_runtime_parsers():
+    assert parser.get_slurm_jobs_runtime(
+        "1|COMPLETED|61\n2|CANCELLED by 0|5\n3|RUNNING|") == {
+            "1": 61, "2": None, "3": None}
+    assert parser.get_pbs_jobs_runtime("""\
+Job Id: 1[0].srv
+    resources_used.walltime = 00:01:01
+    Exit_status = 0
+Job Id: 1[1].srv
+    resources_used.walltime = 00:00:05
+    Exit_status = 1""") == {"1[0].srv": 61, "1[1].srv": None}
+
+def test_slurm_columns_parser(slurm_nodes, slurm_jobs):
+    nodes = parser.get_slurm_nodes_columns(slurm_nodes + "\n")
+    expected = parser.NodeColumns.from_nodes(parser.get_slurm_nodes_info(slurm_nodes))
+    assert nodes.partitions == expected.partitions
+    assert nodes.partition == expected.partition
+    assert nodes.state == expected.state
+    assert nodes.cpus == expected.cpus
+    assert len(parser.get_slurm_nodes_columns("")) == 0
+
+    # a line with a field too many is only off in that line
+    jobs = parser.get_slurm_jobs_columns(slurm_jobs + ",extra")
+    assert jobs.partitions == ["profile"]
+    assert list(jobs.cpus) == [128, 128, 128]
+    assert list(jobs.state) == [
+        parser.JOB_STATE_CODES[JobStatusCode.RUNNING],
+        parser.JOB_STATE_CODES[JobStatusCode.RUNNING],
+        parser.JOB_STATE_CODES[JobStatusCode.QUEUED]]
+
+def test_slurm_jobs_columns_benchmark(slurm_jobs):
+    # squeue of a large cluster, the columns are parsed in one pass
+    data = "\n".join([slurm_jobs] * 20000)
+
+    def best_of(parse):
+        durations = []
+        for _ in range(3):
+            start = time.perf_counter()
+            parse(data)
+            durations.append(time.perf_counter() - start)
+        return min(durations)
+
+    per_job = best_of(
+        lambda data: parser.JobColumns.from_jobs(parser.get_slurm_jobs_info(data)))
+    columns = best_of(parser.get_slurm_jobs_columns)
+    assert columns * 1.5 < per_job
@@ -1,13 +1,15 @@
+import time
+import hashlib
 import pytest
 from io import BytesIO
 from pathlib import Path
+from unittest.mock import MagicMock
 
 import aiofiles.tempfile
 
 from botocore.response import StreamingBody
-from botocore.stub import Stubber
+from botocore.stub import Stubber, ANY
 from botocore.exceptions import ClientError
-from boto3.exceptions import S3UploadFailedError
 
 import hpc.api.utils.s3 as s3
 
@@ -236,26 +238,51 @@ async def test_upload_file_failure(client):
 
 
 @pytest.mark.asyncio
-async def test_download_file(client, get_object):
+async def test_stream_object(client, get_object):
+    payload = b"0123456789" * 10
+    get_object["Body"] = StreamingBody(BytesIO(payload), len(payload))
     stubber = Stubber(client)
     stubber.add_response("get_object", get_object)
     stubber.activate()
-    async with aiofiles.tempfile.TemporaryDirectory() as d:
-        dst = Path(d) / obj
-        res = await s3.download_file(client, bucket, obj, dst)
-        assert res is not None
-        dst.read_bytes() == text_bytes
+    chunks = [
+        chunk async for chunk in s3.stream_object(
+            client, bucket, obj, chunk_size=16, max_buffered_chunks=2)]
+    assert all(len(chunk) <= 16 for chunk in chunks)
+    assert b"".join(chunks) == payload
 
 
 @pytest.mark.asyncio
-async def test_download_file_failure(client):
+async def test_stream_object_failure(client):
     stubber = Stubber(client)
     stubber.add_client_error("get_object")
     stubber.activate()
     with pytest.raises(ClientError):
-        async with aiofiles.tempfile.TemporaryDirectory() as d:
-            dst = Path(d) / obj
-            await s3.download_file(client, bucket, obj, dst)
+        async for _ in s3.stream_object(client, bucket, obj):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_stream_object_stops_reading_before_close():
+    events = []
+
+    class SlowBody:
+        def read(self, size):
+            events.append("read")
+            time.sleep(0.05)
+            events.append("done")
+            return b"x" * size
+
+        def close(self):
+            events.append("close")
+
+    client = MagicMock()
+    client.get_object.return_value = {"Body": SlowBody()}
+    chunks = s3.stream_object(
+        client, bucket, obj, chunk_size=4, max_buffered_chunks=1)
+    assert await chunks.__anext__() == b"xxxx"
+    await chunks.aclose()
+    assert events[-1] == "close"
+    assert events.count("read") == events.count("done")
 
 
 @pytest.mark.asyncio
@@ -292,3 +319,88 @@ async def test_get_object_attributes_failure(client):
     stubber.activate()
     with pytest.raises(ClientError):
         await s3.get_object_attributes(client, bucket, obj)
+
+
+def md5_etag(*parts):
+    digests = [hashlib.md5(part) for part in parts]
+    if len(digests) == 1:
+        return f'"{digests[0].hexdigest()}"'
+    combined = hashlib.md5(b"".join(d.digest() for d in digests)).hexdigest()
+    return f'"{combined}-{len(digests)}"'
+
+
+@pytest.mark.asyncio
+async def test_upload_file_multipart(client):
+    payload = b"a" * 10 + b"b" * 10 + b"c" * 5
+    parts = [payload[0:10], payload[10:20], payload[20:]]
+    stubber = Stubber(client)
+    stubber.add_response(
+        "create_multipart_upload", {"UploadId": "upload-1"},
+        {"Bucket": bucket, "Key": obj})
+    for number, part in enumerate(parts, 1):
+        stubber.add_response(
+            "upload_part", {"ETag": md5_etag(part)},
+            {"Bucket": bucket, "Key": obj, "PartNumber": number,
+             "UploadId": "upload-1", "Body": part, "ContentMD5": ANY})
+    stubber.add_response(
+        "complete_multipart_upload", {"ETag": md5_etag(*parts)},
+        {"Bucket": bucket, "Key": obj, "UploadId": "upload-1",
+         "MultipartUpload": {"Parts": [
+             {"PartNumber": n, "ETag": md5_etag(p)}
+             for n, p in enumerate(parts, 1)]}})
+    stubber.activate()
+    async with aiofiles.tempfile.TemporaryDirectory() as d:
+        path = Path(d) / obj
+        path.write_bytes(payload)
+        await s3.upload_file(client, path, bucket, obj, part_size=10, concurrency=1)
+    stubber.assert_no_pending_responses()
+
+
+@pytest.mark.asyncio
+async def test_upload_file_multipart_unsupported_falls_back(client, put_object):
+    stubber = Stubber(client)
+    stubber.add_client_error("create_multipart_upload", "NotImplemented")
+    stubber.add_response("put_object", put_object)
+    stubber.activate()
+    async with aiofiles.tempfile.TemporaryDirectory() as d:
+        path = Path(d) / obj
+        path.write_bytes(b"x" * 25)
+        res = await s3.upload_file(client, path, bucket, obj, part_size=10)
+        assert res is not None
+    stubber.assert_no_pending_responses()
+
+
+@pytest.mark.asyncio
+async def test_upload_file_checksum_mismatch(client, put_object):
+    put_object["ETag"] = md5_etag(b"something else")
+    stubber = Stubber(client)
+    stubber.add_response("put_object", put_object)
+    stubber.activate()
+    with pytest.raises(ValueError):
+        async with aiofiles.tempfile.TemporaryDirectory() as d:
+            path = Path(d) / obj
+            path.write_bytes(text_bytes)
+            await s3.upload_file(client, path, bucket, obj)
+
+
+@pytest.mark.asyncio
+async def test_upload_file_multipart_aborts_after_running_parts(tmp_path):
+    events = []
+
+    def upload_part(PartNumber, **kwargs):
+        if PartNumber == 1:
+            raise RuntimeError("part 1 failed")
+        time.sleep(0.2)
+        events.append("part {}".format(PartNumber))
+        return {"ETag": "etag"}
+
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    client.upload_part.side_effect = upload_part
+    client.abort_multipart_upload.side_effect = lambda **kwargs: events.append("abort")
+    path = tmp_path / obj
+    path.write_bytes(b"x" * 30)
+    with pytest.raises(RuntimeError):
+        await s3.upload_file(client, path, bucket, obj, part_size=10, concurrency=2)
+    # part 3 never started, part 2 was stored before the abort
+    assert events == ["part 2", "abort"]
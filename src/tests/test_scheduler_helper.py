@@ -2,7 +2,8 @@ import pytest
 
 from hpc.api.openapi.models.job_status_code import JobStatusCode
 from hpc.api.openapi.models.hpc_scheduler_type import HPCSchedulerType
-from hpc.api.utils.scheduler_helper import SchedulerHelperFactory
+from hpc.api.openapi.models.scheduler_interface import SchedulerInterface
+from hpc.api.utils.scheduler_helper import SchedulerHelperFactory, TELEMETRY_DELIMITER
 
 def test_non_existent_scheduler():
     with pytest.raises(NotImplementedError):
@@ -28,6 +29,25 @@ def test_parse_job_scheduler_id():
     with pytest.raises(ValueError):
         helper.parse_job_scheduler_id("does not contain numerics")
 
+def test_array_jobs():
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.PBS)
+    assert helper.get_array_submit_command(3) == "qsub -J 0-2"
+    assert helper.get_array_element_ids("12[].srv", 2) == ["12[0].srv", "12[1].srv"]
+    assert "'12[0].srv'" in helper.get_jobs_status_command(["12[0].srv"])
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.SLURM)
+    assert helper.get_array_submit_command(3) == "sbatch --array=0-2"
+    assert helper.get_array_element_ids("12", 2) == ["12_0", "12_1"]
+
+def test_sequential_jobs():
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.PBS)
+    assert helper.get_array_submit_command(3, 1) == "qsub -J 0-2%1"
+    assert helper.get_dependent_submit_command("12.srv") == \
+        "qsub -W depend=afterany:12.srv"
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.SLURM)
+    assert helper.get_array_submit_command(3, 1) == "sbatch --array=0-2%1"
+    assert helper.get_dependent_submit_command("12") == \
+        "sbatch --dependency=afterany:12"
+
 def test_job_status_code_pbs():
     helper = SchedulerHelperFactory.helper(HPCSchedulerType.PBS)
     assert helper.get_job_status_code("C") == JobStatusCode.COMPLETED
@@ -44,4 +64,73 @@ def test_job_status_code_slurm():
     assert helper.get_job_status_code("COMPLETING") == JobStatusCode.RUNNING
     assert helper.get_job_status_code("RUNNING") == JobStatusCode.RUNNING
     with pytest.raises(NotImplementedError):
-        helper.get_job_status_code("non-existent")
\ No newline at end of file
+        helper.get_job_status_code("non-existent")
+
+def test_jobs_status_pbs():
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.PBS)
+    assert helper.get_jobs_status_command(["1.srv", "2.srv"]).split()[:5] == \
+        ["qstat", "-x", "-f", "1.srv", "2.srv"]
+    data = "Job Id: 1.srv\n    job_state = R\nJob Id: 2.srv\n    job_state = Q"
+    statuses = helper.get_jobs_status(data)
+    assert {k: v.state for k, v in statuses.items()} == {"1.srv": "R", "2.srv": "Q"}
+    assert helper.get_jobs_status("") == {}
+
+def test_jobs_status_slurm():
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.SLURM)
+    assert helper.get_jobs_status_command(["1", "2"]).split()[0] == "sacct"
+    data = "1|RUNNING\n2|CANCELLED by 1000\n3|"
+    statuses = helper.get_jobs_status(data)
+    assert {k: v.state for k, v in statuses.items()} == {"1": "RUNNING", "2": "CANCELLED"}
+    assert helper.get_job_status_code("CANCELLED") == JobStatusCode.COMPLETED
+
+
+def test_telemetry_slurm():
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.SLURM)
+    command = helper.get_telemetry_command()
+    assert command.startswith(helper.get_nodes_info_command())
+    assert command.endswith(helper.get_jobs_info_command())
+    nodes, jobs = helper.get_telemetry(
+        "node01,node01,profile,idle,128,1,64,2,128\n"
+        "{}\n"
+        "1775,128,1,N/A,*,*,*,1:00:00,0,,profile,PENDING,node01\n".format(
+            TELEMETRY_DELIMITER))
+    assert nodes.partitions == ["profile"] and list(nodes.cpus) == [128]
+    assert jobs.partitions == ["profile"] and list(jobs.cpus) == [128]
+    nodes, jobs = helper.get_telemetry(TELEMETRY_DELIMITER)
+    assert len(nodes) == 0 and len(jobs) == 0
+    with pytest.raises(ValueError):
+        helper.get_telemetry("node01,node01,profile,idle,128,1,64,2,128")
+
+
+def test_slurm_helper_interfaces():
+    infrastructure = {"scheduler": HPCSchedulerType.SLURM}
+    helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
+    assert helper.get_jobs_status_command(["1", "2"]).startswith("sacct -n")
+
+    infrastructure["scheduler_interface"] = SchedulerInterface.JSON
+    helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
+    assert helper.get_jobs_status_command(["1", "2"]) == "sacct --json -j 1,2"
+    assert helper.get_submit_command() == "sbatch"
+
+    infrastructure["scheduler_interface"] = SchedulerInterface.REST
+    with pytest.raises(ValueError):
+        SchedulerHelperFactory.for_infrastructure(infrastructure)
+    infrastructure["slurmrestd_url"] = "http://localhost:6820/"
+    helper = SchedulerHelperFactory.for_infrastructure(infrastructure)
+    assert helper.get_jobs_status_command(["1"]).startswith("curl")
+    assert "'http://localhost:6820/slurm/v0.0.39/nodes'" in \
+        helper.get_telemetry_command()
+    nodes, jobs = helper.get_telemetry(
+        '{"nodes": []}\n' + TELEMETRY_DELIMITER + '\n{"jobs": []}')
+    assert len(nodes) == 0 and len(jobs) == 0
+
+
+def test_telemetry_pbs():
+    helper = SchedulerHelperFactory.helper(HPCSchedulerType.PBS)
+    assert "pbsnodes -a -F json" in helper.get_telemetry_command()
+    nodes, jobs = helper.get_telemetry(
+        '{"nodes": {"node01": {"state": "free", "resources_available": {"ncpus": 4}}}}\n'
+        + TELEMETRY_DELIMITER + '\n'
+        '{"Jobs": {"1.srv": {"job_state": "R", "queue": "workq", "Resource_List": {"ncpus": 2}}}}')
+    assert nodes.partitions == ["workq"] and list(nodes.cpus) == [4]
+    assert jobs.partitions == ["workq"] and list(jobs.cpus) == [2]
@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 from pathlib import Path
 
@@ -54,7 +55,7 @@ async def test_non_existent_ssh_key_path(ssh_infrastructures):
             await ssh.get_pkey(key_path, key_password)
 
 
-@patch("asyncssh.connect")
+@patch("asyncssh.connect", new_callable=AsyncMock)
 @pytest.mark.asyncio
 async def test_ssh_command(connect_mock, ssh_infrastructures):
     ssh_infrastructures = await ssh_infrastructures
@@ -69,13 +70,13 @@ async def test_ssh_command(connect_mock, ssh_infrastructures):
         run_mock = AsyncMock()
         run_mock.run.return_value = MagicMock(
             stdout=f"{hostname}\n", stderr="")
-        connect_mock.return_value.__aenter__.return_value = run_mock
+        connect_mock.return_value = run_mock
         stdout, stderr = await ssh.exec_command(host, username, pkey, command)
         assert stdout == hostname
         assert stderr == ""
 
 
-@patch("asyncssh.connect")
+@patch("asyncssh.connect", new_callable=AsyncMock)
 @pytest.mark.asyncio
 async def test_ssh_sftp_upload(connect_mock, ssh_infrastructures):
     ssh_infrastructures = await ssh_infrastructures
@@ -93,14 +94,14 @@ async def test_ssh_sftp_upload(connect_mock, ssh_infrastructures):
             sftp_put_mock = AsyncMock()
             start_sftp_mock = MagicMock()
             start_sftp_mock.start_sftp_client.return_value.__aenter__.return_value = sftp_put_mock
-            connect_mock.return_value.__aenter__.return_value = start_sftp_mock
+            connect_mock.return_value = start_sftp_mock
             await ssh.sftp_upload(
                 host, username, pkey,
                 local_src, remote_dst
             )
 
 
-@patch("asyncssh.connect")
+@patch("asyncssh.connect", new_callable=AsyncMock)
 @pytest.mark.asyncio
 async def test_ssh_sftp_download(connect_mock, ssh_infrastructures):
     ssh_infrastructures = await ssh_infrastructures
@@ -114,10 +115,202 @@ async def test_ssh_sftp_download(connect_mock, ssh_infrastructures):
             remote_src = Path("/tmp") / "test_file.txt"
             local_dst = Path(tmp_dir) / "test_file.txt"
             sftp_get_mock = AsyncMock()
+            sftp_get_mock.stat.return_value.size = 9
             start_sftp_mock = MagicMock()
             start_sftp_mock.start_sftp_client.return_value.__aenter__.return_value = sftp_get_mock
-            connect_mock.return_value.__aenter__.return_value = start_sftp_mock
+            connect_mock.return_value = start_sftp_mock
             await ssh.sftp_download(
                 host, username, pkey,
                 remote_src, local_dst
             )
+
+
+@patch("asyncssh.connect", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_ssh_sftp_upload_stream(connect_mock, ssh_infrastructures):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]
+    pkey = await ssh.get_pkey(
+        infrastructure["ssh_key"]["path"], infrastructure["ssh_key"]["password"])
+    remote_file = AsyncMock()
+    sftp_mock = MagicMock()
+    sftp_mock.open.return_value.__aenter__.return_value = remote_file
+    sftp_mock.truncate = AsyncMock()
+    conn_mock = MagicMock()
+    conn_mock.start_sftp_client.return_value.__aenter__.return_value = sftp_mock
+    connect_mock.return_value = conn_mock
+
+    async def chunks():
+        for chunk in [b"abc", b"def"]:
+            yield chunk
+
+    remote_dst = Path("/tmp") / "test_file.txt"
+    written = []
+
+    async def on_chunk(offset):
+        written.append(offset)
+
+    await ssh.sftp_upload_stream(
+        infrastructure["host"], infrastructure["username"], pkey,
+        chunks(), remote_dst, offset=10, on_chunk=on_chunk)
+    sftp_mock.open.assert_called_once_with(
+        remote_dst, asyncssh.FXF_WRITE | asyncssh.FXF_CREAT)
+    assert [c.args for c in remote_file.write.await_args_list] == \
+        [(b"abc", 10), (b"def", 13)]
+    assert written == [13, 16]
+    sftp_mock.truncate.assert_awaited_once_with(remote_dst, 16)
+
+
+@patch("asyncssh.connect", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_ssh_sftp_upload_parts_resume(connect_mock, ssh_infrastructures):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]
+    pkey = await ssh.get_pkey(
+        infrastructure["ssh_key"]["path"], infrastructure["ssh_key"]["password"])
+    remote_file = AsyncMock()
+    sftp_mock = MagicMock()
+    sftp_mock.open.return_value.__aenter__.return_value = remote_file
+    sftp_mock.put = AsyncMock()
+    sftp_mock.truncate = AsyncMock()
+    conn_mock = MagicMock()
+    conn_mock.start_sftp_client.return_value.__aenter__.return_value = sftp_mock
+    connect_mock.return_value = conn_mock
+    parts = []
+
+    async def on_part(offset, length, size):
+        parts.append((offset, length, size))
+
+    async with aiofiles.tempfile.TemporaryDirectory() as tmp_dir:
+        local_src = Path(tmp_dir) / "test_file.txt"
+        local_src.write_bytes(b"0123456789")
+        remote_dst = Path("/tmp") / "test_file.txt"
+        await ssh.sftp_upload(
+            infrastructure["host"], infrastructure["username"], pkey,
+            local_src, remote_dst, completed_parts={4},
+            on_part=on_part, part_size=4, concurrency=2)
+
+    sftp_mock.put.assert_not_awaited()
+    assert sorted(c.args for c in remote_file.write.await_args_list) == \
+        [(b"0123", 0), (b"89", 8)]
+    assert sorted(parts) == [(0, 4, 10), (8, 2, 10)]
+    sftp_mock.truncate.assert_awaited_once_with(remote_dst, 10)
+
+
+def mock_connection(hostname="node"):
+    conn = MagicMock()
+    conn.run = AsyncMock(return_value=MagicMock(stdout=f"{hostname}\n", stderr=""))
+    return conn
+
+
+@patch("asyncssh.connect", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_ssh_pool_reuses_connection(connect_mock, ssh_infrastructures):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]
+    pkey = await ssh.get_pkey(
+        infrastructure["ssh_key"]["path"], infrastructure["ssh_key"]["password"])
+    connect_mock.return_value = mock_connection()
+    for _ in range(3):
+        await ssh.exec_command(
+            infrastructure["host"], infrastructure["username"], pkey, "hostname")
+    assert connect_mock.await_count == 1
+    await ssh.close_pool()
+
+
+@patch("asyncssh.connect", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_ssh_pool_multiplexes_and_caps_connections(connect_mock, ssh_infrastructures):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]
+    pkey = await ssh.get_pkey(
+        infrastructure["ssh_key"]["path"], infrastructure["ssh_key"]["password"])
+    pool = ssh.SSHConnectionPool(
+        max_connections_per_host=2, max_channels_per_connection=2)
+    connect_mock.side_effect = lambda *args, **kwargs: mock_connection()
+    active = 0
+    peak = 0
+
+    async def use():
+        nonlocal active, peak
+        async with pool.connection(
+                infrastructure["host"], infrastructure["username"], pkey):
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    await asyncio.gather(*[use() for _ in range(10)])
+    assert connect_mock.await_count == 2
+    assert peak == 4
+    await pool.close()
+
+
+@patch("asyncssh.connect", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_ssh_pool_reserves_channels_to_commands(connect_mock, ssh_infrastructures):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]
+    host = infrastructure["host"]
+    username = infrastructure["username"]
+    pkey = await ssh.get_pkey(
+        infrastructure["ssh_key"]["path"], infrastructure["ssh_key"]["password"])
+    pool = ssh.SSHConnectionPool(
+        max_connections_per_host=2, max_channels_per_connection=2,
+        reserved_channels=1)
+    connect_mock.side_effect = lambda *args, **kwargs: mock_connection()
+    release = asyncio.Event()
+    active = 0
+    peak = 0
+
+    async def use_bulk():
+        nonlocal active, peak
+        async with pool.connection(host, username, pkey, bulk=True):
+            active += 1
+            peak = max(peak, active)
+            await release.wait()
+            active -= 1
+
+    transfers = [asyncio.ensure_future(use_bulk()) for _ in range(6)]
+    await asyncio.sleep(0.01)
+    assert active == 3
+    # a command still gets the reserved channel
+    async with pool.connection(host, username, pkey):
+        pass
+    release.set()
+    await asyncio.gather(*transfers)
+    assert peak == 3
+    assert pool._bulk_channels[ssh.SSHConnectionPool.get_key(
+        host, username, pkey)] == 0
+    await pool.close()
+
+
+@patch("asyncssh.connect", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_ssh_pool_evicts_idle_and_closed(connect_mock, ssh_infrastructures):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]
+    host = infrastructure["host"]
+    username = infrastructure["username"]
+    pkey = await ssh.get_pkey(
+        infrastructure["ssh_key"]["path"], infrastructure["ssh_key"]["password"])
+    pool = ssh.SSHConnectionPool(idle_timeout=0.01)
+    connect_mock.side_effect = lambda *args, **kwargs: mock_connection()
+
+    async with pool.connection(host, username, pkey) as conn:
+        first = conn
+    await asyncio.sleep(0.05)
+    first.close.assert_called_once()
+
+    async with pool.connection(host, username, pkey) as conn:
+        second = conn
+    assert second is not first
+    assert connect_mock.await_count == 2
+
+    # connection dropped by the server, e.g. missed keepalives
+    client_factory = connect_mock.call_args.kwargs["client_factory"]
+    client_factory().connection_lost(None)
+    async with pool.connection(host, username, pkey) as conn:
+        assert conn is not second
+    assert connect_mock.await_count == 3
+    await pool.close()
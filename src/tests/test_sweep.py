@@ -0,0 +1,186 @@
+import asyncio
+import pytest
+
+import hpc.api.services.job as job
+import hpc.api.services.sweep as sweep
+import hpc.api.services.tuning as tuning
+from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_request_params import JobRequestParams
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+from hpc.api.openapi.models.service_name import ServiceName
+from hpc.api.openapi.models.sweep_request import SweepRequest
+from hpc.api.openapi.models.sweep_space import SweepSpace
+from hpc.api.openapi.models.sweep_objective import SweepObjective
+from hpc.api.openapi.models.tuned_params import TunedParams
+
+
+def sweep_params():
+    return JobRequestParams(
+        read_input_data="/input.csv",
+        input_data_double="abc",
+        input_data_float="abc",
+        inference_knn_path="abc",
+    )
+
+
+def test_candidates():
+    candidates = sweep.get_candidates(SweepSpace(
+        num_mpi_procs=[4, 8], perforation_stride=[1, 2, 3]))
+    assert len(candidates) == 6
+    assert candidates[-1].to_dict() == {
+        "num_mpi_procs": 8, "num_thread": None, "num_numa": None,
+        "num_core_numa": None, "perforation_stride": 3,
+        "precision_scenario": None}
+    with pytest.raises(ValueError):
+        sweep.get_candidates(SweepSpace())
+
+
+@pytest.mark.asyncio
+async def test_sweep_stores_fastest_candidate(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[1]["name"]
+    commands = []
+
+    checks = []
+
+    async def exec_command(host, username, pkey, command):
+        if command.startswith("echo"):
+            checks.append(command)
+            return "", ""
+        commands.append(command)
+        if command.startswith("stat"):
+            return "3000", ""
+        if command.startswith("sbatch"):
+            return "Submitted batch job 30", ""
+        return "30_0|COMPLETED|120\n30_1|COMPLETED|80\n30_2|FAILED|10", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    mocker.patch("hpc.api.services.job.watch_job_status")
+    sweep_status = await sweep.submit(SweepRequest(
+        services=[ServiceName.KALMAN],
+        infrastructure=infrastructure,
+        params=sweep_params(),
+        space=SweepSpace(num_mpi_procs=[4, 8, 16])))
+    assert sweep_status.status == JobStatusCode.QUEUED
+    assert sweep_status.input_size == 3000
+    # the candidates share the workspace, they run one at a time
+    assert commands[1].startswith("sbatch --array=0-2%1")
+    # and all convert the input, whatever the stamps say
+    assert not checks
+    assert "convert_binary_data=1" in commands[1]
+
+    for candidate in sweep_status.candidates:
+        job_status = await job.get(candidate.job_id)
+        job_status.status = JobStatusCode.COMPLETED
+        await job.save_status(job_status)
+    for _ in range(50):
+        sweep_status = await sweep.get(sweep_status.id)
+        if sweep_status.status == JobStatusCode.COMPLETED:
+            break
+        await asyncio.sleep(0.01)
+
+    assert sweep_status.status == JobStatusCode.COMPLETED
+    assert "-j 30_0,30_1,30_2" in commands[-1]
+    assert [c.runtime for c in sweep_status.candidates] == [120, 80, None]
+    assert sweep_status.best.num_mpi_procs == 8
+    key = tuning.get_tuning_key(infrastructure, [ServiceName.KALMAN], 3000)
+    assert (await tuning.get_tuned_params(key)).num_mpi_procs == 8
+
+
+@pytest.mark.asyncio
+async def test_sweep_recover(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[1]["name"]
+
+    async def exec_command(host, username, pkey, command):
+        return "41|COMPLETED|60\n42|COMPLETED|30", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    candidates = []
+    for scheduler_id in ("41", "42"):
+        job_status = job.JobStatus(
+            id="sweep-job-" + scheduler_id, scheduler_id=scheduler_id,
+            infrastructure=infrastructure, status=JobStatusCode.COMPLETED)
+        await job.save_status(job_status)
+        candidates.append(sweep.SweepCandidate(
+            job_id=job_status.id,
+            params=TunedParams(num_mpi_procs=int(scheduler_id))))
+    for sweep_id, objective in (("wall", SweepObjective.WALL_TIME),
+                                ("kernel", SweepObjective.KERNEL_TIME)):
+        await sweep.save_status(sweep.SweepStatus(
+            id=sweep_id, infrastructure=infrastructure,
+            services=[ServiceName.KALMAN], input_size=100,
+            objective=objective, status=JobStatusCode.RUNNING,
+            candidates=candidates))
+
+    assert await sweep.recover() == 1
+    kernel = await sweep.get("kernel")
+    assert kernel.status == JobStatusCode.COMPLETED
+    assert kernel.reason == "Interrupted by a restart"
+    for _ in range(50):
+        wall = await sweep.get("wall")
+        if wall.status == JobStatusCode.COMPLETED:
+            break
+        await asyncio.sleep(0.01)
+    assert wall.status == JobStatusCode.COMPLETED
+    assert wall.best.num_mpi_procs == 42
+
+
+@pytest.mark.asyncio
+async def test_kernel_time_objective(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[1]["name"]
+    commands = []
+
+    async def exec_command(host, username, pkey, command):
+        commands.append(command)
+        return "1500\n\n900", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    params = sweep_params()
+    job_requests = [
+        sweep.get_job_request(SweepRequest(
+            services=[ServiceName.KMEAN], infrastructure=infrastructure,
+            params=params, space=SweepSpace(),
+            objective=SweepObjective.KERNEL_TIME), "s", i, TunedParams())
+        for i in range(3)]
+    assert job_requests[2].params.profiling_workspace == "/profile/sweep-s/2"
+    assert params.profiling_workspace == "/profile"
+
+    sweep_status = sweep.SweepStatus(
+        id="s", infrastructure=infrastructure, services=[ServiceName.KMEAN],
+        objective=SweepObjective.KERNEL_TIME, status=JobStatusCode.COMPLETED,
+        candidates=[sweep.SweepCandidate(job_id=str(i), params=TunedParams())
+                    for i in range(3)])
+    await sweep.collect_runtimes(sweep_status, job_requests)
+    assert '"${HOME}/serrano/profile/sweep-s/0/kernel_time_ms"' in commands[0]
+    assert [c.runtime for c in sweep_status.candidates] == [1.5, None, 0.9]
+
+
+@pytest.mark.asyncio
+async def test_job_uses_tuned_params(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[0]["name"]
+    commands = []
+
+    async def exec_command(host, username, pkey, command):
+        if command.startswith("echo"):
+            return "", ""
+        commands.append(command)
+        if command.startswith("stat"):
+            return "5000", ""
+        return "1.server", ""
+
+    mocker.patch("hpc.api.utils.ssh.exec_command", new=exec_command)
+    mocker.patch("hpc.api.services.job.watch_job_status")
+    await tuning.save_tuned_params(
+        infrastructure, [ServiceName.FFT], 4097,
+        TunedParams(num_mpi_procs=32, num_thread=2), 10.0, "sweep")
+
+    job_request = JobRequest(
+        services=[ServiceName.FFT], infrastructure=infrastructure,
+        params=sweep_params(), use_tuned_params=True)
+    await job.submit(job_request)
+    assert commands[0] == 'stat -c %s "${HOME}/serrano/data/input.csv" 2>/dev/null || echo 0'
+    assert "num_MPI_Procs=32\n" in commands[1]
+    assert "num_Thread=2\n" in commands[1]
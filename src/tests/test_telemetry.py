@@ -1,13 +1,18 @@
+import asyncio
 import pytest
 
 import hpc.api.services.telemetry as telemetry
+import hpc.api.utils.resource_parser as parser
 
 from hpc.api.utils.resource_parser import SlurmNode, SlurmJob
+from hpc.api.utils.resource_parser import NodeColumns, JobColumns
+from hpc.api.utils.scheduler_helper import TELEMETRY_DELIMITER
 from hpc.api.openapi.models.infrastructure import Infrastructure
+from hpc.api.openapi.models.infrastructure_telemetry import InfrastructureTelemetry
 
 
 async def mock_ssh_command(*args, **kwargs):
-    return "", ""
+    return TELEMETRY_DELIMITER, ""
 
 
 def mock_slurm_nodes_info(*args, **kwargs):
@@ -52,7 +57,7 @@ async def test_slurm_idle_resources(ssh_infrastructures):
     jobs = []
 
     infrastructure = Infrastructure.from_dict(ssh_infrastructures[1])
-    telemetry_data = telemetry.derive_slurm_telemetry(
+    telemetry_data = telemetry.derive_telemetry(
         infrastructure, nodes, jobs)
 
     assert telemetry_data.name == infrastructure.name
@@ -75,7 +80,7 @@ async def test_slurm_allocated_resources(ssh_infrastructures):
     jobs = mock_slurm_jobs_info()
 
     infrastructure = Infrastructure.from_dict(ssh_infrastructures[1])
-    telemetry_data = telemetry.derive_slurm_telemetry(
+    telemetry_data = telemetry.derive_telemetry(
         infrastructure, nodes, jobs)
 
     assert telemetry_data.name == infrastructure.name
@@ -95,10 +100,12 @@ async def test_slurm_allocated_resources(ssh_infrastructures):
 async def test_get_slurm_telemetry(ssh_infrastructures, mocker):
     ssh_infrastructures = await ssh_infrastructures
     mocker.patch('hpc.api.utils.ssh.exec_command', new=mock_ssh_command)
-    mocker.patch('hpc.api.utils.resource_parser.get_slurm_nodes_info',
-                 new=mock_slurm_nodes_info)
-    mocker.patch('hpc.api.utils.resource_parser.get_slurm_jobs_info',
-                 new=mock_slurm_jobs_info)
+    mocker.patch('hpc.api.utils.resource_parser.get_slurm_nodes_columns',
+                 new=lambda data: NodeColumns.from_nodes(
+                     mock_slurm_nodes_info()))
+    mocker.patch('hpc.api.utils.resource_parser.get_slurm_jobs_columns',
+                 new=lambda data: JobColumns.from_jobs(
+                     mock_slurm_jobs_info()))
     telemetry_data = await telemetry.get(ssh_infrastructures[1]["name"])
     assert telemetry_data.name == ssh_infrastructures[1]["name"]
     assert telemetry_data.host == ssh_infrastructures[1]["host"]
@@ -111,3 +118,104 @@ async def test_get_slurm_telemetry(ssh_infrastructures, mocker):
     assert telemetry_data.partitions[0].avail_cpus == 32
     assert telemetry_data.partitions[0].running_jobs == 1
     assert telemetry_data.partitions[0].queued_jobs == 2
+
+
+@pytest.mark.asyncio
+async def test_telemetry_cache_coalesces_and_expires(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    name = ssh_infrastructures[1]["name"]
+    collected = []
+
+    async def collect(infrastructure_name):
+        collected.append(infrastructure_name)
+        await asyncio.sleep(0.05)
+        return InfrastructureTelemetry(
+            name=infrastructure_name, host="host", hostname="hostname",
+            scheduler="slurm", partitions=[])
+
+    mocker.patch('hpc.api.services.telemetry.collect', new=collect)
+    cache = telemetry.TelemetryCache(ttl=0.2)
+    results = await asyncio.gather(*[cache.get(name) for _ in range(5)])
+    assert collected == [name]
+    assert all(r.name == name and r.age is not None for r in results)
+
+    await asyncio.sleep(0.05)
+    assert (await cache.get(name)).age >= 0.04
+    assert collected == [name]
+
+    await asyncio.sleep(0.2)
+    assert (await cache.get(name)).age < 0.05
+    assert collected == [name, name]
+
+
+@pytest.mark.asyncio
+async def test_telemetry_cache_refresher(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    name = ssh_infrastructures[1]["name"]
+    collected = []
+
+    async def collect(infrastructure_name):
+        collected.append(infrastructure_name)
+        return InfrastructureTelemetry(
+            name=infrastructure_name, host="host", hostname="hostname",
+            scheduler="slurm", partitions=[])
+
+    mocker.patch('hpc.api.services.telemetry.collect', new=collect)
+    cache = telemetry.TelemetryCache(ttl=10, refresh_period=0.05)
+    await cache.get(name)
+    await asyncio.sleep(0.12)
+    cache.close()
+    assert len(collected) >= 2
+    assert (await cache.get(name)).age < 0.1
+
+
+@pytest.mark.asyncio
+async def test_telemetry_cache_refresher_drops_idle(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    name = ssh_infrastructures[1]["name"]
+    collected = []
+
+    async def collect(infrastructure_name):
+        collected.append(infrastructure_name)
+        return InfrastructureTelemetry(
+            name=infrastructure_name, host="host", hostname="hostname",
+            scheduler="slurm", partitions=[])
+
+    mocker.patch('hpc.api.services.telemetry.collect', new=collect)
+    cache = telemetry.TelemetryCache(ttl=0.02, refresh_period=0.02)
+    await cache.get(name)
+    # not requested for more than TELEMETRY_IDLE_TTLS ttls
+    await asyncio.sleep(0.2)
+    refreshed = len(collected)
+    await asyncio.sleep(0.1)
+    cache.close()
+    assert len(collected) == refreshed
+    assert name not in cache.snapshots and name not in cache.last_read
+
+
+@pytest.mark.asyncio
+async def test_slurm_telemetry_from_columns(ssh_infrastructures):
+    ssh_infrastructures = await ssh_infrastructures
+    nodes = parser.get_slurm_nodes_columns(
+        "node01,node01,gpu,allocated,128,1,64,2,128\n"
+        "node02,node02,gpu,idle,32,2,8,2,64\n"
+        "node03,node03,cpu,mixed,16,1,16,1,64\n")
+    jobs = parser.get_slurm_jobs_columns(
+        "1,100,1,N/A,*,*,*,59:51,0,node01,gpu,RUNNING,(null)\n"
+        "2,8,1,N/A,*,*,*,1:00:00,0,node03,cpu,RUNNING,(null)\n"
+        "3,8,1,N/A,*,*,*,1:00:00,0,,cpu,PENDING,(null)\n"
+        "4,8,1,N/A,*,*,*,1:00:00,0,,debug,PENDING,(null)\n"
+        "5,8,1,N/A,*,*,*,1:00:00,0,,cpu,SPECIAL_EXIT,(null)\n")
+
+    infrastructure = Infrastructure.from_dict(ssh_infrastructures[1])
+    partitions = telemetry.derive_telemetry(
+        infrastructure, nodes, jobs).partitions
+
+    assert [p.to_dict() for p in partitions] == [
+        {"name": "gpu", "total_nodes": 2, "avail_nodes": 1,
+         "total_cpus": 160, "avail_cpus": 60,
+         "running_jobs": 1, "queued_jobs": 0},
+        {"name": "cpu", "total_nodes": 1, "avail_nodes": 0,
+         "total_cpus": 16, "avail_cpus": 8,
+         "running_jobs": 1, "queued_jobs": 1},
+    ]
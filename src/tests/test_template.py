@@ -1,3 +1,4 @@
+import os
 import pytest
 import hpc.api.utils.template as template
 
@@ -271,3 +272,39 @@ def test_csv_output_command_rendering_depending_on_csv_output_flag():
     )
     rendered_template = template.render(request)
     assert "# generate csv output data: icase=0" not in rendered_template
+
+
+def test_render_cache():
+    registry = template.TemplateRegistry(cache_size=1)
+    request = JobRequest(
+        services=[ServiceName.KNN],
+        infrastructure="some_infra",
+        params=JobRequestParams(
+            read_input_data="abc",
+            input_data_double="abc",
+            input_data_float="abc",
+            inference_knn_path="abc",
+        )
+    )
+    params = template.generate_params(request)
+    rendered = registry.render(params)
+    assert "icase=3\n" in rendered
+    assert list(registry.rendered.values())[0][1] is rendered
+    assert registry.render(template.generate_params(request)) is rendered
+
+    params.num_mpi_procs = 8
+    assert "num_MPI_Procs=8\n" in registry.render(params)
+    assert len(registry.rendered) == 1
+
+
+def test_template_hot_reload(tmp_path):
+    from jinja2 import FileSystemLoader
+    path = tmp_path / "exe.sh.j2"
+    path.write_text("icase={{ params.icase }}")
+    registry = template.TemplateRegistry(FileSystemLoader(str(tmp_path)))
+    params = JobRequestParams(icase=1)
+    assert registry.render(params) == "icase=1"
+
+    path.write_text("case={{ params.icase }}")
+    os.utime(path, (1, 1))
+    assert registry.render(params) == "case=1"
@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+
+import hpc.api.services.job as job
+import hpc.api.services.workflow as workflow
+import hpc.api.utils.persistence as persistence
+from hpc.api.services.data_manager import HTTPDataManager, S3ResultManager
+from hpc.api.openapi.models.file_transfer_request import FileTransferRequest
+from hpc.api.openapi.models.s3_result_transfer_request import S3ResultTransferRequest
+from hpc.api.openapi.models.job_request import JobRequest
+from hpc.api.openapi.models.job_status import JobStatus
+from hpc.api.openapi.models.job_status_code import JobStatusCode
+from hpc.api.openapi.models.service_name import ServiceName
+from hpc.api.openapi.models.workflow_request import WorkflowRequest
+from hpc.api.openapi.models.workflow_status import WorkflowStatus
+from hpc.api.openapi.models.workflow_status_code import WorkflowStatusCode
+
+
+def workflow_request(infrastructure):
+    return WorkflowRequest(
+        inputs=[FileTransferRequest(
+            src="https://example.com/in.csv", dst="data/in.csv",
+            infrastructure=infrastructure)],
+        job=JobRequest(services=[ServiceName.FFT], infrastructure=infrastructure),
+        s3_results=[S3ResultTransferRequest(
+            endpoint="https://s3", bucket="bucket", object="out.csv",
+            region="local", access_key="a", secret_key="s",
+            src="data/out.csv", infrastructure=infrastructure)])
+
+
+async def wait_for_status(workflow_id, status):
+    for _ in range(100):
+        workflow_status = await workflow.get(workflow_id)
+        if workflow_status.status == status:
+            return workflow_status
+        await asyncio.sleep(0.01)
+    return workflow_status
+
+
+@pytest.mark.asyncio
+async def test_workflow_stages(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[1]["name"]
+    input_copy = mocker.patch.object(HTTPDataManager, "copy", new=AsyncMock())
+    result_copy = mocker.patch.object(S3ResultManager, "copy", new=AsyncMock())
+
+    async def submit(job_request):
+        job_status = JobStatus(
+            id="workflow-job", scheduler_id="1", infrastructure=infrastructure,
+            status=JobStatusCode.QUEUED)
+        await job.save_status(job_status)
+        return job_status
+
+    mocker.patch("hpc.api.services.job.submit", new=submit)
+    workflow_status = await workflow.submit(workflow_request(infrastructure))
+    assert workflow_status.status == WorkflowStatusCode.TRANSFERRING_INPUTS
+
+    workflow_status = await wait_for_status(
+        workflow_status.id, WorkflowStatusCode.RUNNING)
+    assert workflow_status.job == "workflow-job"
+    assert len(workflow_status.inputs) == 1
+    assert input_copy.await_count == 1
+    await asyncio.sleep(0.05)
+    assert result_copy.await_count == 0
+
+    await job.save_status(JobStatus(
+        id="workflow-job", scheduler_id="1", infrastructure=infrastructure,
+        status=JobStatusCode.COMPLETED))
+    workflow_status = await wait_for_status(
+        workflow_status.id, WorkflowStatusCode.COMPLETED)
+    assert workflow_status.status == WorkflowStatusCode.COMPLETED
+    assert len(workflow_status.s3_results) == 1
+    assert result_copy.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_workflow_failed_input(ssh_infrastructures, mocker):
+    ssh_infrastructures = await ssh_infrastructures
+    infrastructure = ssh_infrastructures[1]["name"]
+    mocker.patch.object(HTTPDataManager, "copy",
+                        new=AsyncMock(side_effect=OSError("unreachable")))
+    submit = mocker.patch("hpc.api.services.job.submit")
+
+    workflow_status = await workflow.submit(workflow_request(infrastructure))
+    workflow_status = await wait_for_status(
+        workflow_status.id, WorkflowStatusCode.FAILURE)
+    assert workflow_status.status == WorkflowStatusCode.FAILURE
+    assert "unreachable" in workflow_status.reason
+    assert workflow_status.job is None
+    submit.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_recover_fails_interrupted_workflows(mocker):
+    mocker.patch.object(persistence, "_backend", persistence.MemoryBackend())
+    for workflow_id, status in [("w1", WorkflowStatusCode.RUNNING),
+                                ("w2", WorkflowStatusCode.COMPLETED)]:
+        await workflow.save_status(WorkflowStatus(
+            id=workflow_id, infrastructure="slurm", status=status,
+            inputs=[], s3_inputs=[], s3_results=[], reason=""))
+
+    assert await workflow.recover() == 1
+    assert (await workflow.get("w1")).status == WorkflowStatusCode.FAILURE
+    assert (await workflow.get("w2")).status == WorkflowStatusCode.COMPLETED